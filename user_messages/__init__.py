@@ -0,0 +1,5 @@
+import django
+
+if django.VERSION < (3, 2):
+    # newer versions find the app config by themselves
+    default_app_config = "user_messages.apps.UserMessagesConfig"
@@ -2,6 +2,7 @@ from django.contrib import admin
 from django.contrib.admin import StackedInline
 
 from . import models
+from . import search
 
 
 class UserThreadInline(StackedInline):
@@ -14,20 +15,47 @@ class GroupMemberThreadInline(StackedInline):
     extra = 0
 
 
+class GroupThreadInline(StackedInline):
+    model = models.GroupThread
+    extra = 0
+
+
 class MessageInline(StackedInline):
+    # the thread's denormalized latest message fields are only maintained
+    # by ``MessageManager``, so messages are not edited through the admin
     model = models.Message
     extra = 0
+    can_delete = False
+    readonly_fields = ('sender', 'sent_at', 'content')
+
+    def has_add_permission(self, request, obj=None):
+        return False
 
 
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('id', 'thread')
     list_display_links = ('id',)
+    readonly_fields = ('thread', 'sender', 'sent_at')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    def save_model(self, request, obj, form, change):
+        super(MessageAdmin, self).save_model(request, obj, form, change)
+        if "content" in form.changed_data:
+            search.reindex_message(obj)
 
 
 class ThreadAdmin(admin.ModelAdmin):
-    list_display = ('id', 'subject', 'num_messages', 'num_users',)
+    list_display = ('id', 'subject', 'last_message_at', 'num_messages',
+                    'num_users', 'fanout_status',)
     list_display_links = ('id',)
-    inlines = (MessageInline, UserThreadInline, GroupMemberThreadInline,)
+    list_filter = ('fanout_status',)
+    inlines = (MessageInline, UserThreadInline, GroupMemberThreadInline,
+               GroupThreadInline,)
 
 
 class UserThreadAdmin(admin.ModelAdmin):
@@ -0,0 +1,150 @@
+"""JSON endpoints for the inbox, the thread messages, the unread count and
+the lookup of recipients.
+
+Inbox responses carry an ``ETag`` and a ``Last-Modified`` header derived
+from the time the user's inbox last changed, as recorded by ``counters``.
+Conditional requests for unchanged resources are answered with a 304 before
+any thread is queried.
+
+"""
+
+import hashlib
+
+from django.contrib.auth.decorators import login_required
+from django.http import Http404, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+
+from user_messages import counters
+from user_messages import instrumentation
+from user_messages import recipients
+from user_messages.models import Message
+from user_messages.models import Thread
+from user_messages.pagination import InvalidCursor
+
+
+def _inbox_etag(request, *args, **kwargs):
+    modified = counters.get_inbox_modified(request.user)
+    raw = "{}|{}|{}".format(
+        request.user.id, modified.isoformat(), request.get_full_path())
+    return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+
+def _inbox_last_modified(request, *args, **kwargs):
+    return counters.get_inbox_modified(request.user)
+
+
+def _conditional(view):
+    return cache_control(private=True, no_cache=True)(
+        condition(
+            etag_func=_inbox_etag,
+            last_modified_func=_inbox_last_modified
+        )(view)
+    )
+
+
+def _serialize_user(user):
+    return {"id": user.id, "username": user.get_username()}
+
+
+def _serialize_message(message):
+    return {
+        "id": message.id,
+        "sender": _serialize_user(message.sender),
+        "sent_at": message.sent_at,
+        "content": message.content,
+    }
+
+
+def _serialize_thread(thread):
+    latest_message = thread.latest_message
+    return {
+        "id": thread.id,
+        "subject": thread.subject,
+        "url": thread.get_absolute_url(),
+        "unread": thread.user_unread,
+        "unread_messages": thread.user_unread_messages,
+        "message_count": thread.message_count,
+        "last_message_at": thread.last_message_at,
+        "latest_message": (
+            _serialize_message(latest_message)
+            if latest_message is not None else None),
+    }
+
+
+def _serialize_page(page, key, serialize):
+    return {
+        key: [serialize(item) for item in page],
+        "next_cursor": page.next_cursor,
+        "previous_cursor": page.previous_cursor,
+    }
+
+
+@login_required
+@instrumentation.instrumented("api.inbox")
+@_conditional
+def inbox(request):
+    """Return a page of the user's threads, only the unread ones if the
+    ``unread`` query parameter is set."""
+    if request.GET.get("unread"):
+        get_page = Thread.objects.unread_threads_page
+    else:
+        get_page = Thread.objects.active_threads_page
+    try:
+        page = get_page(
+            request.user, cursor=request.GET.get("cursor") or None)
+    except InvalidCursor:
+        raise Http404("Invalid cursor")
+    return JsonResponse(_serialize_page(page, "threads", _serialize_thread))
+
+
+@login_required
+@instrumentation.instrumented("api.thread_messages")
+@_conditional
+def thread_messages(request, thread_id):
+    """Return a page of the thread's messages, see ``views.thread_messages``.
+
+    Unlike ``views.thread_detail`` the thread is not marked as read.
+
+    """
+
+    thread = get_object_or_404(
+        Thread.objects.active_threads(request.user),
+        pk=thread_id
+    )
+    try:
+        page = Message.objects.messages_page(
+            thread, cursor=request.GET.get("cursor") or None)
+    except InvalidCursor:
+        raise Http404("Invalid cursor")
+    data = _serialize_page(page, "messages", _serialize_message)
+    data["thread"] = {"id": thread.id, "subject": thread.subject}
+    return JsonResponse(data)
+
+
+@login_required
+@instrumentation.instrumented("api.unread_count")
+@_conditional
+def unread_count(request):
+    return JsonResponse(
+        {"unread_count": counters.get_unread_count(request.user)})
+
+
+@login_required
+@instrumentation.instrumented("api.recipients")
+def recipients_page(request):
+    """Return a page of the users whose username starts with the ``q``
+    query parameter, that the user can send a message to."""
+    try:
+        page = recipients.search_recipients(
+            request.user,
+            request.GET.get("q", ""),
+            cursor=request.GET.get("cursor") or None
+        )
+    except InvalidCursor:
+        raise Http404("Invalid cursor")
+    return JsonResponse({
+        "users": [_serialize_user(user) for user in page],
+        "next_cursor": page.next_cursor,
+    })
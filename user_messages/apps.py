@@ -0,0 +1,16 @@
+from django.apps import AppConfig
+
+
+class UserMessagesConfig(AppConfig):
+    name = "user_messages"
+    default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        from user_messages import counters
+        from user_messages import events
+        from user_messages import recipients
+        from user_messages.signals import message_sent
+        message_sent.connect(
+            events.publish_message, dispatch_uid="user_messages.events")
+        counters.connect_signals()
+        recipients.connect_signals()
@@ -0,0 +1,185 @@
+"""ASGI application pushing new message events to the users.
+
+Mount it next to the django application, in the project's asgi module::
+
+    from django.core.asgi import get_asgi_application
+    from user_messages.asgi import with_event_stream
+
+    application = with_event_stream(
+        get_asgi_application(), "/messages/events/")
+
+and enable the ``USER_MESSAGES_EVENTS`` setting. The user is authenticated
+through the django session cookie.
+
+By default the response is a stream of server-sent events: an
+``unread_count`` event when connecting, then a ``message`` event for every
+new message in the user's threads, followed by an updated ``unread_count``.
+A comment is sent every ``USER_MESSAGES_EVENTS_KEEPALIVE`` seconds (defaults
+to 15) to keep the connection open.
+
+Clients that cannot use server-sent events can pass the ``poll`` query
+parameter instead. The response is then sent as soon as an event is
+received, or after ``USER_MESSAGES_EVENTS_POLL_TIMEOUT`` seconds (defaults to
+25), as a JSON object with the ``events`` list and the ``unread_count``.
+
+Idle clients only wait on the broker, the database is queried when
+connecting and when an event is received.
+
+"""
+
+import asyncio
+from http.cookies import SimpleCookie
+from importlib import import_module
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpRequest
+
+from user_messages import counters
+from user_messages import events
+
+
+def with_event_stream(application, path="/messages/events/"):
+    """Return an application serving ``event_stream`` on ``path``.
+
+    Other requests are passed to ``application``.
+
+    """
+
+    async def router(scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == path:
+            await event_stream(scope, receive, send)
+        else:
+            await application(scope, receive, send)
+
+    return router
+
+
+def _get_user(scope):
+    from django.contrib.auth import get_user
+    cookies = SimpleCookie()
+    for name, value in scope.get("headers", ()):
+        if name == b"cookie":
+            cookies.load(value.decode("latin-1"))
+    morsel = cookies.get(settings.SESSION_COOKIE_NAME)
+    engine = import_module(settings.SESSION_ENGINE)
+    request = HttpRequest()
+    request.session = engine.SessionStore(
+        morsel.value if morsel is not None else None)
+    return get_user(request)
+
+
+def _get_channels(user):
+    channels = [events.user_channel(user.pk)]
+    channels.extend(
+        events.group_channel(group_id)
+        for group_id in user.groups.values_list("pk", flat=True)
+    )
+    return channels
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _next_event(subscription, disconnected, timeout):
+    """Return the next event, or ``None`` on timeout or disconnection."""
+    getter = asyncio.ensure_future(subscription.get())
+    done, pending = await asyncio.wait(
+        {getter, disconnected},
+        timeout=timeout,
+        return_when=asyncio.FIRST_COMPLETED
+    )
+    if getter in done:
+        return getter.result()
+    getter.cancel()
+    return None
+
+
+async def _send_start(send, status, content_type):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+
+
+async def _send_event(send, name, data):
+    body = "event: {}\ndata: {}\n\n".format(name, json.dumps(data))
+    await send({
+        "type": "http.response.body",
+        "body": body.encode("utf-8"),
+        "more_body": True,
+    })
+
+
+async def _stream(user, subscription, disconnected, send):
+    keepalive = getattr(settings, "USER_MESSAGES_EVENTS_KEEPALIVE", 15)
+    get_unread_count = sync_to_async(counters.get_unread_count)
+    await _send_start(send, 200, b"text/event-stream")
+    await _send_event(
+        send, "unread_count",
+        {"unread_count": await get_unread_count(user)}
+    )
+    while True:
+        event = await _next_event(subscription, disconnected, keepalive)
+        if disconnected.done():
+            return
+        if event is None:
+            await send({
+                "type": "http.response.body",
+                "body": b": keepalive\n\n",
+                "more_body": True,
+            })
+            continue
+        await _send_event(send, event["type"], event)
+        await _send_event(
+            send, "unread_count",
+            {"unread_count": await get_unread_count(user)}
+        )
+
+
+async def _long_poll(user, subscription, disconnected, send):
+    timeout = getattr(settings, "USER_MESSAGES_EVENTS_POLL_TIMEOUT", 25)
+    event = await _next_event(subscription, disconnected, timeout)
+    if disconnected.done():
+        return
+    body = json.dumps({
+        "events": [event] if event is not None else [],
+        "unread_count": await sync_to_async(counters.get_unread_count)(user),
+    })
+    await _send_start(send, 200, b"application/json")
+    await send({"type": "http.response.body", "body": body.encode("utf-8")})
+
+
+async def event_stream(scope, receive, send):
+    """Send the events of the authenticated user."""
+    user = await sync_to_async(_get_user)(scope)
+    if not user.is_authenticated:
+        await _send_start(send, 403, b"text/plain")
+        await send({"type": "http.response.body", "body": b"Forbidden"})
+        return
+    channels = await sync_to_async(_get_channels)(user)
+    subscription = events.get_broker().subscribe(channels)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    query = parse_qs(
+        scope.get("query_string", b"").decode("latin-1"),
+        keep_blank_values=True
+    )
+    try:
+        if "poll" in query:
+            await _long_poll(user, subscription, disconnected, send)
+        else:
+            await _stream(user, subscription, disconnected, send)
+    finally:
+        disconnected.cancel()
+        subscription.close()
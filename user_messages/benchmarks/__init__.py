@@ -0,0 +1,7 @@
+"""Benchmarks for the messaging queries.
+
+Benchmarks create their own data inside a transaction that is rolled back
+once they are done. They are meant to be run through the
+``user_messages_benchmark`` management command.
+
+"""
@@ -0,0 +1,224 @@
+"""Synthetic datasets for the messaging benchmarks.
+
+The generated data tries to look like a real GeoNode instance:
+
+* group sizes follow a rank-size (Zipf) distribution, so there are a few very
+  large groups and many small ones;
+* a few users send most of the messages;
+* most threads only have a couple of messages, while a few of them have
+  hundreds (Pareto distribution).
+
+All records are inserted in bulk, without going through ``MessageManager``.
+
+"""
+
+from collections import namedtuple
+import datetime
+import itertools
+import random
+
+from django.contrib.auth import get_user_model
+from django.db.models import Count, OuterRef, Subquery
+from django.utils import timezone
+
+from geonode.groups.models import GroupMember, GroupProfile
+
+from user_messages.models import FanoutGroup
+from user_messages.models import GroupMemberThread
+from user_messages.models import GroupThread
+from user_messages.models import Message
+from user_messages.models import Thread
+from user_messages.models import UserThread
+
+PREFIX = "user_messages_benchmark"
+BATCH_SIZE = 1000
+
+Dataset = namedtuple("Dataset", ["options", "users", "groups", "threads"])
+
+DEFAULT_OPTIONS = {
+    "num_users": 1000,
+    "num_groups": 20,
+    "max_group_size": 500,
+    "group_size_exponent": 1.0,
+    "num_threads": 2000,
+    "group_thread_ratio": 0.3,
+    "subscription_ratio": 0.0,
+    "message_count_alpha": 1.5,
+    "max_messages": 500,
+    "unread_ratio": 0.3,
+    "deleted_ratio": 0.05,
+    "seed": 0,
+}
+
+
+def _create_users(num_users):
+    User = get_user_model()
+    User.objects.bulk_create(
+        [User(username="{}_{}".format(PREFIX, index))
+         for index in range(num_users)],
+        batch_size=BATCH_SIZE
+    )
+    return list(User.objects.filter(
+        username__startswith=PREFIX).order_by("pk"))
+
+
+def _create_groups(rng, users, num_groups, max_group_size, exponent):
+    """Create groups with sizes following a rank-size distribution.
+
+    Return a list of ``(group_profile, member_ids)`` tuples.
+
+    """
+
+    groups = []
+    for rank in range(num_groups):
+        size = max(2, int(max_group_size / (rank + 1) ** exponent))
+        members = rng.sample(users, min(size, len(users)))
+        group_profile = GroupProfile.objects.create(
+            title="{} {}".format(PREFIX, rank),
+            slug="{}-{}".format(PREFIX, rank),
+            description=PREFIX,
+            access="public",
+        )
+        GroupMember.objects.bulk_create(
+            [GroupMember(group=group_profile, user=member, role="member")
+             for member in members],
+            batch_size=BATCH_SIZE
+        )
+        group_profile.group.user_set.add(*members)
+        groups.append((group_profile, [member.pk for member in members]))
+    return groups
+
+
+def _message_count(rng, alpha, max_messages):
+    return min(int(rng.paretovariate(alpha)), max_messages)
+
+
+def _read_sequence(rng, unread_ratio, message_count):
+    if rng.random() < unread_ratio:
+        return rng.randrange(message_count)
+    return message_count
+
+
+def refresh_thread_stats(thread_ids):
+    """Recompute the denormalized latest message fields of the threads."""
+    latest = Message.objects.filter(
+        thread=OuterRef("pk")).order_by("-sent_at", "-pk")
+    count = Message.objects.filter(
+        thread=OuterRef("pk")).order_by().values("thread").annotate(
+        count=Count("pk")).values("count")
+    thread_ids = list(thread_ids)
+    for start in range(0, len(thread_ids), BATCH_SIZE):
+        Thread.objects.filter(
+            pk__in=thread_ids[start:start + BATCH_SIZE]
+        ).update(
+            last_message=Subquery(latest.values("pk")[:1]),
+            last_message_at=Subquery(latest.values("sent_at")[:1]),
+            message_count=Subquery(count),
+            sequence=Subquery(count),
+        )
+
+
+def generate(**options):
+    """Create a dataset and return it as a ``Dataset`` tuple.
+
+    See ``DEFAULT_OPTIONS`` for the accepted options.
+
+    """
+
+    unknown = set(options) - set(DEFAULT_OPTIONS)
+    if unknown:
+        raise TypeError("Unknown dataset options: {}".format(
+            ", ".join(sorted(unknown))))
+    options = dict(DEFAULT_OPTIONS, **options)
+    rng = random.Random(options["seed"])
+    users = _create_users(options["num_users"])
+    groups = _create_groups(
+        rng,
+        users,
+        options["num_groups"],
+        options["max_group_size"],
+        options["group_size_exponent"]
+    )
+    # a few users send most of the messages
+    sender_weights = list(itertools.accumulate(
+        1.0 / (rank + 1) for rank in range(len(users))))
+    start = timezone.now() - datetime.timedelta(days=365)
+    Thread.objects.bulk_create(
+        [Thread(subject="{} thread {}".format(PREFIX, index))
+         for index in range(options["num_threads"])],
+        batch_size=BATCH_SIZE
+    )
+    threads = list(Thread.objects.filter(
+        subject__startswith=PREFIX).order_by("pk"))
+    user_threads = []
+    member_threads = []
+    group_threads = []
+    fanout_groups = []
+    messages = []
+
+    def flush(force=False):
+        for model, rows in ((UserThread, user_threads),
+                            (GroupMemberThread, member_threads),
+                            (GroupThread, group_threads),
+                            (FanoutGroup, fanout_groups),
+                            (Message, messages)):
+            if rows and (force or len(rows) >= BATCH_SIZE):
+                model.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+                del rows[:]
+
+    for thread in threads:
+        sender = rng.choices(users, cum_weights=sender_weights)[0]
+        message_count = _message_count(
+            rng, options["message_count_alpha"], options["max_messages"])
+        user_threads.append(UserThread(
+            thread=thread, user=sender, read_sequence=message_count))
+        if groups and rng.random() < options["group_thread_ratio"]:
+            group_profile, member_ids = rng.choice(groups)
+            if rng.random() < options["subscription_ratio"]:
+                group_threads.append(
+                    GroupThread(thread=thread, group=group_profile.group))
+            else:
+                fanout_groups.append(
+                    FanoutGroup(thread=thread, group=group_profile.group))
+                member_threads.extend(
+                    GroupMemberThread(
+                        thread=thread,
+                        group=group_profile.group,
+                        user_id=member_id,
+                        read_sequence=_read_sequence(
+                            rng, options["unread_ratio"], message_count),
+                        deleted=rng.random() < options["deleted_ratio"]
+                    ) for member_id in member_ids if member_id != sender.pk
+                )
+            participant_ids = member_ids
+        else:
+            recipients = set(rng.sample(users, rng.randint(1, 5)))
+            recipients.discard(sender)
+            user_threads.extend(
+                UserThread(
+                    thread=thread,
+                    user=recipient,
+                    read_sequence=_read_sequence(
+                        rng, options["unread_ratio"], message_count),
+                    deleted=rng.random() < options["deleted_ratio"]
+                ) for recipient in recipients
+            )
+            participant_ids = [recipient.pk for recipient in recipients]
+        sent_at = start + datetime.timedelta(
+            seconds=rng.randint(0, 365 * 24 * 3600))
+        for index in range(message_count):
+            messages.append(Message(
+                thread=thread,
+                sender_id=(
+                    sender.pk if index == 0 or not participant_ids
+                    else rng.choice(participant_ids)),
+                sent_at=sent_at,
+                content="benchmark message {}".format(index)
+            ))
+            sent_at += datetime.timedelta(seconds=rng.randint(1, 3600))
+        flush()
+    flush(force=True)
+    refresh_thread_stats(thread.pk for thread in threads)
+    threads = list(Thread.objects.filter(
+        subject__startswith=PREFIX).order_by("pk"))
+    return Dataset(options, users, groups, threads)
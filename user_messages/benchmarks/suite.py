@@ -0,0 +1,158 @@
+"""Time the messaging entry points on a synthetic dataset.
+
+For each entry point the suite records the wall time of every run, the number
+of database queries and the peak memory allocated by python (measured in an
+additional run, since tracing allocations slows everything down). Results
+are plain dictionaries, which can be dumped as JSON and compared with the
+results of another run, typically for another commit.
+
+"""
+
+from collections import Counter
+import time
+import tracemalloc
+
+import django
+from django.db import connection
+from django.db.models import Count
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from user_messages import views
+from user_messages.benchmarks import dataset as benchmark_dataset
+from user_messages.models import GroupMemberThread
+from user_messages.models import Message
+from user_messages.models import UserThread
+
+METRICS = ("mean_seconds", "queries", "peak_memory_bytes")
+
+
+def measure(name, func, repeat=5):
+    """Run ``func`` several times and return its measurements."""
+    timings = []
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    try:
+        func()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        "name": name,
+        "repeat": repeat,
+        "mean_seconds": sum(timings) / len(timings),
+        "min_seconds": min(timings),
+        "max_seconds": max(timings),
+        "queries": len(queries),
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def _request(method, user, data=None):
+    request = getattr(RequestFactory(), method)("/", data=data or {})
+    request.user = user
+    return request
+
+
+def _busiest_user(data):
+    """Return the user involved in the largest number of threads."""
+    counts = Counter()
+    for participants in (UserThread.objects, GroupMemberThread.objects):
+        counts.update(dict(
+            participants.filter(thread__in=data.threads).values(
+                "user").annotate(count=Count("pk")).values_list(
+                "user", "count")
+        ))
+    busiest_id = counts.most_common(1)[0][0]
+    return next(user for user in data.users if user.pk == busiest_id)
+
+
+def _largest_group_thread(data):
+    """Return the thread with the largest number of group members."""
+    thread_id = GroupMemberThread.objects.filter(
+        thread__in=data.threads
+    ).values("thread").annotate(
+        count=Count("pk")
+    ).order_by("-count").values_list("thread", flat=True).first()
+    return next(
+        (thread for thread in data.threads if thread.pk == thread_id),
+        data.threads[0]
+    )
+
+
+def run(repeat=5, **dataset_options):
+    """Create a dataset and measure all entry points against it.
+
+    Return a dictionary with the run's metadata and its results.
+
+    """
+
+    data = benchmark_dataset.generate(**dataset_options)
+    user = _busiest_user(data)
+    longest_thread = max(
+        data.threads, key=lambda thread: thread.message_count)
+    reader = longest_thread.registered_users.first()
+    group_thread = _largest_group_thread(data)
+    group_member = group_thread.registered_users.first()
+    largest_group = data.groups[0][0] if data.groups else None
+
+    def message_create():
+        post_data = {
+            "to_users": [reader.pk] if reader.pk != user.pk else [],
+            "to_groups": [largest_group.pk] if largest_group else [],
+            "subject": "benchmark",
+            "content": "benchmark",
+        }
+        views.message_create(_request("post", user, post_data))
+
+    entry_points = (
+        ("inbox", lambda: views.inbox(_request("get", user))),
+        ("thread_detail_get", lambda: views.thread_detail(
+            _request("get", reader), thread_id=longest_thread.pk)),
+        ("thread_detail_post", lambda: views.thread_detail(
+            _request("post", reader, {"content": "benchmark"}),
+            thread_id=longest_thread.pk)),
+        ("message_create", message_create),
+        ("new_reply", lambda: Message.objects.new_reply(
+            group_thread, group_member, "benchmark")),
+    )
+    return {
+        "meta": {
+            "created": timezone.now().isoformat(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "dataset": data.options,
+        },
+        "results": [
+            measure(name, func, repeat) for name, func in entry_points],
+    }
+
+
+def compare(baseline, current):
+    """Compare two sets of results, as returned by ``run``.
+
+    Return a list of ``(name, metric, baseline, current, ratio)`` tuples,
+    for each entry point found in both sets.
+
+    """
+
+    baseline_results = dict(
+        (result["name"], result) for result in baseline["results"])
+    rows = []
+    for result in current["results"]:
+        previous = baseline_results.get(result["name"])
+        if previous is None:
+            continue
+        for metric in METRICS:
+            before = previous.get(metric)
+            after = result.get(metric)
+            if before is None or after is None:
+                continue
+            ratio = float(after) / before if before else None
+            rows.append((result["name"], metric, before, after, ratio))
+    return rows
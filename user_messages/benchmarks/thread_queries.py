@@ -0,0 +1,89 @@
+"""Compare the inbox queries against the former OR-join based ones.
+
+Until the participation tables were looked up in independent subqueries, the
+``ThreadManager`` queries joined both ``UserThread`` and
+``GroupMemberThread`` and removed the resulting duplicate rows with
+``DISTINCT``. The cost of that form grows with the number of members of the
+groups involved in each thread.
+
+The former queries predate group subscriptions, so subscribed threads are
+left out when checking that both forms return the same threads.
+
+"""
+
+import random
+import time
+
+from django.db.models import F
+from django.db.models import Q
+
+from user_messages.benchmarks import dataset as benchmark_dataset
+from user_messages.models import Thread
+
+
+def legacy_active_threads(user):
+    return Thread.objects.filter(
+        Q(
+            userthread__user__id=user.id,
+            userthread__deleted=False
+        ) | Q(
+            groupmemberthread__user__id=user.id,
+            groupmemberthread__deleted=False
+        )
+    ).distinct()
+
+
+def legacy_unread_threads(user):
+    return Thread.objects.filter(
+        Q(
+            userthread__user=user,
+            userthread__deleted=False,
+            userthread__read_sequence__lt=F("sequence")
+        ) | Q(
+            groupmemberthread__user=user,
+            groupmemberthread__deleted=False,
+            groupmemberthread__read_sequence__lt=F("sequence"),
+        )
+    ).distinct()
+
+
+def _time_queries(query, users, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for user in users:
+            list(query(user).values_list("pk", flat=True))
+    return (time.perf_counter() - started) / (repeat * len(users))
+
+
+def run(sample_size=50, repeat=3, **dataset_options):
+    """Time both forms of the queries for a sample of users.
+
+    Return a list of ``(name, seconds per call)`` tuples.
+
+    """
+
+    data = benchmark_dataset.generate(**dataset_options)
+    sample = random.Random(data.options["seed"]).sample(
+        data.users, min(sample_size, len(data.users)))
+    queries = (
+        ("active_threads", Thread.objects.active_threads,
+         legacy_active_threads),
+        ("unread_threads", Thread.objects.unread_threads,
+         legacy_unread_threads),
+    )
+    subscribed = set(Thread.objects.filter(
+        groupthread__isnull=False).values_list("pk", flat=True))
+    results = []
+    for name, query, legacy_query in queries:
+        for user in sample:
+            threads = set(query(user).values_list("pk", flat=True))
+            legacy_threads = set(
+                legacy_query(user).values_list("pk", flat=True))
+            if threads - subscribed != legacy_threads - subscribed:
+                raise AssertionError(
+                    "{} differs from its legacy form for {}".format(
+                        name, user))
+        results.append(
+            ("legacy_" + name, _time_queries(legacy_query, sample, repeat)))
+        results.append((name, _time_queries(query, sample, repeat)))
+    return results
@@ -1,8 +1,8 @@
-from user_messages.models import Thread
+from user_messages.counters import get_unread_count
 
 
 def user_messages(request):
     c = {}
     if request.user.is_authenticated:
-        c["inbox_count"] = Thread.objects.unread_threads(request.user).count()
+        c["inbox_count"] = get_unread_count(request.user)
     return c
@@ -0,0 +1,290 @@
+"""Per-user unread thread counters, stored in the django cache.
+
+The number of unread threads is shown on every page through the
+``user_messages`` context processor. Instead of counting the unread threads
+on every request, the count is cached and then adjusted whenever a thread's
+read state changes for a user. If a counter is missing from the cache (or
+has expired) it is recomputed from the database the next time it is needed.
+
+The cache also holds the time each user's inbox last changed, which is used
+to answer conditional requests without querying the threads. Whenever a
+counter is updated or dropped the modification time is dropped as well, and
+a missing modification time is set to the current time when next needed.
+Losing it can therefore only make clients fetch unchanged data again.
+
+Threads sent to groups can involve many users, whose counters are not
+adjusted one by one. Instead, each group has a version token in the cache,
+and the keys of a user's counter and modification time include the tokens of
+the user's groups: those the user is a member of, and those the user has
+participation records for. Replacing the tokens of some groups drops the
+counters of all their members at once. The ids of a user's groups are cached
+as well, and dropped whenever the user joins or leaves a group.
+
+The cache alias to use is controlled by the ``USER_MESSAGES_CACHE_ALIAS``
+setting and the counters' lifetime, in seconds, by the
+``USER_MESSAGES_UNREAD_COUNT_TIMEOUT`` setting.
+
+"""
+
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import m2m_changed
+from django.utils import timezone
+
+from user_messages.utils import get_group_change_user_ids
+
+
+def _get_cache():
+    return caches[getattr(settings, "USER_MESSAGES_CACHE_ALIAS", "default")]
+
+
+def _get_timeout():
+    return getattr(settings, "USER_MESSAGES_UNREAD_COUNT_TIMEOUT", 60 * 60)
+
+
+def _get_key(user_id, stamp):
+    return "user_messages:unread_count:{}:{}".format(user_id, stamp)
+
+
+def _get_modified_key(user_id, stamp):
+    return "user_messages:inbox_modified:{}:{}".format(user_id, stamp)
+
+
+def _get_groups_key(user_id):
+    return "user_messages:user_groups:{}".format(user_id)
+
+
+def _get_group_version_key(group_id):
+    return "user_messages:group_version:{}".format(group_id)
+
+
+def _get_user_group_ids(user_ids):
+    """Return the ids of the groups of each of the input users.
+
+    Former members of a group who still have participation records for it
+    keep it, so that their counters are dropped when its threads get a
+    reply.
+
+    """
+
+    from user_messages.models import GroupMemberThread
+    cache = _get_cache()
+    keys = dict((user_id, _get_groups_key(user_id)) for user_id in user_ids)
+    cached = cache.get_many(list(keys.values()))
+    group_ids = dict(
+        (user_id, cached[key]) for user_id, key in keys.items()
+        if key in cached
+    )
+    missing = dict(
+        (user_id, []) for user_id in keys if user_id not in group_ids)
+    if missing:
+        memberships = get_user_model().groups.through.objects.filter(
+            user__in=list(missing)
+        ).values_list("user", "group").union(
+            GroupMemberThread.objects.filter(
+                user__in=list(missing)).values_list("user", "group")
+        )
+        for user_id, group_id in memberships:
+            missing[user_id].append(group_id)
+        cache.set_many(
+            dict((keys[user_id], ids) for user_id, ids in missing.items()),
+            _get_timeout()
+        )
+        group_ids.update(missing)
+    return group_ids
+
+
+def _get_group_versions(group_ids):
+    cache = _get_cache()
+    keys = dict(
+        (group_id, _get_group_version_key(group_id))
+        for group_id in group_ids
+    )
+    cached = cache.get_many(list(keys.values()))
+    versions = {}
+    for group_id, key in keys.items():
+        version = cached.get(key)
+        if version is None:
+            version = uuid.uuid4().hex
+            if not cache.add(key, version, None):
+                # set concurrently
+                version = cache.get(key, version)
+        versions[group_id] = version
+    return versions
+
+
+def _get_stamps(user_ids):
+    """Return the part of each user's keys made of its groups' versions."""
+    group_ids = _get_user_group_ids(user_ids)
+    versions = _get_group_versions(
+        set(group_id for ids in group_ids.values() for group_id in ids))
+    stamps = {}
+    for user_id, ids in group_ids.items():
+        tokens = ",".join(
+            "{}:{}".format(group_id, versions[group_id])
+            for group_id in sorted(ids)
+        )
+        stamps[user_id] = hashlib.md5(tokens.encode("utf-8")).hexdigest()
+    return stamps
+
+
+def get_unread_count(user):
+    """Return the number of unread threads of the input user."""
+    cache = _get_cache()
+    key = _get_key(user.id, _get_stamps([user.id])[user.id])
+    count = cache.get(key)
+    if count is None:
+        from user_messages.models import Thread
+        count = Thread.objects.unread_threads(user).count()
+        cache.set(key, count, _get_timeout())
+    return count
+
+
+def get_inbox_modified(user):
+    """Return the last time the inbox of the input user changed."""
+    cache = _get_cache()
+    key = _get_modified_key(user.id, _get_stamps([user.id])[user.id])
+    modified = cache.get(key)
+    if modified is None:
+        modified = timezone.now()
+        if not cache.add(key, modified, _get_timeout()):
+            # set concurrently
+            modified = cache.get(key, modified)
+    return modified
+
+
+def touch_inbox(user_ids):
+    """Record that the inboxes of the input users have changed.
+
+    This is only needed for changes that do not affect the unread counters,
+    such as a new reply in a thread that is already unread.
+
+    """
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    def delete():
+        stamps = _get_stamps(user_ids)
+        _get_cache().delete_many(
+            [_get_modified_key(user_id, stamps[user_id])
+             for user_id in user_ids])
+
+    transaction.on_commit(delete)
+
+
+def increment_unread_count(user_ids, delta=1):
+    """Adjust the cached counters of the input users by ``delta``.
+
+    Counters that are not currently cached are left alone, they will be
+    recomputed when needed. The cache is only updated once the current
+    transaction is committed.
+
+    """
+
+    user_ids = set(user_ids)
+    if not user_ids or not delta:
+        return
+
+    def update():
+        cache = _get_cache()
+        stamps = _get_stamps(user_ids)
+        for user_id in user_ids:
+            key = _get_key(user_id, stamps[user_id])
+            try:
+                count = cache.incr(key, delta)
+            except ValueError:
+                # not cached
+                continue
+            if count < 0:
+                cache.delete(key)
+        cache.delete_many(
+            [_get_modified_key(user_id, stamps[user_id])
+             for user_id in user_ids])
+
+    transaction.on_commit(update)
+
+
+def decrement_unread_count(user_ids, delta=1):
+    increment_unread_count(user_ids, -delta)
+
+
+def invalidate_unread_count(user_ids):
+    """Drop the cached counters of the input users."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    def delete():
+        stamps = _get_stamps(user_ids)
+        _get_cache().delete_many(
+            [_get_key(user_id, stamps[user_id]) for user_id in user_ids] +
+            [_get_modified_key(user_id, stamps[user_id])
+             for user_id in user_ids]
+        )
+
+    transaction.on_commit(delete)
+
+
+def invalidate_group_unread_count(group_ids):
+    """Drop the cached counters of all the members of the input groups.
+
+    Only the version tokens of the groups are replaced, whatever the number
+    of members.
+
+    """
+
+    group_ids = set(group_ids)
+    if not group_ids:
+        return
+    transaction.on_commit(
+        lambda: _get_cache().set_many(
+            dict((_get_group_version_key(group_id), uuid.uuid4().hex)
+                 for group_id in group_ids),
+            None
+        )
+    )
+
+
+def touch_group_inbox(group_ids):
+    """Record that the inboxes of the members of the groups have changed.
+
+    Their counters are dropped as well, see
+    ``invalidate_group_unread_count``.
+
+    """
+
+    invalidate_group_unread_count(group_ids)
+
+
+def invalidate_user_groups(user_ids):
+    """Drop the cached groups of the input users, and so their counters."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    transaction.on_commit(
+        lambda: _get_cache().delete_many(
+            [_get_groups_key(user_id) for user_id in user_ids])
+    )
+
+
+def _user_groups_changed(sender, instance, action, reverse, pk_set,
+                         **kwargs):
+    user_ids = get_group_change_user_ids(instance, action, reverse, pk_set)
+    if user_ids is not None:
+        invalidate_user_groups(user_ids)
+
+
+def connect_signals():
+    """Drop the counters of the users whose groups change."""
+    m2m_changed.connect(
+        _user_groups_changed,
+        sender=get_user_model().groups.through,
+        dispatch_uid="user_messages.counters.user_groups"
+    )
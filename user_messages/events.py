@@ -0,0 +1,188 @@
+"""Publication of new message events to connected clients.
+
+When the ``USER_MESSAGES_EVENTS`` setting is true, every new message is
+published, once the transaction that created it is committed, to the
+channels of the thread's participants and of its subscribed groups. The
+``user_messages.asgi`` application forwards these events to the clients.
+
+Events go through a broker, an instance of the class named by the
+``USER_MESSAGES_EVENT_BROKER`` setting. The default ``InProcessBroker`` only
+reaches clients connected to the same process, a broker backed by an external
+pub/sub service is needed to deliver events across processes.
+
+"""
+
+import asyncio
+from collections import defaultdict
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, "USER_MESSAGES_EVENTS", False)
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(getattr(
+                settings,
+                "USER_MESSAGES_EVENT_BROKER",
+                "user_messages.events.InProcessBroker"
+            ))()
+    return _broker
+
+
+def user_channel(user_id):
+    return "user:{}".format(user_id)
+
+
+def group_channel(group_id):
+    return "group:{}".format(group_id)
+
+
+class Broker(object):
+    """Interface of the event brokers."""
+
+    def publish(self, channels, event):
+        """Send ``event``, a JSON serializable dict, to the channels.
+
+        Subscribers to several of the channels get the event only once.
+        This may be called from any thread.
+
+        """
+
+        raise NotImplementedError
+
+    def subscribe(self, channels):
+        """Return a ``Subscription`` to the input channels.
+
+        This is called from the event loop the subscription is used in.
+
+        """
+
+        raise NotImplementedError
+
+
+class Subscription(object):
+
+    async def get(self):
+        """Wait for the next event and return it."""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class InProcessSubscription(Subscription):
+
+    def __init__(self, broker, channels, max_size):
+        self.broker = broker
+        self.channels = frozenset(channels)
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(max_size)
+
+    def put(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # the loop has been closed
+            self.close()
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # the client does not keep up, its events are dropped
+            pass
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker(Broker):
+    """Deliver the events to the subscribers of the current process.
+
+    Each subscription buffers at most ``max_size`` events, further events
+    are dropped until the client reads them.
+
+    """
+
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._subscriptions = defaultdict(set)
+
+    def publish(self, channels, event):
+        with self._lock:
+            subscriptions = set()
+            for channel in channels:
+                subscriptions.update(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def subscribe(self, channels):
+        subscription = InProcessSubscription(self, channels, self.max_size)
+        with self._lock:
+            for channel in subscription.channels:
+                self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for channel in subscription.channels:
+                subscribers = self._subscriptions.get(channel)
+                if subscribers is None:
+                    continue
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscriptions[channel]
+
+
+def message_event(thread, message_id, sender_id, reply):
+    return {
+        "type": "message",
+        "thread": thread.pk,
+        "subject": thread.subject,
+        "message": message_id,
+        "sender": sender_id,
+        "reply": reply,
+    }
+
+
+def publish(event, user_ids=(), group_ids=()):
+    """Publish ``event`` to the users and groups once committed."""
+    channels = [user_channel(user_id) for user_id in set(user_ids)]
+    channels.extend(group_channel(group_id) for group_id in set(group_ids))
+    if channels:
+        transaction.on_commit(lambda: get_broker().publish(channels, event))
+
+
+def publish_message(sender, message, thread, reply, **kwargs):
+    """Receiver of the ``message_sent`` signal."""
+    if not is_enabled():
+        return
+    from user_messages.models import GroupMemberThread
+    from user_messages.models import GroupThread
+    from user_messages.models import UserThread
+    user_ids = set(UserThread.objects.filter(
+        thread=thread).values_list("user", flat=True))
+    user_ids.update(GroupMemberThread.objects.fanned_out().filter(
+        thread=thread).values_list("user", flat=True))
+    group_ids = GroupThread.objects.filter(
+        thread=thread).values_list("group", flat=True)
+    publish(
+        message_event(thread, message.pk, message.sender_id, reply),
+        user_ids,
+        group_ids
+    )
@@ -0,0 +1,289 @@
+"""Creation of the participation records of new threads.
+
+Messages sent to groups need one record per active group member. For very
+large groups writing these records can take a while, so when the number of
+members reaches the ``USER_MESSAGES_DEFERRED_FANOUT_THRESHOLD`` setting the
+records are written by a local pool of worker threads instead, once the
+thread and its first message have been committed. The progress is reflected
+in the thread's ``fanout_status``. The target groups are stored, see
+``record_groups``, so fan-outs lost when a process stops, or that failed, can
+be run again with ``resume_group_fanouts``.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Exists
+from django.db.models import OuterRef
+
+from user_messages import counters
+from user_messages import events
+from user_messages import instrumentation
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_batch_size():
+    return getattr(settings, "USER_MESSAGES_FANOUT_BATCH_SIZE", 500)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(
+                    settings, "USER_MESSAGES_FANOUT_WORKERS", 2),
+                thread_name_prefix="user_messages_fanout"
+            )
+    return _executor
+
+
+def _get_active_members(group_profiles):
+    GroupMember = group_profiles[0].groupmember_set.model
+    return GroupMember.objects.filter(
+        group__in=group_profiles,
+        user__is_active=True
+    )
+
+
+def should_defer(group_profiles):
+    """Return whether the fan-out to the input groups should be deferred."""
+    threshold = getattr(
+        settings, "USER_MESSAGES_DEFERRED_FANOUT_THRESHOLD", None)
+    if threshold is None or not group_profiles:
+        return False
+    return _get_active_members(group_profiles).count() >= threshold
+
+
+def add_users(thread, sender, users):
+    """Add the sender and the input users to a new thread.
+
+    Return the ids of the users that have been added, excluding the sender.
+
+    """
+
+    from user_messages.models import UserThread
+    recipient_ids = set(user.id for user in users) - {sender.id}
+    UserThread.objects.bulk_create(
+        [UserThread(thread=thread, user_id=sender.id,
+                    read_sequence=thread.sequence)] + [
+            UserThread(thread=thread, user_id=user_id)
+            for user_id in recipient_ids
+        ],
+        batch_size=_get_batch_size()
+    )
+    instrumentation.record_fanout(len(recipient_ids))
+    return recipient_ids
+
+
+def add_group_members(thread, sender, group_profiles):
+    """Add the active members of the input groups to a new thread.
+
+    Group members are resolved with a single query and the records are
+    inserted in batches of ``USER_MESSAGES_FANOUT_BATCH_SIZE`` rows. Return
+    the ids of the users that have been added, excluding the sender.
+
+    """
+
+    from user_messages.models import GroupMemberThread
+    recipient_ids = set()
+    if not group_profiles:
+        return recipient_ids
+    batch_size = _get_batch_size()
+    members = _get_active_members(group_profiles).values_list(
+        "group__group", "user").iterator()
+    batch = []
+    for group_id, user_id in members:
+        batch.append(GroupMemberThread(
+            thread=thread,
+            group_id=group_id,
+            user_id=user_id,
+            read_sequence=thread.sequence if user_id == sender.id else 0
+        ))
+        if user_id != sender.id:
+            recipient_ids.add(user_id)
+        if len(batch) >= batch_size:
+            GroupMemberThread.objects.bulk_create(batch)
+            batch = []
+    GroupMemberThread.objects.bulk_create(batch)
+    instrumentation.record_fanout(len(recipient_ids))
+    return recipient_ids
+
+
+def record_groups(thread, group_profiles):
+    """Store the groups whose members are added to a new thread."""
+    from user_messages.models import FanoutGroup
+    FanoutGroup.objects.bulk_create([
+        FanoutGroup(thread=thread, group_id=group_id)
+        for group_id in set(
+            group_profile.group_id for group_profile in group_profiles)
+    ])
+
+
+def subscribe_groups(thread, sender, group_profiles):
+    """Subscribe the input groups to a new thread.
+
+    Only one record per group is created, plus a state record for the sender
+    in each of its groups, where the thread is already read.
+
+    """
+
+    from user_messages.models import GroupThread
+    group_ids = set(
+        group_profile.group_id for group_profile in group_profiles)
+    GroupThread.objects.bulk_create(
+        [GroupThread(thread=thread, group_id=group_id)
+         for group_id in group_ids]
+    )
+    add_member_states(thread, sender, read_sequence=thread.sequence)
+    counters.invalidate_group_unread_count(group_ids)
+
+
+def add_member_states(thread, user, **state):
+    """Create the user's state records for the thread's subscribed groups.
+
+    Only groups where the user is a member and that do not have a state
+    record for the user yet are taken into account. Return the number of
+    records that have been created.
+
+    """
+
+    from user_messages.models import GroupMemberThread
+    group_ids = thread.groupthread_set.filter(
+        group__user__id=user.id
+    ).exclude(
+        group__in=thread.groupmemberthread_set.filter(
+            user__id=user.id).values("group")
+    ).values_list("group", flat=True)
+    created = GroupMemberThread.objects.bulk_create([
+        GroupMemberThread(
+            thread=thread, group_id=group_id, user_id=user.id, **state)
+        for group_id in group_ids
+    ])
+    instrumentation.record_fanout(len(created))
+    return len(created)
+
+
+def add_member_states_for_threads(threads, user, read=False, **state):
+    """Create the user's missing state records for several threads.
+
+    ``threads`` is a queryset of thread ids. The records are looked up with
+    a single query, see ``add_member_states``. When ``read`` is true, each
+    thread is read up to its current sequence.
+
+    """
+
+    from user_messages.models import GroupMemberThread, GroupThread
+    existing_states = GroupMemberThread.objects.filter(
+        thread=OuterRef("thread"),
+        group=OuterRef("group"),
+        user__id=user.id
+    )
+    missing = GroupThread.objects.filter(
+        thread__in=threads,
+        group__user__id=user.id
+    ).filter(~Exists(existing_states)).values_list(
+        "thread", "group", "thread__sequence")
+    created = GroupMemberThread.objects.bulk_create(
+        [GroupMemberThread(
+            thread_id=thread_id, group_id=group_id, user_id=user.id,
+            read_sequence=sequence if read else 0, **state)
+         for thread_id, group_id, sequence in missing],
+        batch_size=_get_batch_size()
+    )
+    instrumentation.record_fanout(len(created))
+    return len(created)
+
+
+@instrumentation.instrumented("fanout.run_group_fanout")
+def run_group_fanout(thread_id, sender, group_profiles):
+    """Add the members of the input groups to a thread with a pending fan-out.
+
+    The thread's ``fanout_status`` is set to complete on success and to
+    failed if an error occurs.
+
+    """
+
+    from user_messages.models import Thread
+    try:
+        with transaction.atomic():
+            thread = Thread.objects.select_for_update().get(pk=thread_id)
+            if thread.fanout_status != Thread.FANOUT_PENDING:
+                return
+            recipient_ids = add_group_members(thread, sender, group_profiles)
+            thread.fanout_status = Thread.FANOUT_COMPLETE
+            thread.save(update_fields=["fanout_status"])
+            counters.increment_unread_count(recipient_ids)
+            if events.is_enabled():
+                # the message was published before the members were added
+                events.publish(
+                    events.message_event(
+                        thread, thread.last_message_id, sender.id, False),
+                    recipient_ids
+                )
+    except Exception:
+        logger.exception("Could not add group members to thread %s",
+                         thread_id)
+        Thread.objects.filter(pk=thread_id).update(
+            fanout_status=Thread.FANOUT_FAILED)
+
+
+def _run_in_worker(thread_id, sender, group_profiles):
+    try:
+        run_group_fanout(thread_id, sender, group_profiles)
+    finally:
+        # workers get their own database connections, which must not be
+        # left open once the job is done
+        connections.close_all()
+
+
+def schedule_group_fanout(thread, sender, group_profiles):
+    """Add the members of the input groups to a thread in the background.
+
+    The work is handed to the worker pool once the current transaction is
+    committed, so that workers can see the thread.
+
+    """
+
+    group_profiles = list(group_profiles)
+    transaction.on_commit(
+        lambda: _get_executor().submit(
+            _run_in_worker, thread.pk, sender, group_profiles)
+    )
+
+
+def resume_group_fanouts():
+    """Run the pending and failed fan-outs again, in the current process.
+
+    A pending fan-out that is running elsewhere is not repeated, since
+    ``run_group_fanout`` locks the thread and only adds members to threads
+    whose fan-out is still pending. Return the number of fan-outs that have
+    been resumed and the number of them that have completed.
+
+    """
+
+    from geonode.groups.models import GroupProfile
+    from user_messages.models import Thread
+    thread_ids = list(Thread.objects.filter(
+        fanout_status__in=(Thread.FANOUT_PENDING, Thread.FANOUT_FAILED)
+    ).order_by("pk").values_list("pk", flat=True))
+    for thread_id in thread_ids:
+        Thread.objects.filter(
+            pk=thread_id, fanout_status=Thread.FANOUT_FAILED
+        ).update(fanout_status=Thread.FANOUT_PENDING)
+        thread = Thread.objects.get(pk=thread_id)
+        group_profiles = list(GroupProfile.objects.filter(
+            group__fanoutgroup__thread=thread))
+        run_group_fanout(
+            thread_id, thread.first_message.sender, group_profiles)
+    completed = Thread.objects.filter(
+        pk__in=thread_ids, fanout_status=Thread.FANOUT_COMPLETE).count()
+    return len(thread_ids), completed
@@ -1,20 +1,24 @@
 from django import forms
-from django.db.models import Q
 from django.core.exceptions import ValidationError
 
 from django.contrib.auth import get_user_model
 from django.utils.translation import ugettext_lazy as _
 
+from user_messages import recipients
 from user_messages.models import Message
+from user_messages.widgets import RecipientSelectMultiple
 
 from geonode.groups.models import GroupProfile
 
 
 class NewMessageForm(forms.Form):
 
+    # only the submitted users are looked up, whether to validate or to
+    # render them, see ``recipients``
     to_users = forms.ModelMultipleChoiceField(
         label=_("To users"),
         queryset=get_user_model().objects.all(),  # refined below in __init__
+        widget=RecipientSelectMultiple,
         required=False,
     )
     to_groups = forms.ModelMultipleChoiceField(
@@ -28,29 +32,12 @@ class NewMessageForm(forms.Form):
     def __init__(self, *args, **kwargs):
         self.sender = kwargs.pop("current_user")
         super(NewMessageForm, self).__init__(*args, **kwargs)
-        if not self.sender.is_superuser:
-            # show only public groups or ones that the current user is a
-            # member of
-            groups = self.sender.groups.all()
-            group_list_all = []
-            try:
-                group_list_all = self.sender.group_list_all().values('group')
-            except Exception:
-                pass
-            public_groups = GroupProfile.objects.exclude(
-                access="public-invite").exclude(access="private").values('group')
-
-            self.fields["to_groups"].queryset = GroupProfile.objects.filter(
-                Q(group__isnull=True) | Q(group__in=groups) |
-                Q(group__in=public_groups) | Q(group__in=group_list_all) |
-                Q(group__user=self.sender)
-            ).distinct().order_by('title')
-
-        self.fields["to_users"].queryset = get_user_model().objects.exclude(
-            username="AnonymousUser").exclude(
-            id=self.sender.id).exclude(
-            is_active=False
-        ).order_by('username')
+        # show only public groups or ones that the current user is a member
+        # of, this is used to validate the submitted groups as well
+        self.fields["to_groups"].queryset = recipients.messageable_groups(
+            self.sender)
+        self.fields["to_users"].queryset = recipients.messageable_users(
+            self.sender)
 
     def clean(self):
         """Validate fields that depend on each other
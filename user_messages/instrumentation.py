@@ -0,0 +1,95 @@
+"""Optional timing and query instrumentation of the messaging operations.
+
+When the ``USER_MESSAGES_INSTRUMENTATION`` setting is true, every call to an
+instrumented operation (the inbox, thread and message creation views, the
+inbox pages and the creation of messages and replies) is measured and the
+``user_messages.signals.operation_measured`` signal is sent with:
+
+* ``name``: the name of the operation, which is also the signal's sender;
+* ``duration``: its wall time, in seconds;
+* ``queries``: the number of queries it ran on the default database;
+* ``fanout``: the number of recipients whose state it has written;
+* ``exception``: the exception it raised, if any.
+
+Measurements can be nested, a view's measurement includes the ones of the
+manager methods it calls. When the setting is false, the default, the
+operations are called directly.
+
+"""
+
+import functools
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from user_messages.signals import operation_measured
+
+_local = threading.local()
+
+
+def is_enabled():
+    return getattr(settings, "USER_MESSAGES_INSTRUMENTATION", False)
+
+
+def _get_stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class Measurement(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.fanout = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+def record_fanout(count):
+    """Add ``count`` recipients to the operations being measured."""
+    for measurement in getattr(_local, "stack", ()):
+        measurement.fanout += count
+
+
+def instrumented(name):
+    """Decorate a function so that its calls are measured when enabled."""
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return func(*args, **kwargs)
+            measurement = Measurement(name)
+            stack = _get_stack()
+            stack.append(measurement)
+            exception = None
+            started = time.perf_counter()
+            try:
+                with connection.execute_wrapper(measurement):
+                    return func(*args, **kwargs)
+            except Exception as exc:
+                exception = exc
+                raise
+            finally:
+                duration = time.perf_counter() - started
+                stack.pop()
+                operation_measured.send(
+                    sender=name,
+                    name=name,
+                    duration=duration,
+                    queries=measurement.queries,
+                    fanout=measurement.fanout,
+                    exception=exception
+                )
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,129 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from user_messages.benchmarks import dataset
+from user_messages.benchmarks import suite
+from user_messages.benchmarks import thread_queries
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a synthetic messaging dataset and benchmark the messaging "
+        "entry points against it. Unless --keep-data is given, the dataset "
+        "is created in a transaction that is rolled back afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--suite",
+            choices=("entry_points", "thread_queries"),
+            default="entry_points",
+            help="entry_points times the views and manager methods, "
+                 "thread_queries compares the inbox queries against their "
+                 "former OR-join form"
+        )
+        parser.add_argument(
+            "--users", type=int, default=dataset.DEFAULT_OPTIONS["num_users"])
+        parser.add_argument(
+            "--groups", type=int,
+            default=dataset.DEFAULT_OPTIONS["num_groups"])
+        parser.add_argument(
+            "--max-group-size", type=int,
+            default=dataset.DEFAULT_OPTIONS["max_group_size"])
+        parser.add_argument(
+            "--threads", type=int,
+            default=dataset.DEFAULT_OPTIONS["num_threads"])
+        parser.add_argument(
+            "--max-messages", type=int,
+            default=dataset.DEFAULT_OPTIONS["max_messages"])
+        parser.add_argument(
+            "--subscription-ratio", type=float,
+            default=dataset.DEFAULT_OPTIONS["subscription_ratio"],
+            help="share of the group threads that use group subscriptions"
+        )
+        parser.add_argument(
+            "--seed", type=int, default=dataset.DEFAULT_OPTIONS["seed"])
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--sample-size", type=int, default=50,
+            help="number of users to run the thread_queries suite for"
+        )
+        parser.add_argument(
+            "--output", help="write the results to this JSON file")
+        parser.add_argument(
+            "--compare",
+            help="compare the results with the ones stored in this JSON file"
+        )
+        parser.add_argument(
+            "--keep-data", action="store_true",
+            help="commit the generated dataset instead of rolling it back"
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            try:
+                with open(options["compare"]) as baseline_file:
+                    baseline = json.load(baseline_file)
+            except (IOError, ValueError) as exc:
+                raise CommandError(
+                    "Could not read {}: {}".format(options["compare"], exc))
+        dataset_options = {
+            "num_users": options["users"],
+            "num_groups": options["groups"],
+            "max_group_size": options["max_group_size"],
+            "num_threads": options["threads"],
+            "max_messages": options["max_messages"],
+            "subscription_ratio": options["subscription_ratio"],
+            "seed": options["seed"],
+        }
+        with transaction.atomic():
+            if options["suite"] == "thread_queries":
+                results = self.run_thread_queries(options, dataset_options)
+            else:
+                results = suite.run(
+                    repeat=options["repeat"], **dataset_options)
+            if not options["keep_data"]:
+                transaction.set_rollback(True)
+        self.print_results(results)
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                json.dump(results, output_file, indent=2, sort_keys=True)
+        if baseline is not None:
+            self.print_comparison(suite.compare(baseline, results))
+
+    def run_thread_queries(self, options, dataset_options):
+        timings = thread_queries.run(
+            sample_size=options["sample_size"],
+            repeat=options["repeat"],
+            **dataset_options
+        )
+        return {
+            "meta": {"dataset": dataset_options},
+            "results": [
+                {"name": name, "mean_seconds": seconds}
+                for name, seconds in timings
+            ],
+        }
+
+    def print_results(self, results):
+        for result in results["results"]:
+            line = "{:<25} {:>10.3f} ms".format(
+                result["name"], result["mean_seconds"] * 1000)
+            if "queries" in result:
+                line += " {:>6} queries {:>10.1f} KiB".format(
+                    result["queries"], result["peak_memory_bytes"] / 1024.0)
+            self.stdout.write(line)
+
+    def print_comparison(self, rows):
+        self.stdout.write("")
+        for name, metric, before, after, ratio in rows:
+            self.stdout.write("{:<25} {:<18} {:>14.6g} {:>14.6g} {:>8}".format(
+                name,
+                metric,
+                before,
+                after,
+                "x{:.2f}".format(ratio) if ratio is not None else "-"
+            ))
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from user_messages import retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the threads that have been deleted by all their participants "
+        "or that have expired, according to the retention settings. Threads "
+        "are deleted in chunks, each one in its own transaction."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--deleted-days", type=int,
+            help="age of the last message of the deleted threads to purge, "
+                 "defaults to the USER_MESSAGES_RETENTION_DELETED_DAYS "
+                 "setting"
+        )
+        parser.add_argument(
+            "--expired-days", type=int,
+            help="age of the last message of any thread to purge, defaults "
+                 "to the USER_MESSAGES_RETENTION_DAYS setting"
+        )
+        parser.add_argument(
+            "--chunk-size", type=int,
+            help="number of threads deleted per transaction, defaults to "
+                 "the USER_MESSAGES_PURGE_CHUNK_SIZE setting"
+        )
+        parser.add_argument(
+            "--pause", type=float, default=0,
+            help="seconds to wait between chunks"
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="only report the number of threads to purge"
+        )
+
+    def handle(self, *args, **options):
+        for option in ("deleted_days", "expired_days"):
+            if options[option] is not None and options[option] < 0:
+                raise CommandError(
+                    "--{} must not be negative".format(
+                        option.replace("_", "-")))
+        if options["chunk_size"] is not None and options["chunk_size"] < 1:
+            raise CommandError("--chunk-size must be positive")
+        thread_qs = retention.purgeable_threads(
+            deleted_days=options["deleted_days"],
+            expired_days=options["expired_days"]
+        )
+        total = thread_qs.count()
+        if options["dry_run"]:
+            self.stdout.write("{} threads would be purged".format(total))
+            return
+
+        def progress(purged):
+            self.stdout.write("Purged {}/{} threads".format(purged, total))
+
+        purged = retention.purge_threads(
+            thread_qs,
+            chunk_size=options["chunk_size"],
+            pause=options["pause"],
+            progress=progress
+        )
+        self.stdout.write(self.style.SUCCESS(
+            "Purged {} threads".format(purged)))
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Min
+
+from user_messages import search
+from user_messages.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the full-text search index of the messages. Messages are "
+        "indexed in chunks, each one in its own transaction. With "
+        "--prune, only remove the entries of deleted messages."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000)
+        parser.add_argument("--database", default="default")
+        parser.add_argument("--prune", action="store_true")
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be positive")
+        using = options["database"]
+        backend = search.get_backend(using)
+        if backend is None:
+            raise CommandError(
+                "The {} database has no search index".format(using))
+        if options["prune"]:
+            with transaction.atomic(using=using):
+                pruned = backend.prune()
+            self.stdout.write(self.style.SUCCESS(
+                "Removed {} entries of deleted messages".format(pruned)))
+            return
+        messages = Message.objects.using(using)
+        with transaction.atomic(using=using):
+            backend.clear()
+        total = messages.count()
+        indexed = 0
+        last_pk = 0
+        while True:
+            rows = list(
+                messages.filter(pk__gt=last_pk).order_by("pk").values_list(
+                    "pk", "thread", "thread__subject", "content"
+                )[:chunk_size]
+            )
+            if not rows:
+                break
+            # the subject is only indexed with the first message of a thread
+            first_pks = set(
+                messages.filter(
+                    thread__in={thread_id for _, thread_id, _, _ in rows}
+                ).order_by().values("thread").annotate(
+                    first_pk=Min("pk")).values_list("first_pk", flat=True)
+            )
+            with transaction.atomic(using=using):
+                backend.index([
+                    (pk, subject if pk in first_pks else "", content)
+                    for pk, _, subject, content in rows
+                ])
+            indexed += len(rows)
+            last_pk = rows[-1][0]
+            self.stdout.write("Indexed {}/{} messages".format(indexed, total))
+        self.stdout.write(self.style.SUCCESS(
+            "Indexed {} messages".format(indexed)))
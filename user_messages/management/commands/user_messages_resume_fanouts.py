@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from user_messages import fanout
+
+
+class Command(BaseCommand):
+    help = (
+        "Add the group members of the threads whose deferred fan-out is "
+        "still pending or has failed, for instance because the process "
+        "running it was stopped."
+    )
+
+    def handle(self, *args, **options):
+        resumed, completed = fanout.resume_group_fanouts()
+        if completed < resumed:
+            raise CommandError(
+                "{} of {} fan-outs failed again".format(
+                    resumed - completed, resumed))
+        self.stdout.write(self.style.SUCCESS(
+            "Completed {} fan-outs".format(completed)))
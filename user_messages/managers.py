@@ -1,10 +1,128 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import BooleanField
+from django.db.models import Case
+from django.db.models import Exists
+from django.db.models import ExpressionWrapper
+from django.db.models import F
+from django.db.models import IntegerField
 from django.db.models import Manager
+from django.db.models import OuterRef
 from django.db.models import Q
+from django.db.models import QuerySet
+from django.db.models import Subquery
+from django.db.models import Value
+from django.db.models import When
+from django.db.models.functions import Coalesce
+from django.db.models.functions import Least
 
+from user_messages import counters
+from user_messages import fanout
+from user_messages import instrumentation
+from user_messages import search
+from user_messages.pagination import paginate_messages
+from user_messages.pagination import paginate_threads
 from user_messages.signals import message_sent
 
+# a participation record is unread when the thread got messages past the
+# sequence it has been read up to
+_UNREAD = Q(deleted=False, read_sequence__lt=F("thread__sequence"))
+# state records of subscribed groups that leave the thread out of the unread
+# ones
+_READ_OR_DELETED = (
+    Q(deleted=True) | Q(read_sequence__gte=F("thread__sequence")))
+_ACTIVE = Q(deleted=False)
 
-class ThreadManager(Manager):
+
+class ParticipantQuerySet(QuerySet):
+
+    def with_unread(self):
+        """Annotate the records with their ``unread`` state, which otherwise
+        reads the thread of every record with its own query."""
+        return self.annotate(unread=ExpressionWrapper(
+            Q(read_sequence__lt=F("thread__sequence")),
+            output_field=BooleanField()
+        ))
+
+
+class GroupMemberThreadQuerySet(ParticipantQuerySet):
+
+    def fanned_out(self):
+        """Leave out the state records of subscribed groups.
+
+        Members of a subscribed group are only involved in the thread while
+        they belong to the group, which is looked up through
+        ``GroupThread``: their state records do not involve them by
+        themselves.
+
+        """
+
+        return self.filter(~Exists(_subscriptions()))
+
+    def involving(self, user):
+        """Return the user's records that involve the user in their thread:
+        those of fanned out groups and the state records of the subscribed
+        groups the user is still a member of."""
+        return self.filter(
+            Q(~Exists(_subscriptions())) | Q(group__user__id=user.id),
+            user__id=user.id
+        )
+
+
+class ThreadQuerySet(QuerySet):
+
+    def with_user_state(self, user):
+        """Annotate threads with the user's state in a single query.
+
+        Each thread gets a ``user_unread`` and a ``user_deleted`` boolean
+        attribute, which take into account all the ways the user may be
+        involved in the thread. A thread where the user is not involved at
+        all is reported as deleted. ``user_unread_messages`` is the number of
+        messages the user has not read yet, 0 for read threads.
+
+        """
+
+        unread = _state_conditions(user, _UNREAD, _READ_OR_DELETED)
+        active = _state_conditions(user, _ACTIVE, Q(deleted=True))
+        annotations = {"_user_unrecorded": _unrecorded_condition(user)}
+        for prefix, conditions in (("unread", unread), ("active", active)):
+            for index, condition in enumerate(conditions):
+                annotations["_user_{}_{}".format(prefix, index)] = condition
+        return self.annotate(**annotations).annotate(
+            user_unread=_any_annotation(
+                ["_user_unread_{}".format(i) for i in range(len(unread))],
+                True
+            ),
+            user_deleted=_any_annotation(
+                ["_user_active_{}".format(i) for i in range(len(active))],
+                False
+            ),
+        ).annotate(
+            user_unread_messages=Case(
+                When(
+                    user_unread=True,
+                    then=ExpressionWrapper(
+                        F("sequence") - _read_sequence_expression(user),
+                        output_field=IntegerField()
+                    )
+                ),
+                default=Value(0),
+                output_field=IntegerField()
+            ),
+        )
+
+    def with_latest_message(self):
+        """Fetch the latest message of each thread, and its sender, as well.
+
+        ``Thread.latest_message`` and its ``sender`` can then be read
+        without any additional query.
+
+        """
+
+        return self.select_related("last_message__sender")
+
+
+class ThreadManager(Manager.from_queryset(ThreadQuerySet)):
 
     def active_threads(self, user):
         """Return all active threads where the user is involved.
@@ -14,39 +132,224 @@ class ThreadManager(Manager):
 
         """
 
-        return self.filter(
-            Q(
-                userthread__user__id=user.id,
-                userthread__deleted=False
-            ) | Q(
-                groupmemberthread__user__id=user.id,
-                groupmemberthread__deleted=False
-            )
-        ).distinct()
+        return self._involved_threads(user, _ACTIVE, Q(deleted=True))
 
     def sorted_active_threads(self, user):
-        return _sort_distinct_thread_queryset(self.active_threads(user))
+        return self._sort_by_latest_message(self.active_threads(user))
+
+    @instrumentation.instrumented("ThreadManager.active_threads_page")
+    def active_threads_page(self, user, cursor=None, page_size=None):
+        """Return a page of the user's active threads, latest first.
+
+        ``cursor`` is either ``None``, for the first page, or one of the
+        ``next_cursor``/``previous_cursor`` values of a previous page.
+        Threads are annotated with the user's state, as in
+        ``ThreadQuerySet.with_user_state``, and come with their latest
+        message, as in ``ThreadQuerySet.with_latest_message``.
+
+        """
+
+        return paginate_threads(
+            self.sorted_active_threads(user).with_user_state(
+                user).with_latest_message(),
+            cursor,
+            page_size
+        )
 
     def unread_threads(self, user):
         """Return all unread threads where the user is involved."""
-        return self.filter(
-            Q(
-                userthread__user=user,
-                userthread__deleted=False,
-                userthread__unread=True
-            ) | Q(
-                groupmemberthread__user=user,
-                groupmemberthread__deleted=False,
-                groupmemberthread__unread=True,
-            )
-        ).distinct()
+        return self._involved_threads(user, _UNREAD, _READ_OR_DELETED)
 
     def sorted_unread_threads(self, user):
-        return _sort_distinct_thread_queryset(self.unread_threads(user))
+        return self._sort_by_latest_message(self.unread_threads(user))
+
+    @instrumentation.instrumented("ThreadManager.unread_threads_page")
+    def unread_threads_page(self, user, cursor=None, page_size=None):
+        """Return a page of the user's unread threads, latest first."""
+        return paginate_threads(
+            self.sorted_unread_threads(user).with_user_state(
+                user).with_latest_message(),
+            cursor,
+            page_size
+        )
+
+    @instrumentation.instrumented("ThreadManager.mark_read")
+    def mark_read(self, user, thread_ids=None):
+        """Mark threads as read for the user.
+
+        ``thread_ids`` restricts the change to the input threads, it
+        defaults to all of the user's active threads. Threads the user is
+        not involved in, or has deleted, are left alone. Return the number
+        of state records that have been changed.
+
+        """
+
+        from user_messages.models import Thread
+        return self._set_user_state(
+            user, thread_ids,
+            Q(read_sequence__lt=F("thread__sequence")),
+            {"read_sequence": Subquery(Thread.objects.filter(
+                pk=OuterRef("thread")).values("sequence"))},
+            {"read": True}
+        )
+
+    @instrumentation.instrumented("ThreadManager.mark_unread")
+    def mark_unread(self, user, thread_ids=None):
+        """Mark the latest message of threads as unread for the user, see
+        ``mark_read``."""
+        from user_messages.models import Thread
+        # subscribed threads without a state record are already unread
+        return self._set_user_state(
+            user, thread_ids,
+            Q(read_sequence__gte=F("thread__sequence"),
+              thread__sequence__gt=0),
+            {"read_sequence": Subquery(Thread.objects.filter(
+                pk=OuterRef("thread")
+            ).annotate(
+                previous=F("sequence") - 1
+            ).values("previous"))}
+        )
+
+    @instrumentation.instrumented("ThreadManager.delete_threads")
+    def delete_threads(self, user, thread_ids=None):
+        """Delete threads for the user, see ``mark_read``.
+
+        The threads are only hidden from the user, until they get a new
+        message.
+
+        """
+
+        return self._set_user_state(
+            user, thread_ids, Q(), {"deleted": True}, {"deleted": True})
+
+    def _set_user_state(self, user, thread_ids, outdated, state,
+                        member_state=None):
+        """Apply ``state`` to the user's records for the threads.
+
+        Only the active records matching ``outdated`` are updated, with a
+        single statement per participation table. When ``member_state`` is
+        given, state records are first created with it for the subscribed
+        groups the user does not have one for yet, see
+        ``fanout.add_member_states_for_threads``.
+
+        """
+
+        from user_messages.models import GroupMemberThread, UserThread
+        threads = self.active_threads(user)
+        if thread_ids is not None:
+            threads = threads.filter(pk__in=thread_ids)
+        threads = threads.order_by().values("pk")
+        changed = 0
+        if member_state is not None:
+            # created first, the threads are then still active
+            changed += fanout.add_member_states_for_threads(
+                threads, user, **member_state)
+        for model in (UserThread, GroupMemberThread):
+            changed += model.objects.filter(
+                outdated, thread__in=threads, user__id=user.id, deleted=False
+            ).update(**state)
+        if changed:
+            counters.invalidate_unread_count([user.id])
+        return changed
+
+    def _involved_threads(self, user, state, diverged):
+        """Return the threads where the user is involved with ``state``.
+
+        Each way of being involved in a thread (directly, as a member of a
+        group or through a subscribed group) is looked up in its own
+        subquery. These subqueries do not depend on the outer query, so the
+        database resolves each one once, with an index lookup, instead of
+        joining every participation table and removing duplicates with
+        ``DISTINCT``.
+
+        ``state`` is the condition that the user's participation records
+        must match, and ``diverged`` the one that a user's state record for
+        a subscribed group must match for the thread to be left out.
+
+        """
+
+        from user_messages.models import GroupMemberThread, UserThread
+        return self.filter(
+            Q(pk__in=UserThread.objects.filter(
+                state, user__id=user.id).values("thread")) |
+            Q(pk__in=GroupMemberThread.objects.fanned_out().filter(
+                state, user__id=user.id).values("thread")) |
+            Q(pk__in=self._subscribed_threads(user, diverged))
+        )
+
+    def _subscribed_threads(self, user, diverged):
+        """Return the threads the user is subscribed to via its groups.
+
+        Threads for which the user has a state record matching ``diverged``
+        are left out.
+
+        """
+
+        from user_messages.models import GroupMemberThread, GroupThread
+        diverged_states = GroupMemberThread.objects.filter(
+            diverged,
+            thread=OuterRef("thread"),
+            group=OuterRef("group"),
+            user__id=user.id
+        )
+        return GroupThread.objects.filter(
+            group__user__id=user.id
+        ).annotate(
+            diverged=Exists(diverged_states)
+        ).filter(diverged=False).values("thread")
+
+    def _sort_by_latest_message(self, thread_qs, sort_descending=True):
+        """Sort a Thread queryset according to its latest message's date.
+
+        The latest message's date is stored on the thread itself, so the
+        queryset stays lazy and is sorted by the database.
+
+        """
+
+        latest = F("last_message_at")
+        if sort_descending:
+            ordering = (latest.desc(nulls_last=True), "-pk")
+        else:
+            ordering = (latest.asc(nulls_last=True), "pk")
+        return thread_qs.order_by(*ordering)
 
 
 class MessageManager(Manager):
 
+    @instrumentation.instrumented("MessageManager.messages_page")
+    def messages_page(self, thread, cursor=None, page_size=None):
+        """Return a page of the thread's messages, with their senders.
+
+        The first page holds the latest messages, its ``next_cursor`` leads
+        to the older ones. See ``pagination.paginate_messages``.
+
+        """
+
+        return paginate_messages(
+            self.filter(thread=thread).select_related("sender"),
+            cursor,
+            page_size
+        )
+
+    @instrumentation.instrumented("MessageManager.search")
+    def search(self, user, query, page=1, page_size=None):
+        """Return a page of the messages of the user's active threads that
+        match ``query``, best matches first.
+
+        See the ``search`` module for the way messages are indexed.
+
+        """
+
+        from user_messages.models import Thread
+        return search.search_messages(
+            self.select_related("sender", "thread"),
+            Thread.objects.active_threads(user),
+            query,
+            page,
+            page_size
+        )
+
+    @instrumentation.instrumented("MessageManager.new_reply")
     def new_reply(self, thread, user, content):
         """Generate a new message for the input thread.
 
@@ -56,67 +359,226 @@ class MessageManager(Manager):
 
         """
 
-        msg = self.create(thread=thread, sender=user, content=content)
-        thread.userthread_set.exclude(user=user).update(
-            deleted=False, unread=True)
-        thread.groupmemberthread_set.exclude(user=user).update(
-            deleted=False, unread=True)
-        thread.userthread_set.filter(user=user).update(unread=False)
-        thread.groupmemberthread_set.filter(user=user).update(unread=False)
+        with transaction.atomic():
+            subscribed_group_ids = set(
+                thread.groupthread_set.values_list("group", flat=True))
+            group_ids = subscribed_group_ids | set(
+                thread.fanoutgroup_set.values_list("group", flat=True))
+            user_ids = set(
+                thread.userthread_set.values_list("user", flat=True))
+            msg = self.create(thread=thread, sender=user, content=content)
+            _record_message(thread, msg)
+            search.index_messages([(msg.pk, "", content)], using=self.db)
+            # the new sequence is enough to make the thread unread for the
+            # other participants, their records are only written to restore
+            # deleted threads
+            written = _update_reply_states(
+                thread.userthread_set, user, thread.sequence)
+            written += _update_reply_states(
+                thread.groupmemberthread_set, user, thread.sequence)
+            if subscribed_group_ids:
+                # members of subscribed groups without a state record still
+                # have the thread unread
+                fanout.add_member_states(
+                    thread, user, read_sequence=thread.sequence)
+            instrumentation.record_fanout(written)
+            # the counters of group members are dropped through their
+            # groups, whatever their number
+            counters.invalidate_unread_count(user_ids | {user.id})
+            counters.invalidate_group_unread_count(group_ids)
         message_sent.send(
             sender=self.model, message=msg, thread=thread, reply=True)
         return msg
 
+    @instrumentation.instrumented("MessageManager.new_message")
     def new_message(self, from_user, subject, content, to_users=None,
-                    to_groups=None):
+                    to_groups=None, subscribe_groups=None):
         """Create a new conversation thread and its first message.
 
         The new thread will involve both the ``from_user`` and all users from
         the ``to_users`` and ``to_groups`` parameters. All users belonging to
         a group in the ``to_groups`` parameter are added to the thread.
 
+        If ``subscribe_groups`` is true the groups themselves are subscribed
+        to the thread, instead of each of their members, and the thread
+        involves whoever is a member of these groups at any given time. It
+        defaults to the ``USER_MESSAGES_GROUP_SUBSCRIPTIONS`` setting.
+
+        Otherwise, when the groups have more members than the
+        ``USER_MESSAGES_DEFERRED_FANOUT_THRESHOLD`` setting, group members
+        are added to the thread in the background, after this method
+        returns. The thread's ``fanout_status`` stays pending until then.
+
         """
 
         to_users = list(to_users) if to_users is not None else []
         to_groups = list(to_groups) if to_groups is not None else []
+        if subscribe_groups is None:
+            subscribe_groups = getattr(
+                settings, "USER_MESSAGES_GROUP_SUBSCRIPTIONS", False)
         from user_messages.models import Thread
-        thread = Thread.objects.create(subject=subject)
-        thread.userthread_set.create(user=from_user, unread=False)
-        for user in to_users:
-            if user.id != from_user.id:
-                thread.userthread_set.create(user=user)
-        for group_profile in to_groups:
-            active_members = group_profile.groupmember_set.filter(
-                user__is_active=True)
-            for group_member in active_members:
-                thread.groupmemberthread_set.create(
-                    user=group_member.user,
-                    group=group_profile.group,
-                    unread=False if group_member.user == from_user else True
-                )
-        msg = self.create(thread=thread, sender=from_user, content=content)
+        defer_fanout = not subscribe_groups and fanout.should_defer(to_groups)
+        with transaction.atomic():
+            thread = Thread.objects.create(
+                subject=subject,
+                fanout_status=(
+                    Thread.FANOUT_PENDING if defer_fanout
+                    else Thread.FANOUT_COMPLETE)
+            )
+            msg = self.create(
+                thread=thread, sender=from_user, content=content)
+            _record_message(thread, msg)
+            search.index_messages(
+                [(msg.pk, subject, content)], using=self.db)
+            recipient_ids = fanout.add_users(thread, from_user, to_users)
+            if subscribe_groups:
+                fanout.subscribe_groups(thread, from_user, to_groups)
+            else:
+                fanout.record_groups(thread, to_groups)
+                if defer_fanout:
+                    fanout.schedule_group_fanout(
+                        thread, from_user, to_groups)
+                else:
+                    recipient_ids |= fanout.add_group_members(
+                        thread, from_user, to_groups)
+            counters.increment_unread_count(recipient_ids)
+            counters.touch_inbox([from_user.id])
         message_sent.send(
             sender=self.model, message=msg, thread=thread, reply=False)
         return msg
 
 
-def _sort_distinct_thread_queryset(thread_qs, sort_descending=True):
-    """Sort a Thread queryset according to its latest message's date.
+def _state_conditions(user, state, diverged):
+    """Return the conditions for the outer thread to involve the user.
+
+    These are the correlated counterparts of the subqueries built by
+    ``ThreadManager._involved_threads``.
+
+    """
+
+    from user_messages.models import GroupMemberThread, GroupThread
+    from user_messages.models import UserThread
+    diverged_states = GroupMemberThread.objects.filter(
+        diverged,
+        thread=OuterRef("thread"),
+        group=OuterRef("group"),
+        user__id=user.id
+    )
+    return [
+        Exists(UserThread.objects.filter(
+            state, thread=OuterRef("pk"), user__id=user.id)),
+        Exists(GroupMemberThread.objects.fanned_out().filter(
+            state, thread=OuterRef("pk"), user__id=user.id)),
+        Exists(GroupThread.objects.filter(
+            thread=OuterRef("pk"), group__user__id=user.id
+        ).annotate(
+            diverged=Exists(diverged_states)
+        ).filter(diverged=False)),
+    ]
+
 
-    This function is a workaround for the fact that django inserts duplicate
-    records when trying to use ``.order_by`` and ``.distinct`` in the
-    same queryset. More details at:
+def _unrecorded_condition(user):
+    """Return whether the user is subscribed to the outer thread through a
+    group it has no state record for, where nothing has been read yet."""
+    from user_messages.models import GroupMemberThread, GroupThread
+    states = GroupMemberThread.objects.filter(
+        thread=OuterRef("thread"),
+        group=OuterRef("group"),
+        user__id=user.id
+    )
+    return Exists(GroupThread.objects.filter(
+        thread=OuterRef("pk"), group__user__id=user.id
+    ).filter(~Exists(states)))
 
-    https://docs.djangoproject.com/en/1.8/ref/models/querysets/#django.db.models.query.QuerySet.distinct
+
+def _read_sequence_expression(user):
+    """Return the sequence the user has read the outer thread up to.
+
+    A user involved in several ways has read the thread up to the lowest
+    sequence of its active records. Requires the ``_user_unrecorded``
+    annotation.
 
     """
 
-    materialized_qs = list(thread_qs)
-    try:
-        materialized_qs.sort(
-            key=lambda thread: thread.latest_message.sent_at,
-            reverse=sort_descending
+    from user_messages.models import GroupMemberThread, UserThread
+    lowest = [
+        Coalesce(
+            Subquery(records.filter(
+                thread=OuterRef("pk"), deleted=False
+            ).order_by("read_sequence").values("read_sequence")[:1]),
+            F("sequence")
         )
-    except Exception:
-        pass
-    return materialized_qs
+        for records in (UserThread.objects.filter(user__id=user.id),
+                        GroupMemberThread.objects.involving(user))
+    ]
+    return Least(
+        *lowest,
+        Case(
+            When(_user_unrecorded=True, then=Value(0)),
+            default=F("sequence"),
+            output_field=IntegerField()
+        ),
+        output_field=IntegerField()
+    )
+
+
+def _subscriptions():
+    """Return the subscription of the outer record's group to its thread."""
+    from user_messages.models import GroupThread
+    return GroupThread.objects.filter(
+        thread=OuterRef("thread"), group=OuterRef("group"))
+
+
+def _any_annotation(names, value):
+    """Return ``value`` if any of the input boolean annotations is true."""
+    condition = Q()
+    for name in names:
+        condition |= Q(**{name: True})
+    return Case(
+        When(condition, then=Value(value)),
+        default=Value(not value),
+        output_field=BooleanField()
+    )
+
+
+def _update_reply_states(participants, user, sequence):
+    """Update the thread's state records for a reply sent by ``user``.
+
+    The thread is restored for the other participants who had deleted it,
+    and read up to ``sequence`` for the sender. Only the records whose state
+    changes are written, with a single statement.
+
+    """
+
+    return participants.filter(
+        Q(~Q(user_id=user.id), deleted=True) |
+        Q(user_id=user.id, read_sequence__lt=sequence)
+    ).update(
+        deleted=Case(
+            When(user_id=user.id, then=F("deleted")),
+            default=Value(False)
+        ),
+        read_sequence=Case(
+            When(user_id=user.id, then=Value(sequence)),
+            default=F("read_sequence"),
+            output_field=IntegerField()
+        ),
+    )
+
+
+def _record_message(thread, message):
+    """Update the thread's denormalized latest message fields."""
+    from user_messages.models import Thread
+    Thread.objects.filter(pk=thread.pk).update(
+        last_message=message,
+        last_message_at=message.sent_at,
+        message_count=F("message_count") + 1,
+        sequence=F("sequence") + 1
+    )
+    # read back rather than incremented, the instance may be stale; the
+    # row stays locked by the update until the transaction ends
+    thread.message_count, thread.sequence = Thread.objects.filter(
+        pk=thread.pk).values_list("message_count", "sequence").get()
+    thread.last_message = message
+    thread.last_message_at = message.sent_at
+    thread._latest_message = message
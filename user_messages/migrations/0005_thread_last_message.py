@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def backfill_last_message(apps, schema_editor):
+    Thread = apps.get_model("user_messages", "Thread")
+    Message = apps.get_model("user_messages", "Message")
+    db_alias = schema_editor.connection.alias
+    latest = Message.objects.using(db_alias).filter(
+        thread=OuterRef("pk")).order_by("-sent_at", "-pk")
+    count = Message.objects.using(db_alias).filter(
+        thread=OuterRef("pk")).order_by().values("thread").annotate(
+        count=Count("pk")).values("count")
+    last_pk = 0
+    while True:
+        chunk = list(
+            Thread.objects.using(db_alias).filter(
+                pk__gt=last_pk).order_by("pk").values_list(
+                "pk", flat=True)[:BACKFILL_CHUNK_SIZE]
+        )
+        if not chunk:
+            break
+        Thread.objects.using(db_alias).filter(pk__in=chunk).update(
+            last_message=Subquery(latest.values("pk")[:1]),
+            last_message_at=Subquery(latest.values("sent_at")[:1]),
+            message_count=Coalesce(Subquery(count), 0),
+        )
+        last_pk = chunk[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_messages', '0004_auto_20171108_1101'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='last_message',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='user_messages.Message', verbose_name='Last message'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Last message sent at'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Number of messages'),
+        ),
+        migrations.RunPython(
+            backfill_last_message, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_messages', '0005_thread_last_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='fanout_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('complete', 'Complete'), ('failed', 'Failed')], default='complete', editable=False, max_length=20, verbose_name='Recipients status'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0006_require_contenttypes_0002'),
+        ('user_messages', '0006_thread_fanout_status'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupThread',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='auth.Group')),
+                ('thread', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='user_messages.Thread')),
+            ],
+            options={
+                'unique_together': {('thread', 'group')},
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_messages', '0007_groupthread'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='groupmemberthread',
+            index=models.Index(fields=['user', 'deleted', 'unread', 'thread'], name='um_gmthread_user_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupmemberthread',
+            index=models.Index(condition=models.Q(deleted=False), fields=['user', 'unread', 'thread'], name='um_gmthread_user_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupmemberthread',
+            index=models.Index(fields=['thread', 'group', 'user'], name='um_gmthread_thread_member_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupthread',
+            index=models.Index(fields=['group', 'thread'], name='um_groupthread_group_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['thread', 'sent_at'], name='um_message_thread_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='thread',
+            index=models.Index(fields=['last_message_at', 'id'], name='um_thread_last_message_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userthread',
+            index=models.Index(fields=['user', 'deleted', 'unread', 'thread'], name='um_userthread_user_state_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userthread',
+            index=models.Index(condition=models.Q(deleted=False), fields=['user', 'unread', 'thread'], name='um_userthread_user_active_idx'),
+        ),
+    ]
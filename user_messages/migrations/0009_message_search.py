@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == "sqlite":
+        test_connection = sqlite3.connect(":memory:")
+        try:
+            test_connection.execute(
+                "CREATE VIRTUAL TABLE fts5_test USING fts5(content)")
+        except sqlite3.OperationalError:
+            # searching falls back to unindexed lookups
+            return
+        finally:
+            test_connection.close()
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE user_messages_message_fts "
+            "USING fts5(subject, content)"
+        )
+    elif connection.vendor == "postgresql":
+        schema_editor.execute(
+            "CREATE TABLE user_messages_message_search ("
+            "message_id integer NOT NULL PRIMARY KEY "
+            "REFERENCES user_messages_message (id) "
+            "ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+            "document tsvector NOT NULL)"
+        )
+        schema_editor.execute(
+            "CREATE INDEX user_messages_message_search_idx "
+            "ON user_messages_message_search USING GIN (document)"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == "sqlite":
+        schema_editor.execute(
+            "DROP TABLE IF EXISTS user_messages_message_fts")
+    elif connection.vendor == "postgresql":
+        schema_editor.execute(
+            "DROP TABLE IF EXISTS user_messages_message_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_messages', '0008_inbox_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
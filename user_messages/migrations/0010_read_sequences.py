@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def _thread_chunks(Thread, db_alias):
+    last_pk = 0
+    while True:
+        chunk = list(
+            Thread.objects.using(db_alias).filter(
+                pk__gt=last_pk).order_by("pk").values_list(
+                "pk", flat=True)[:BACKFILL_CHUNK_SIZE]
+        )
+        if not chunk:
+            break
+        yield chunk
+        last_pk = chunk[-1]
+
+
+def backfill_read_sequences(apps, schema_editor):
+    Thread = apps.get_model("user_messages", "Thread")
+    db_alias = schema_editor.connection.alias
+    threads = Thread.objects.using(db_alias).filter(pk=OuterRef("thread"))
+    sequence = Subquery(threads.values("sequence"))
+    # the number of unread messages is unknown, the latest one at least
+    previous = Subquery(
+        threads.annotate(previous=F("sequence") - 1).values("previous"))
+    participant_models = (
+        apps.get_model("user_messages", "UserThread"),
+        apps.get_model("user_messages", "GroupMemberThread"),
+    )
+    for chunk in _thread_chunks(Thread, db_alias):
+        Thread.objects.using(db_alias).filter(pk__in=chunk).update(
+            sequence=F("message_count"))
+        for model in participant_models:
+            participants = model.objects.using(db_alias).filter(
+                thread__in=chunk)
+            participants.filter(unread=False).update(read_sequence=sequence)
+            participants.filter(
+                unread=True, thread__sequence__gt=0
+            ).update(read_sequence=previous)
+
+
+def backfill_unread(apps, schema_editor):
+    Thread = apps.get_model("user_messages", "Thread")
+    db_alias = schema_editor.connection.alias
+    participant_models = (
+        apps.get_model("user_messages", "UserThread"),
+        apps.get_model("user_messages", "GroupMemberThread"),
+    )
+    for chunk in _thread_chunks(Thread, db_alias):
+        for model in participant_models:
+            model.objects.using(db_alias).filter(
+                thread__in=chunk,
+                read_sequence__gte=F("thread__sequence")
+            ).update(unread=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_messages', '0009_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='sequence',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Message sequence'),
+        ),
+        migrations.AddField(
+            model_name='userthread',
+            name='read_sequence',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='groupmemberthread',
+            name='read_sequence',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_read_sequences, backfill_unread),
+        migrations.RemoveIndex(
+            model_name='groupmemberthread',
+            name='um_gmthread_user_state_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='groupmemberthread',
+            name='um_gmthread_user_active_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='userthread',
+            name='um_userthread_user_state_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='userthread',
+            name='um_userthread_user_active_idx',
+        ),
+        migrations.RemoveField(
+            model_name='groupmemberthread',
+            name='unread',
+        ),
+        migrations.RemoveField(
+            model_name='userthread',
+            name='unread',
+        ),
+        migrations.AddIndex(
+            model_name='groupmemberthread',
+            index=models.Index(fields=['user', 'deleted', 'thread', 'read_sequence'], name='um_gmthread_user_read_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupmemberthread',
+            index=models.Index(condition=models.Q(deleted=False), fields=['user', 'thread', 'read_sequence'], name='um_gmthread_user_visible_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userthread',
+            index=models.Index(fields=['user', 'deleted', 'thread', 'read_sequence'], name='um_userthread_user_read_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userthread',
+            index=models.Index(condition=models.Q(deleted=False), fields=['user', 'thread', 'read_sequence'], name='um_userthread_user_visible_idx'),
+        ),
+    ]
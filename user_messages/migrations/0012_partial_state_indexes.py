@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+# created instead of the partial indexes, on backends that do not support them
+FALLBACK_INDEXES = (
+    ("UserThread", models.Index(
+        fields=["user", "deleted", "thread", "read_sequence"],
+        name="um_userthread_user_seq_idx")),
+    ("GroupMemberThread", models.Index(
+        fields=["user", "deleted", "thread", "read_sequence"],
+        name="um_gmthread_user_seq_idx")),
+)
+
+
+def add_fallback_indexes(apps, schema_editor):
+    if schema_editor.connection.features.supports_partial_indexes:
+        return
+    for model_name, index in FALLBACK_INDEXES:
+        schema_editor.add_index(
+            apps.get_model("user_messages", model_name), index)
+
+
+def remove_fallback_indexes(apps, schema_editor):
+    if schema_editor.connection.features.supports_partial_indexes:
+        return
+    for model_name, index in FALLBACK_INDEXES:
+        schema_editor.remove_index(
+            apps.get_model("user_messages", model_name), index)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_messages', '0011_fanoutgroup'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='groupmemberthread',
+            name='um_gmthread_user_read_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='userthread',
+            name='um_userthread_user_read_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='groupmemberthread',
+            name='um_gmthread_user_visible_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='userthread',
+            name='um_userthread_user_visible_idx',
+        ),
+        migrations.AddIndex(
+            model_name='groupmemberthread',
+            index=models.Index(condition=models.Q(deleted=False), fields=['user', 'thread', 'read_sequence', 'deleted'], name='um_gmthread_user_visible_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userthread',
+            index=models.Index(condition=models.Q(deleted=False), fields=['user', 'thread', 'read_sequence', 'deleted'], name='um_userthread_user_visible_idx'),
+        ),
+        migrations.RunPython(add_fallback_indexes, remove_fallback_indexes),
+    ]
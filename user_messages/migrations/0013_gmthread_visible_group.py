@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_messages', '0012_partial_state_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='groupmemberthread',
+            name='um_gmthread_user_visible_idx',
+        ),
+        migrations.AddIndex(
+            model_name='groupmemberthread',
+            index=models.Index(condition=models.Q(deleted=False), fields=['user', 'thread', 'read_sequence', 'group', 'deleted'], name='um_gmthread_user_visible_idx'),
+        ),
+    ]
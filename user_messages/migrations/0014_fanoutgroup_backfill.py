@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+
+from django.db import migrations
+from django.db.models import Exists, OuterRef
+
+BACKFILL_CHUNK_SIZE = 1000
+
+
+def backfill_fanout_groups(apps, schema_editor):
+    Thread = apps.get_model("user_messages", "Thread")
+    FanoutGroup = apps.get_model("user_messages", "FanoutGroup")
+    GroupMemberThread = apps.get_model("user_messages", "GroupMemberThread")
+    GroupThread = apps.get_model("user_messages", "GroupThread")
+    db_alias = schema_editor.connection.alias
+    subscriptions = GroupThread.objects.using(db_alias).filter(
+        thread=OuterRef("thread"), group=OuterRef("group"))
+    recorded = FanoutGroup.objects.using(db_alias).filter(
+        thread=OuterRef("thread"), group=OuterRef("group"))
+    last_pk = 0
+    while True:
+        chunk = list(
+            Thread.objects.using(db_alias).filter(
+                pk__gt=last_pk).order_by("pk").values_list(
+                "pk", flat=True)[:BACKFILL_CHUNK_SIZE]
+        )
+        if not chunk:
+            break
+        groups = GroupMemberThread.objects.using(db_alias).filter(
+            thread__in=chunk
+        ).filter(
+            ~Exists(subscriptions), ~Exists(recorded)
+        ).order_by().values_list("thread", "group").distinct()
+        FanoutGroup.objects.using(db_alias).bulk_create([
+            FanoutGroup(thread_id=thread_id, group_id=group_id)
+            for thread_id, group_id in groups
+        ])
+        last_pk = chunk[-1]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user_messages', '0013_gmthread_visible_group'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            backfill_fanout_groups, migrations.RunPython.noop),
+    ]
@@ -8,11 +8,21 @@ from django.contrib.auth.models import Group
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+from user_messages.managers import GroupMemberThreadQuerySet
+from user_messages.managers import ParticipantQuerySet
 from user_messages.managers import ThreadManager, MessageManager
 from user_messages.utils import cached_attribute
 
 
 class Thread(models.Model):
+    FANOUT_PENDING = "pending"
+    FANOUT_COMPLETE = "complete"
+    FANOUT_FAILED = "failed"
+    FANOUT_STATUS_CHOICES = (
+        (FANOUT_PENDING, _("Pending")),
+        (FANOUT_COMPLETE, _("Complete")),
+        (FANOUT_FAILED, _("Failed")),
+    )
 
     subject = models.CharField(
         _('Subject'), max_length=150
@@ -31,9 +41,49 @@ class Thread(models.Model):
         blank=True,
         related_name="group_threads"
     )
+    # denormalized from the thread's messages, kept up to date by
+    # ``MessageManager`` so that listing threads does not need to look at
+    # the messages table
+    last_message = models.ForeignKey(
+        "Message",
+        verbose_name=_('Last message'),
+        null=True,
+        blank=True,
+        editable=False,
+        related_name="+",
+        on_delete=models.SET_NULL
+    )
+    last_message_at = models.DateTimeField(
+        _('Last message sent at'), null=True, blank=True, editable=False
+    )
+    message_count = models.PositiveIntegerField(
+        _('Number of messages'), default=0, editable=False
+    )
+    # incremented with every new message, participants store the sequence
+    # they have read up to, see ``UserThread.read_sequence``
+    sequence = models.PositiveIntegerField(
+        _('Message sequence'), default=0, editable=False
+    )
+    # whether all recipients have already been added to the thread, see
+    # ``user_messages.fanout``
+    fanout_status = models.CharField(
+        _('Recipients status'),
+        max_length=20,
+        choices=FANOUT_STATUS_CHOICES,
+        default=FANOUT_COMPLETE,
+        editable=False
+    )
 
     objects = ThreadManager()
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["last_message_at", "id"],
+                name="um_thread_last_message_idx"
+            ),
+        ]
+
     def get_absolute_url(self):
         return reverse("messages_thread_detail", kwargs={"thread_id": self.pk})
 
@@ -45,22 +95,29 @@ class Thread(models.Model):
     @property
     @cached_attribute
     def latest_message(self):
+        if self.last_message_id is not None:
+            return self.last_message
         return self.messages.order_by("-sent_at").first()
 
     @property
     def num_messages(self):
-        return self.messages.count()
+        return self.message_count
 
     @property
     def registered_users(self):
         return get_user_model().objects.filter(
             Q(userthread__thread=self) |
-            Q(groupmemberthread__thread=self)
+            Q(pk__in=GroupMemberThread.objects.fanned_out().filter(
+                thread=self).values("user")) |
+            Q(groups__groupthread__thread=self)
         ).distinct()
 
     @property
     def registered_groups(self):
-        return Group.objects.filter(groupmemberthread__thread=self).distinct()
+        return Group.objects.filter(
+            Q(groupmemberthread__thread=self) |
+            Q(groupthread__thread=self)
+        ).distinct()
 
     @property
     def num_users(self):
@@ -71,7 +128,29 @@ class Thread(models.Model):
         return self.subject
 
 
-class GroupMemberThread(models.Model):
+class ReadStateMixin(object):
+    """The ``unread`` state of a participation record.
+
+    It is computed from the thread's ``sequence``, unless the record was
+    loaded with ``with_unread()``, which is the way to go when listing
+    records.
+
+    """
+
+    @property
+    def unread(self):
+        try:
+            return self.__dict__["_unread"]
+        except KeyError:
+            return self.read_sequence < self.thread.sequence
+
+    @unread.setter
+    def unread(self, value):
+        # set by the ``with_unread()`` annotation
+        self.__dict__["_unread"] = value
+
+
+class GroupMemberThread(ReadStateMixin, models.Model):
     thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
     # we could replace ``group`` and ``user`` below with
     # ``member=models.ForeignKey(geonode.groups.models.GroupMember)``
@@ -80,25 +159,103 @@ class GroupMemberThread(models.Model):
     group = models.ForeignKey(Group, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.CASCADE)
-    unread = models.BooleanField(
-        default=True
+    read_sequence = models.PositiveIntegerField(
+        default=0
     )
     deleted = models.BooleanField(
         default=False
     )
 
+    objects = GroupMemberThreadQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # ``deleted`` is always false in this index, it is only there so
+            # that SQLite reads the records from the index alone. ``group``
+            # tells the records of subscribed groups apart. Backends without
+            # partial indexes get a full index on
+            # ``(user, deleted, thread, read_sequence)`` instead, see the
+            # ``0012_partial_state_indexes`` migration
+            models.Index(
+                fields=["user", "thread", "read_sequence", "group",
+                        "deleted"],
+                condition=Q(deleted=False),
+                name="um_gmthread_user_visible_idx"
+            ),
+            models.Index(
+                fields=["thread", "group", "user"],
+                name="um_gmthread_thread_member_idx"
+            ),
+        ]
+
+
+class GroupThread(models.Model):
+    """A group subscribed to a thread as a whole.
 
-class UserThread(models.Model):
+    All current members of the group are involved in the thread. Unlike
+    threads whose group members are stored individually, a member only gets a
+    ``GroupMemberThread`` record once its state differs from the default one,
+    where no message has been read and the thread is not deleted.
+
+    """
+
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
+    group = models.ForeignKey(Group, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = (("thread", "group"),)
+        indexes = [
+            models.Index(
+                fields=["group", "thread"],
+                name="um_groupthread_group_idx"
+            ),
+        ]
+
+
+class FanoutGroup(models.Model):
+    """A group whose members have been, or are being, added to a thread.
+
+    Replies drop the unread counters of the members of these groups at
+    once, and pending or failed fan-outs are resumed from them, see
+    ``fanout.resume_group_fanouts``.
+
+    """
+
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
+    group = models.ForeignKey(Group, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = (("thread", "group"),)
+
+
+class UserThread(ReadStateMixin, models.Model):
     thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
 
-    unread = models.BooleanField(
-        default=True
+    # the thread is unread as long as this is lower than its ``sequence``
+    read_sequence = models.PositiveIntegerField(
+        default=0
     )
     deleted = models.BooleanField(
         default=False
     )
 
+    objects = ParticipantQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # ``deleted`` is always false in this index, it is only there so
+            # that SQLite reads the records from the index alone. Backends
+            # without partial indexes get a full index on
+            # ``(user, deleted, thread, read_sequence)`` instead, see the
+            # ``0012_partial_state_indexes`` migration
+            models.Index(
+                fields=["user", "thread", "read_sequence", "deleted"],
+                condition=Q(deleted=False),
+                name="um_userthread_user_visible_idx"
+            ),
+        ]
+
 
 class Message(models.Model):
     thread = models.ForeignKey(
@@ -114,6 +271,12 @@ class Message(models.Model):
 
     class Meta:
         ordering = ("sent_at",)
+        indexes = [
+            models.Index(
+                fields=["thread", "sent_at"],
+                name="um_message_thread_sent_idx"
+            ),
+        ]
 
     def get_absolute_url(self):
         return self.thread.get_absolute_url()
@@ -0,0 +1,222 @@
+"""Keyset (cursor) pagination for thread listings, thread messages and users.
+
+Thread lists are ordered by the date of their latest message and then by
+their id, messages by the date they were sent and then by their id. Instead
+of using ``OFFSET``, which makes the database walk over all the previous
+rows, pages are selected by comparing against the ordering key of the last
+(or first) row of the current page. Every page therefore costs the same as
+the first one.
+
+"""
+
+import base64
+import binascii
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+NEXT = "n"
+PREVIOUS = "p"
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def get_page_size(page_size=None, setting="USER_MESSAGES_INBOX_PAGE_SIZE"):
+    if page_size is None:
+        page_size = getattr(settings, setting, 20)
+    return max(int(page_size), 1)
+
+
+def encode_cursor(direction, sent_at, pk):
+    raw = "{}|{}|{}".format(direction, sent_at.isoformat(), pk)
+    return base64.urlsafe_b64encode(
+        raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Return the ``(direction, sent_at, pk)`` tuple stored in ``cursor``."""
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(
+            (cursor + padding).encode("ascii")).decode("utf-8")
+        direction, sent_at, pk = raw.split("|")
+        sent_at = parse_datetime(sent_at)
+        pk = int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+    if direction not in (NEXT, PREVIOUS) or sent_at is None:
+        raise InvalidCursor(cursor)
+    return direction, sent_at, pk
+
+
+class CursorPage(object):
+    """A page of rows, along with the cursors of its neighbour pages."""
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __repr__(self):
+        return "<{} of {} rows>".format(
+            type(self).__name__, len(self.object_list))
+
+
+class ThreadPage(CursorPage):
+    """A page of threads, latest first."""
+
+    def __repr__(self):
+        return "<ThreadPage of {} threads>".format(len(self.object_list))
+
+
+def _paginate_keyset(queryset, cursor, page_size, key, page_class):
+    """Return a ``page_class`` page with the rows that follow ``cursor``.
+
+    ``queryset`` must be ordered by ``key`` and ``pk``, both descending.
+
+    """
+
+    queryset = queryset.filter(**{"{}__isnull".format(key): False})
+    if cursor is None:
+        direction = NEXT
+        rows = list(queryset[:page_size + 1])
+    else:
+        direction, sent_at, pk = decode_cursor(cursor)
+        if direction == NEXT:
+            rows = list(queryset.filter(
+                Q(**{"{}__lt".format(key): sent_at}) |
+                Q(**{key: sent_at, "pk__lt": pk})
+            )[:page_size + 1])
+        else:
+            rows = list(queryset.filter(
+                Q(**{"{}__gt".format(key): sent_at}) |
+                Q(**{key: sent_at, "pk__gt": pk})
+            ).reverse()[:page_size + 1])
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    if direction == PREVIOUS:
+        rows.reverse()
+    has_next = has_more if direction == NEXT else True
+    has_previous = cursor is not None if direction == NEXT else has_more
+    next_cursor = previous_cursor = None
+    if rows and has_next:
+        next_cursor = encode_cursor(
+            NEXT, getattr(rows[-1], key), rows[-1].pk)
+    if rows and has_previous:
+        previous_cursor = encode_cursor(
+            PREVIOUS, getattr(rows[0], key), rows[0].pk)
+    return page_class(rows, next_cursor, previous_cursor)
+
+
+def paginate_threads(thread_qs, cursor=None, page_size=None):
+    """Return a ``ThreadPage`` with the threads that follow ``cursor``.
+
+    ``thread_qs`` must be ordered by ``last_message_at`` and ``pk``, both
+    descending, as returned by ``ThreadManager.sorted_active_threads``.
+
+    """
+
+    return _paginate_keyset(
+        thread_qs, cursor, get_page_size(page_size), "last_message_at",
+        ThreadPage)
+
+
+class MessagePage(CursorPage):
+    """A page of messages, in chronological order.
+
+    ``next_cursor`` points to the page of older messages and
+    ``previous_cursor`` to the page of newer ones.
+
+    """
+
+    def __repr__(self):
+        return "<MessagePage of {} messages>".format(len(self.object_list))
+
+
+def paginate_messages(message_qs, cursor=None, page_size=None):
+    """Return a ``MessagePage`` with the messages that precede ``cursor``.
+
+    Without a cursor the page holds the latest messages. The page size
+    defaults to the ``USER_MESSAGES_THREAD_PAGE_SIZE`` setting.
+
+    """
+
+    page = _paginate_keyset(
+        message_qs.order_by("-sent_at", "-pk"),
+        cursor,
+        get_page_size(page_size, "USER_MESSAGES_THREAD_PAGE_SIZE"),
+        "sent_at",
+        MessagePage
+    )
+    # selected latest first
+    page.object_list.reverse()
+    return page
+
+
+class UserPage(CursorPage):
+    """A page of users, ordered by username.
+
+    Only ``next_cursor`` is set, users are meant to be browsed forward.
+
+    """
+
+    def __repr__(self):
+        return "<UserPage of {} users>".format(len(self.object_list))
+
+
+def encode_username_cursor(username):
+    return base64.urlsafe_b64encode(
+        username.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_username_cursor(cursor):
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        return base64.b64decode(
+            (cursor + padding).encode("ascii"), altchars=b"-_",
+            validate=True
+        ).decode("utf-8")
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def paginate_users(user_qs, cursor=None, page_size=None):
+    """Return a ``UserPage`` with the users that follow ``cursor``.
+
+    Users are ordered by their username, which is unique. The page size
+    defaults to the ``USER_MESSAGES_RECIPIENT_PAGE_SIZE`` setting.
+
+    """
+
+    page_size = get_page_size(page_size, "USER_MESSAGES_RECIPIENT_PAGE_SIZE")
+    key = user_qs.model.USERNAME_FIELD
+    user_qs = user_qs.order_by(key)
+    if cursor is not None:
+        user_qs = user_qs.filter(
+            **{"{}__gt".format(key): decode_username_cursor(cursor)})
+    rows = list(user_qs[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_username_cursor(rows[-1].get_username())
+    return UserPage(rows, next_cursor)
@@ -0,0 +1,191 @@
+"""Lookup of the users a message can be sent to.
+
+``NewMessageForm`` does not list every user anymore: its widget only renders
+the selected ones, and the others are found through the
+``messages_api_recipients`` endpoint, a page at a time.
+
+Users are matched on a prefix of their username. The username is unique, so
+it is indexed, and a prefix lookup can use that index: PostgreSQL gets an
+additional ``varchar_pattern_ops`` index for ``LIKE 'prefix%'`` lookups on
+unique text columns.
+
+The groups a user may send a message to are resolved with a single query and
+cached, see ``messageable_group_ids``. The cached ids of a user are dropped
+when the user joins or leaves a group, or becomes a superuser. Those of all
+users are dropped when a group profile is saved or deleted, since its access
+may have changed. The cache alias is controlled by the
+``USER_MESSAGES_CACHE_ALIAS`` setting and the lifetime of the cached ids, in
+seconds, by the ``USER_MESSAGES_MESSAGEABLE_GROUPS_TIMEOUT`` setting.
+
+"""
+
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+
+from user_messages.pagination import paginate_users
+from user_messages.utils import get_group_change_user_ids
+
+# groups that only their members may send messages to
+RESTRICTED_ACCESS = ("public-invite", "private")
+
+_VERSION_KEY = "user_messages:messageable_groups_version"
+
+
+def _get_cache():
+    return caches[getattr(settings, "USER_MESSAGES_CACHE_ALIAS", "default")]
+
+
+def _get_timeout():
+    return getattr(
+        settings, "USER_MESSAGES_MESSAGEABLE_GROUPS_TIMEOUT", 60 * 60)
+
+
+def messageable_users(sender):
+    """Return the users ``sender`` can send a message to."""
+    return get_user_model().objects.exclude(
+        username="AnonymousUser").exclude(
+        id=sender.id).exclude(
+        is_active=False
+    )
+
+
+def search_recipients(sender, query="", cursor=None, page_size=None):
+    """Return a page of the users ``sender`` can send a message to, whose
+    username starts with ``query``.
+
+    See ``pagination.paginate_users`` for ``cursor`` and ``page_size``.
+
+    """
+
+    users = messageable_users(sender)
+    if query:
+        users = users.filter(**{
+            "{}__startswith".format(get_user_model().USERNAME_FIELD): query})
+    return paginate_users(users, cursor, page_size)
+
+
+def _get_version():
+    cache = _get_cache()
+    version = cache.get(_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(_VERSION_KEY, version, None):
+            # set concurrently
+            version = cache.get(_VERSION_KEY, version)
+    return version
+
+
+def _get_key(user_id, version):
+    return "user_messages:messageable_groups:{}:{}".format(user_id, version)
+
+
+def _query_messageable_group_ids(sender):
+    from geonode.groups.models import GroupProfile
+    group_profiles = GroupProfile.objects.all()
+    if not sender.is_superuser:
+        # subqueries instead of a join on the members, so that no duplicate
+        # rows have to be removed
+        condition = (
+            Q(group__isnull=True) |
+            ~Q(access__in=RESTRICTED_ACCESS) |
+            Q(group__in=sender.groups.values("pk"))
+        )
+        try:
+            condition |= Q(group__in=sender.group_list_all().values("group"))
+        except Exception:
+            pass
+        group_profiles = group_profiles.filter(condition)
+    return list(group_profiles.order_by().values_list("pk", flat=True))
+
+
+def messageable_group_ids(sender):
+    """Return the ids of the group profiles ``sender`` can send a message to.
+
+    Superusers can send messages to any group, other users to public groups
+    and to the groups they are a member of.
+
+    """
+
+    cache = _get_cache()
+    key = _get_key(sender.id, _get_version())
+    group_ids = cache.get(key)
+    if group_ids is None:
+        group_ids = _query_messageable_group_ids(sender)
+        cache.set(key, group_ids, _get_timeout())
+    return group_ids
+
+
+def messageable_groups(sender):
+    """Return the group profiles ``sender`` can send a message to, by
+    title."""
+    from geonode.groups.models import GroupProfile
+    return GroupProfile.objects.filter(
+        pk__in=messageable_group_ids(sender)).order_by("title")
+
+
+def invalidate_messageable_groups(user_ids):
+    """Drop the cached groups of the input users."""
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+
+    def delete():
+        version = _get_version()
+        _get_cache().delete_many(
+            [_get_key(user_id, version) for user_id in user_ids])
+
+    transaction.on_commit(delete)
+
+
+def invalidate_all_messageable_groups():
+    """Drop the cached groups of all users."""
+    transaction.on_commit(
+        lambda: _get_cache().set(_VERSION_KEY, uuid.uuid4().hex, None))
+
+
+def _user_groups_changed(sender, instance, action, reverse, pk_set,
+                         **kwargs):
+    user_ids = get_group_change_user_ids(instance, action, reverse, pk_set)
+    if user_ids is not None:
+        invalidate_messageable_groups(user_ids)
+
+
+def _user_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or "is_superuser" in update_fields:
+        invalidate_messageable_groups([instance.pk])
+
+
+def _group_member_changed(sender, instance, **kwargs):
+    invalidate_messageable_groups([instance.user_id])
+
+
+def _group_profile_changed(sender, instance, **kwargs):
+    invalidate_all_messageable_groups()
+
+
+def connect_signals():
+    """Invalidate the cached groups whenever they may have changed."""
+    from geonode.groups.models import GroupMember, GroupProfile
+    m2m_changed.connect(
+        _user_groups_changed,
+        sender=get_user_model().groups.through,
+        dispatch_uid="user_messages.recipients.user_groups"
+    )
+    post_save.connect(
+        _user_changed, sender=get_user_model(),
+        dispatch_uid="user_messages.recipients.user")
+    for signal in (post_save, post_delete):
+        signal.connect(
+            _group_member_changed, sender=GroupMember,
+            dispatch_uid="user_messages.recipients.group_member")
+        signal.connect(
+            _group_profile_changed, sender=GroupProfile,
+            dispatch_uid="user_messages.recipients.group_profile")
@@ -0,0 +1,167 @@
+"""Purge of the threads nobody can see anymore.
+
+Deleting a thread only hides it from the user who deleted it. Once every
+participant has deleted it, the thread, its messages and its participation
+records are kept for nothing. ``purge_threads`` removes them, along with
+their search index entries.
+
+Which threads are purged is set by two settings:
+
+* ``USER_MESSAGES_RETENTION_DELETED_DAYS`` (defaults to 0): threads deleted
+  by all their participants are purged once their last message is that many
+  days old. ``None`` keeps them forever.
+* ``USER_MESSAGES_RETENTION_DAYS`` (defaults to ``None``): any thread whose
+  last message is that many days old is purged, whether or not it has been
+  deleted. ``None`` keeps them forever.
+
+Threads are deleted in chunks of ``USER_MESSAGES_PURGE_CHUNK_SIZE`` threads
+(defaults to 500), each one in its own short transaction, so that purging
+does not hold locks on the inbox tables for long.
+
+"""
+
+from datetime import timedelta
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Exists
+from django.db.models import OuterRef
+from django.db.models import Q
+from django.utils import timezone
+
+from user_messages import counters
+from user_messages import search
+
+
+def _get_chunk_size(chunk_size=None):
+    if chunk_size is None:
+        chunk_size = getattr(settings, "USER_MESSAGES_PURGE_CHUNK_SIZE", 500)
+    return max(int(chunk_size), 1)
+
+
+def deleted_threads():
+    """Return the threads that have been deleted by all their participants.
+
+    Members of a subscribed group who do not have a state record for the
+    thread yet can still see it, so the thread is only considered deleted
+    if they all have a deleted state record. The state records of former
+    members are not taken into account. Threads whose group members are
+    still being added are never considered deleted.
+
+    """
+
+    from user_messages.models import GroupMemberThread
+    from user_messages.models import GroupThread
+    from user_messages.models import Thread
+    from user_messages.models import UserThread
+    deleted_states = GroupMemberThread.objects.filter(
+        thread=OuterRef(OuterRef("thread")),
+        group=OuterRef(OuterRef("group")),
+        user=OuterRef("pk"),
+        deleted=True
+    )
+    subscribers = get_user_model().objects.filter(
+        groups=OuterRef("group")).filter(~Exists(deleted_states))
+    return Thread.objects.exclude(
+        fanout_status=Thread.FANOUT_PENDING
+    ).filter(
+        ~Exists(UserThread.objects.filter(
+            thread=OuterRef("pk"), deleted=False)),
+        ~Exists(GroupMemberThread.objects.fanned_out().filter(
+            thread=OuterRef("pk"), deleted=False)),
+        ~Exists(GroupThread.objects.filter(
+            thread=OuterRef("pk")).filter(Exists(subscribers))),
+    )
+
+
+def purgeable_threads(deleted_days=None, expired_days=None, now=None):
+    """Return the threads to purge according to the retention policy.
+
+    ``deleted_days`` and ``expired_days`` default to the
+    ``USER_MESSAGES_RETENTION_DELETED_DAYS`` and
+    ``USER_MESSAGES_RETENTION_DAYS`` settings.
+
+    """
+
+    from user_messages.models import Thread
+    if deleted_days is None:
+        deleted_days = getattr(
+            settings, "USER_MESSAGES_RETENTION_DELETED_DAYS", 0)
+    if expired_days is None:
+        expired_days = getattr(settings, "USER_MESSAGES_RETENTION_DAYS", None)
+    if now is None:
+        now = timezone.now()
+    condition = Q(pk__in=[])
+    if deleted_days is not None:
+        condition |= Q(
+            Q(last_message_at__isnull=True) |
+            Q(last_message_at__lte=now - timedelta(days=deleted_days)),
+            pk__in=deleted_threads().values("pk")
+        )
+    if expired_days is not None:
+        condition |= Q(
+            last_message_at__lte=now - timedelta(days=expired_days))
+    return Thread.objects.filter(condition)
+
+
+def _delete_threads(thread_ids):
+    from user_messages.models import GroupMemberThread
+    from user_messages.models import GroupThread
+    from user_messages.models import Message
+    from user_messages.models import Thread
+    from user_messages.models import UserThread
+    # expired threads may still be shown to their participants
+    user_ids = set(UserThread.objects.filter(
+        thread__in=thread_ids, deleted=False).values_list("user", flat=True))
+    user_ids.update(GroupMemberThread.objects.filter(
+        thread__in=thread_ids, deleted=False).values_list("user", flat=True))
+    group_ids = set(GroupThread.objects.filter(
+        thread__in=thread_ids).values_list("group", flat=True))
+    message_ids = list(Message.objects.filter(
+        thread__in=thread_ids).values_list("pk", flat=True))
+    search.remove_messages(message_ids)
+    UserThread.objects.filter(thread__in=thread_ids).delete()
+    GroupMemberThread.objects.filter(thread__in=thread_ids).delete()
+    GroupThread.objects.filter(thread__in=thread_ids).delete()
+    Thread.objects.filter(pk__in=thread_ids).update(last_message=None)
+    Message.objects.filter(pk__in=message_ids).delete()
+    Thread.objects.filter(pk__in=thread_ids).delete()
+    counters.invalidate_unread_count(user_ids)
+    counters.invalidate_group_unread_count(group_ids)
+
+
+def purge_threads(thread_qs=None, chunk_size=None, pause=0, progress=None):
+    """Delete the threads of ``thread_qs``, chunk by chunk.
+
+    ``thread_qs`` defaults to ``purgeable_threads()``. It is evaluated again
+    for every chunk, inside the chunk's transaction, so that threads that
+    became visible again in the meantime are left alone. ``pause`` is the
+    number of seconds to wait between chunks, and ``progress`` a function
+    called with the number of threads purged so far after every chunk.
+    Return the number of purged threads.
+
+    """
+
+    if thread_qs is None:
+        thread_qs = purgeable_threads()
+    chunk_size = _get_chunk_size(chunk_size)
+    purged = 0
+    while True:
+        with transaction.atomic():
+            thread_ids = list(
+                thread_qs.select_for_update().order_by("pk").values_list(
+                    "pk", flat=True)[:chunk_size]
+            )
+            if thread_ids:
+                _delete_threads(thread_ids)
+        if not thread_ids:
+            return purged
+        purged += len(thread_ids)
+        if progress is not None:
+            progress(purged)
+        if len(thread_ids) < chunk_size:
+            return purged
+        if pause:
+            time.sleep(pause)
@@ -0,0 +1,301 @@
+"""Full-text search of the messages.
+
+Messages are indexed in a separate table, which depends on the database:
+
+* SQLite: ``user_messages_message_fts``, an FTS5 virtual table whose rowids
+  are the message ids;
+* PostgreSQL: ``user_messages_message_search``, which stores a ``tsvector``
+  per message, with a GIN index. The text search configuration is set by the
+  ``USER_MESSAGES_SEARCH_CONFIG`` setting (defaults to ``simple``).
+
+Both tables are created by the migrations. Every message is indexed with its
+content, and the first message of each thread with the thread's subject as
+well. ``MessageManager`` indexes new messages as they are created, existing
+ones can be indexed with the ``user_messages_rebuild_search_index`` command.
+Messages whose content is edited in the admin are indexed again.
+Purged threads are removed from the index along with their messages. On
+SQLite, the entries of messages deleted in other ways, such as along with
+their sender, are left behind: the same command with ``--prune`` removes
+them. On PostgreSQL they are deleted by the foreign key.
+
+On other databases, or when SQLite lacks FTS5, searching falls back to
+unindexed ``icontains`` lookups.
+
+"""
+
+import sqlite3
+
+from django.conf import settings
+from django.db import connections
+
+SQLITE_TABLE = "user_messages_message_fts"
+POSTGRESQL_TABLE = "user_messages_message_search"
+SQLITE_CHUNK_SIZE = 500
+
+_fts5_support = None
+
+
+def _get_config():
+    return getattr(settings, "USER_MESSAGES_SEARCH_CONFIG", "simple")
+
+
+def get_page_size(page_size=None):
+    if page_size is None:
+        page_size = getattr(settings, "USER_MESSAGES_SEARCH_PAGE_SIZE", 20)
+    return max(int(page_size), 1)
+
+
+class SearchPage(object):
+    """A page of search results, best matches first.
+
+    Messages have a ``rank`` attribute, which is ``None`` when the search is
+    not backed by an index.
+
+    """
+
+    def __init__(self, object_list, number, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.has_next = has_next
+
+    @property
+    def has_previous(self):
+        return self.number > 1
+
+    @property
+    def next_page_number(self):
+        return self.number + 1 if self.has_next else None
+
+    @property
+    def previous_page_number(self):
+        return self.number - 1 if self.has_previous else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __repr__(self):
+        return "<SearchPage {} of {} messages>".format(
+            self.number, len(self.object_list))
+
+
+class SQLiteBackend(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @staticmethod
+    def to_match_expression(query):
+        """Quote every term, so that FTS5 operators are matched literally."""
+        return " ".join(
+            '"{}"'.format(term.replace('"', '""')) for term in query.split())
+
+    def index(self, rows):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO {} (rowid, subject, content) "
+                "VALUES (%s, %s, %s)".format(SQLITE_TABLE),
+                rows
+            )
+
+    def remove(self, message_ids):
+        message_ids = list(message_ids)
+        with self.connection.cursor() as cursor:
+            # in chunks, below the maximum number of query parameters
+            for start in range(0, len(message_ids), SQLITE_CHUNK_SIZE):
+                chunk = message_ids[start:start + SQLITE_CHUNK_SIZE]
+                cursor.execute(
+                    "DELETE FROM {} WHERE rowid IN ({})".format(
+                        SQLITE_TABLE, ", ".join(["%s"] * len(chunk))),
+                    chunk
+                )
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute("DELETE FROM {}".format(SQLITE_TABLE))
+
+    def prune(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM {} WHERE rowid NOT IN "
+                "(SELECT id FROM user_messages_message)".format(SQLITE_TABLE)
+            )
+            return cursor.rowcount
+
+    def search(self, query, thread_sql, thread_params, limit, offset):
+        expression = self.to_match_expression(query)
+        if not expression:
+            return []
+        sql = (
+            "SELECT {table}.rowid, bm25({table}, 2.0, 1.0) AS rank "
+            "FROM {table} "
+            "INNER JOIN user_messages_message "
+            "ON user_messages_message.id = {table}.rowid "
+            "WHERE {table} MATCH %s "
+            "AND user_messages_message.thread_id IN ({threads}) "
+            "ORDER BY rank, {table}.rowid DESC LIMIT %s OFFSET %s"
+        ).format(table=SQLITE_TABLE, threads=thread_sql)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                sql,
+                [expression] + list(thread_params) + [limit, offset]
+            )
+            # bm25 scores are lower for better matches
+            return [(pk, -rank) for pk, rank in cursor.fetchall()]
+
+
+class PostgreSQLBackend(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def index(self, rows):
+        config = _get_config()
+        with self.connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO {} (message_id, document) VALUES (%s, "
+                "setweight(to_tsvector(%s::regconfig, %s), 'A') || "
+                "setweight(to_tsvector(%s::regconfig, %s), 'B')) "
+                "ON CONFLICT (message_id) DO UPDATE "
+                "SET document = EXCLUDED.document".format(POSTGRESQL_TABLE),
+                [(pk, config, subject, config, content)
+                 for pk, subject, content in rows]
+            )
+
+    def remove(self, message_ids):
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM {} WHERE message_id = ANY(%s)".format(
+                    POSTGRESQL_TABLE),
+                [list(message_ids)]
+            )
+
+    def clear(self):
+        with self.connection.cursor() as cursor:
+            cursor.execute("TRUNCATE {}".format(POSTGRESQL_TABLE))
+
+    def prune(self):
+        # the foreign key deletes the entries along with their messages
+        return 0
+
+    def search(self, query, thread_sql, thread_params, limit, offset):
+        sql = (
+            "SELECT {table}.message_id, "
+            "ts_rank({table}.document, query) AS rank "
+            "FROM {table} "
+            "INNER JOIN user_messages_message "
+            "ON user_messages_message.id = {table}.message_id, "
+            "plainto_tsquery(%s::regconfig, %s) query "
+            "WHERE {table}.document @@ query "
+            "AND user_messages_message.thread_id IN ({threads}) "
+            "ORDER BY rank DESC, {table}.message_id DESC "
+            "LIMIT %s OFFSET %s"
+        ).format(table=POSTGRESQL_TABLE, threads=thread_sql)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                sql,
+                [_get_config(), query] + list(thread_params) +
+                [limit, offset]
+            )
+            return cursor.fetchall()
+
+
+def has_fts5():
+    """Return whether the SQLite library supports FTS5."""
+    global _fts5_support
+    if _fts5_support is None:
+        connection = sqlite3.connect(":memory:")
+        try:
+            connection.execute(
+                "CREATE VIRTUAL TABLE fts5_test USING fts5(content)")
+            _fts5_support = True
+        except sqlite3.OperationalError:
+            _fts5_support = False
+        finally:
+            connection.close()
+    return _fts5_support
+
+
+def get_backend(using="default"):
+    """Return the search backend of the database, or ``None``."""
+    connection = connections[using]
+    if connection.vendor == "postgresql":
+        return PostgreSQLBackend(connection)
+    if connection.vendor == "sqlite" and has_fts5():
+        return SQLiteBackend(connection)
+    return None
+
+
+def index_messages(rows, using="default"):
+    """Index the ``(message_id, subject, content)`` rows.
+
+    ``subject`` should be empty for all but the first message of a thread.
+
+    """
+
+    rows = list(rows)
+    backend = get_backend(using)
+    if backend is not None and rows:
+        backend.index(rows)
+
+
+def remove_messages(message_ids, using="default"):
+    """Remove the input messages from the index."""
+    message_ids = list(message_ids)
+    backend = get_backend(using)
+    if backend is not None and message_ids:
+        backend.remove(message_ids)
+
+
+def reindex_message(message, using="default"):
+    """Index the message again, after its content changed."""
+    # the subject is only indexed with the first message of a thread
+    is_first = not message.thread.messages.filter(pk__lt=message.pk).exists()
+    remove_messages([message.pk], using=using)
+    index_messages(
+        [(message.pk, message.thread.subject if is_first else "",
+          message.content)],
+        using=using
+    )
+
+
+def search_messages(message_qs, thread_qs, query, page=1, page_size=None):
+    """Return a ``SearchPage`` of the messages matching ``query``.
+
+    Only messages belonging to the threads of ``thread_qs`` are considered.
+
+    """
+
+    page = max(int(page), 1)
+    page_size = get_page_size(page_size)
+    offset = (page - 1) * page_size
+    query = query.strip()
+    if not query:
+        return SearchPage([], page, False)
+    backend = get_backend(message_qs.db)
+    if backend is None:
+        from django.db.models import Q
+        rows = list(message_qs.filter(
+            Q(content__icontains=query) | Q(thread__subject__icontains=query),
+            thread__in=thread_qs.values("pk")
+        ).order_by("-sent_at", "-pk")[offset:offset + page_size + 1])
+        for message in rows:
+            message.rank = None
+    else:
+        thread_sql, thread_params = thread_qs.order_by().values(
+            "pk").query.sql_with_params()
+        ranks = backend.search(
+            query, thread_sql, thread_params, page_size + 1, offset)
+        messages = message_qs.in_bulk([pk for pk, rank in ranks])
+        rows = []
+        for pk, rank in ranks:
+            message = messages.get(pk)
+            if message is not None:
+                message.rank = rank
+                rows.append(message)
+    return SearchPage(rows[:page_size], page, len(rows) > page_size)
@@ -2,3 +2,5 @@ from django.dispatch import Signal
 
 
 message_sent = Signal(providing_args=["message", "thread", "reply"])
+operation_measured = Signal(
+    providing_args=["name", "duration", "queries", "fanout", "exception"])
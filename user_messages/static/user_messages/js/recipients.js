@@ -0,0 +1,117 @@
+/* Look up the recipients of RecipientSelectMultiple widgets.
+ *
+ * A search field is added after each select with a data-autocomplete-url
+ * attribute. Users whose username starts with the typed text are fetched
+ * from that URL, a page at a time, and clicking one of them adds it to the
+ * selected options.
+ */
+(function () {
+    "use strict";
+
+    var DELAY = 250;
+
+    function addOption(select, user) {
+        var value = String(user.id);
+        for (var i = 0; i < select.options.length; i++) {
+            if (select.options[i].value === value) {
+                select.options[i].selected = true;
+                return;
+            }
+        }
+        var option = document.createElement("option");
+        option.value = value;
+        option.textContent = user.username;
+        option.selected = true;
+        select.appendChild(option);
+    }
+
+    function fetchPage(url, query, cursor, callback) {
+        var params = "q=" + encodeURIComponent(query);
+        if (cursor) {
+            params += "&cursor=" + encodeURIComponent(cursor);
+        }
+        var request = new XMLHttpRequest();
+        request.open("GET", url + (url.indexOf("?") < 0 ? "?" : "&") + params);
+        request.setRequestHeader("Accept", "application/json");
+        request.onload = function () {
+            if (request.status === 200) {
+                callback(JSON.parse(request.responseText));
+            }
+        };
+        request.send();
+    }
+
+    function setUp(select) {
+        var url = select.getAttribute("data-autocomplete-url");
+        var input = document.createElement("input");
+        var results = document.createElement("ul");
+        var timer = null;
+        var generation = 0;
+        input.type = "search";
+        input.autocomplete = "off";
+        input.className = "user-messages-recipient-search";
+        results.className = "user-messages-recipient-results";
+        select.parentNode.insertBefore(input, select.nextSibling);
+        select.parentNode.insertBefore(results, input.nextSibling);
+
+        function show(query, cursor, current) {
+            fetchPage(url, query, cursor, function (page) {
+                if (current !== generation) {
+                    // a newer search has started
+                    return;
+                }
+                page.users.forEach(function (user) {
+                    var item = document.createElement("li");
+                    var button = document.createElement("button");
+                    button.type = "button";
+                    button.textContent = user.username;
+                    button.addEventListener("click", function () {
+                        addOption(select, user);
+                    });
+                    item.appendChild(button);
+                    results.appendChild(item);
+                });
+                if (page.next_cursor) {
+                    var more = document.createElement("li");
+                    var button = document.createElement("button");
+                    button.type = "button";
+                    button.textContent = "…";
+                    button.addEventListener("click", function () {
+                        results.removeChild(more);
+                        show(query, page.next_cursor, current);
+                    });
+                    more.appendChild(button);
+                    results.appendChild(more);
+                }
+            });
+        }
+
+        input.addEventListener("input", function () {
+            clearTimeout(timer);
+            generation += 1;
+            results.innerHTML = "";
+            var query = input.value.trim();
+            if (!query) {
+                return;
+            }
+            var current = generation;
+            timer = setTimeout(function () {
+                show(query, null, current);
+            }, DELAY);
+        });
+    }
+
+    function init() {
+        var selects = document.querySelectorAll(
+            "select[data-autocomplete-url]");
+        for (var i = 0; i < selects.length; i++) {
+            setUp(selects[i]);
+        }
+    }
+
+    if (document.readyState === "loading") {
+        document.addEventListener("DOMContentLoaded", init);
+    } else {
+        init();
+    }
+}());
@@ -1,5 +1,6 @@
 from django import template
 
+from user_messages.counters import get_unread_count
 from user_messages.models import Thread
 
 
@@ -8,9 +9,19 @@ register = template.Library()
 
 @register.filter
 def unread(thread, user):
-    return bool(thread.userthread_set.filter(user=user, unread=True))
+    """Return whether the thread is unread for the user.
+
+    Threads annotated with ``ThreadQuerySet.with_user_state``, like the ones
+    listed in the inbox, do not need any additional query.
+
+    """
+
+    user_unread = getattr(thread, "user_unread", None)
+    if user_unread is not None:
+        return user_unread
+    return Thread.objects.unread_threads(user).filter(pk=thread.pk).exists()
 
 
 @register.filter
 def unread_threads(user):
-    return Thread.objects.unread_threads(user).count()
+    return get_unread_count(user)
@@ -0,0 +1,156 @@
+"""Unit tests for user_messages.api"""
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+
+from user_messages import models
+
+
+class ApiTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.first_user = get_user_model().objects.create_user(
+            "first", "first@fakemail.com", "pass")
+        self.second_user = get_user_model().objects.create_user(
+            "second", "second@fakemail.com", "pass")
+        self.third_user = get_user_model().objects.create_user(
+            "third", "third@fakemail.com", "pass")
+        self.message = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="first message of the first thread",
+            content="test",
+            to_users=[self.second_user],
+        )
+        self.thread = self.message.thread
+        self.client.force_login(self.second_user)
+
+    def test_inbox(self):
+        response = self.client.get(reverse("messages_api_inbox"))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("ETag", response)
+        self.assertIn("Last-Modified", response)
+        data = response.json()
+        self.assertIsNone(data["next_cursor"])
+        thread, = data["threads"]
+        self.assertEqual(thread["id"], self.thread.id)
+        self.assertEqual(thread["subject"], self.thread.subject)
+        self.assertTrue(thread["unread"])
+        self.assertEqual(thread["message_count"], 1)
+        self.assertEqual(
+            thread["latest_message"]["sender"]["username"], "first")
+
+    def test_inbox_unread(self):
+        self.client.get(
+            reverse("messages_thread_detail", args=(self.thread.id,)))
+        response = self.client.get(
+            reverse("messages_api_inbox"), data={"unread": 1})
+        self.assertEqual(response.json()["threads"], [])
+
+    def test_inbox_invalid_cursor(self):
+        response = self.client.get(
+            reverse("messages_api_inbox"), data={"cursor": "invalid"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_inbox_not_modified(self):
+        response = self.client.get(reverse("messages_api_inbox"))
+        # the session and the user are still loaded, the threads are not
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                reverse("messages_api_inbox"),
+                HTTP_IF_NONE_MATCH=response["ETag"]
+            )
+        self.assertEqual(response.status_code, 304)
+
+    def test_inbox_not_modified_since(self):
+        response = self.client.get(reverse("messages_api_inbox"))
+        response = self.client.get(
+            reverse("messages_api_inbox"),
+            HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_inbox_modified_by_new_reply(self):
+        response = self.client.get(reverse("messages_api_inbox"))
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Message.objects.new_reply(
+                self.thread, self.first_user, "reply")
+        response = self.client.get(
+            reverse("messages_api_inbox"),
+            HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["threads"][0]["message_count"], 2)
+
+    def test_etag_depends_on_query_string(self):
+        first = self.client.get(reverse("messages_api_inbox"))
+        second = self.client.get(
+            reverse("messages_api_inbox"), data={"unread": 1})
+        self.assertNotEqual(first["ETag"], second["ETag"])
+
+    def test_thread_messages(self):
+        response = self.client.get(reverse(
+            "messages_api_thread_messages", args=(self.thread.id,)))
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data["thread"]["id"], self.thread.id)
+        message, = data["messages"]
+        self.assertEqual(message["id"], self.message.id)
+        self.assertEqual(message["content"], "test")
+        # reading the messages through the api does not mark them as read
+        self.assertTrue(
+            self.thread.userthread_set.get(user=self.second_user).unread)
+
+    def test_thread_messages_not_involved(self):
+        self.client.force_login(self.third_user)
+        response = self.client.get(reverse(
+            "messages_api_thread_messages", args=(self.thread.id,)))
+        self.assertEqual(response.status_code, 404)
+
+    def test_unread_count(self):
+        response = self.client.get(reverse("messages_api_unread_count"))
+        self.assertEqual(response.json(), {"unread_count": 1})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(
+                reverse("messages_thread_detail", args=(self.thread.id,)))
+        response = self.client.get(
+            reverse("messages_api_unread_count"),
+            HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"unread_count": 0})
+
+    def test_recipients(self):
+        response = self.client.get(
+            reverse("messages_api_recipients"), data={"q": "th"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            "users": [{"id": self.third_user.id, "username": "third"}],
+            "next_cursor": None,
+        })
+
+    def test_recipients_pagination(self):
+        with self.settings(USER_MESSAGES_RECIPIENT_PAGE_SIZE=1):
+            data = self.client.get(reverse("messages_api_recipients")).json()
+            self.assertEqual(
+                [user["username"] for user in data["users"]], ["first"])
+            data = self.client.get(
+                reverse("messages_api_recipients"),
+                data={"cursor": data["next_cursor"]}
+            ).json()
+        # the current user is not a recipient
+        self.assertEqual(
+            [user["username"] for user in data["users"]], ["third"])
+        self.assertIsNone(data["next_cursor"])
+
+    def test_recipients_invalid_cursor(self):
+        response = self.client.get(
+            reverse("messages_api_recipients"), data={"cursor": "%%%"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_login_required(self):
+        self.client.logout()
+        response = self.client.get(reverse("messages_api_unread_count"))
+        self.assertEqual(response.status_code, 302)
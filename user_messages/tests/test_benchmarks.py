@@ -0,0 +1,61 @@
+"""Unit tests for user_messages.benchmarks"""
+
+from django.test import TestCase
+
+from user_messages.benchmarks import dataset
+from user_messages.benchmarks import suite
+from user_messages.benchmarks import thread_queries
+
+SMALL_DATASET = {
+    "num_users": 20,
+    "num_groups": 2,
+    "max_group_size": 10,
+    "num_threads": 20,
+    "max_messages": 5,
+}
+
+
+class DatasetTestCase(TestCase):
+
+    def test_generate(self):
+        data = dataset.generate(**SMALL_DATASET)
+        self.assertEqual(len(data.users), 20)
+        self.assertEqual(len(data.groups), 2)
+        self.assertEqual(len(data.threads), 20)
+        for thread in data.threads:
+            self.assertGreater(thread.message_count, 0)
+            self.assertEqual(thread.latest_message, thread.messages.last())
+
+    def test_generate_unknown_option(self):
+        with self.assertRaises(TypeError):
+            dataset.generate(num_messages=10)
+
+
+class SuiteTestCase(TestCase):
+
+    def test_run_and_compare(self):
+        results = suite.run(repeat=1, **SMALL_DATASET)
+        names = [result["name"] for result in results["results"]]
+        self.assertEqual(
+            names,
+            ["inbox", "thread_detail_get", "thread_detail_post",
+             "message_create", "new_reply"]
+        )
+        rows = suite.compare(results, results)
+        self.assertEqual(len(rows), len(names) * len(suite.METRICS))
+
+
+class ThreadQueriesBenchmarkTestCase(TestCase):
+
+    def test_run(self):
+        results = thread_queries.run(sample_size=5, repeat=1, **SMALL_DATASET)
+        self.assertEqual(
+            [name for name, seconds in results],
+            ["legacy_active_threads", "active_threads",
+             "legacy_unread_threads", "unread_threads"]
+        )
+
+    def test_run_with_subscriptions(self):
+        results = thread_queries.run(
+            sample_size=5, repeat=1, subscription_ratio=0.5, **SMALL_DATASET)
+        self.assertEqual(len(results), 4)
@@ -0,0 +1,172 @@
+"""Unit tests for user_messages.counters"""
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.test import TestCase
+
+from user_messages import counters
+from user_messages import models
+
+
+class UnreadCountTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.first_user = get_user_model().objects.create_user(
+            "first", "first@fakemail.com", "pass")
+        self.second_user = get_user_model().objects.create_user(
+            "second", "second@fakemail.com", "pass")
+        self.third_user = get_user_model().objects.create_user(
+            "third", "third@fakemail.com", "pass")
+        self.message = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="first message of the first thread",
+            content="test",
+            to_users=[self.second_user, self.third_user],
+        )
+
+    def assertCountsEqual(self, expected):
+        users = (self.first_user, self.second_user, self.third_user)
+        self.assertEqual(
+            [counters.get_unread_count(user) for user in users], expected)
+        self.assertEqual(
+            [models.Thread.objects.unread_threads(user).count()
+             for user in users],
+            expected
+        )
+
+    def test_get_unread_count_is_cached(self):
+        self.assertEqual(counters.get_unread_count(self.second_user), 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(counters.get_unread_count(self.second_user), 1)
+
+    def test_new_message_increments_count(self):
+        self.assertCountsEqual([0, 1, 1])
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Message.objects.new_message(
+                from_user=self.first_user,
+                subject="first message of the second thread",
+                content="test",
+                to_users=[self.second_user],
+            )
+        self.assertCountsEqual([0, 2, 1])
+
+    def test_new_reply_updates_count(self):
+        self.assertCountsEqual([0, 1, 1])
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Message.objects.new_reply(
+                self.message.thread, self.second_user, "reply")
+        self.assertCountsEqual([1, 0, 1])
+
+    def test_missing_count_is_not_incremented(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            counters.increment_unread_count([self.second_user.id])
+        self.assertEqual(counters.get_unread_count(self.second_user), 1)
+
+    def test_invalidate_unread_count(self):
+        self.assertEqual(counters.get_unread_count(self.second_user), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            counters.invalidate_unread_count([self.second_user.id])
+        with self.assertNumQueries(1):
+            self.assertEqual(counters.get_unread_count(self.second_user), 1)
+
+
+class GroupUnreadCountTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.first_user = get_user_model().objects.create_user(
+            "first", "first@fakemail.com", "pass")
+        self.second_user = get_user_model().objects.create_user(
+            "second", "second@fakemail.com", "pass")
+        self.group = Group.objects.create(name="group")
+        self.message = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="first message of the first thread",
+            content="test",
+        )
+
+    def subscribe_group(self):
+        models.GroupThread.objects.create(
+            thread=self.message.thread, group=self.group)
+
+    def test_joining_and_leaving_a_group(self):
+        self.subscribe_group()
+        self.assertEqual(counters.get_unread_count(self.second_user), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group.user_set.add(self.second_user)
+        self.assertEqual(counters.get_unread_count(self.second_user), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.second_user.groups.clear()
+        self.assertEqual(counters.get_unread_count(self.second_user), 0)
+
+    def test_new_reply_reaches_former_group_members(self):
+        thread = self.message.thread
+        models.GroupMemberThread.objects.create(
+            thread=thread, group=self.group, user=self.second_user)
+        models.FanoutGroup.objects.create(thread=thread, group=self.group)
+        self.assertEqual(counters.get_unread_count(self.second_user), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Thread.objects.mark_read(self.second_user)
+        self.assertEqual(counters.get_unread_count(self.second_user), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Message.objects.new_reply(thread, self.first_user, "reply")
+        self.assertEqual(counters.get_unread_count(self.second_user), 1)
+
+    def test_invalidate_group_unread_count(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.group.user_set.add(self.second_user)
+        self.assertEqual(counters.get_unread_count(self.second_user), 0)
+        self.subscribe_group()
+        with self.assertNumQueries(0):
+            with self.captureOnCommitCallbacks(execute=True):
+                counters.invalidate_group_unread_count([self.group.id])
+        self.assertEqual(counters.get_unread_count(self.second_user), 1)
+
+
+class InboxModifiedTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.first_user = get_user_model().objects.create_user(
+            "first", "first@fakemail.com", "pass")
+        self.second_user = get_user_model().objects.create_user(
+            "second", "second@fakemail.com", "pass")
+        self.third_user = get_user_model().objects.create_user(
+            "third", "third@fakemail.com", "pass")
+        self.message = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="first message of the first thread",
+            content="test",
+            to_users=[self.second_user, self.third_user],
+        )
+
+    def get_modified(self):
+        return [
+            counters.get_inbox_modified(user)
+            for user in (self.first_user, self.second_user, self.third_user)
+        ]
+
+    def test_get_inbox_modified_is_cached(self):
+        modified = counters.get_inbox_modified(self.first_user)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                counters.get_inbox_modified(self.first_user), modified)
+
+    def test_new_reply_touches_all_participants(self):
+        before = self.get_modified()
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Message.objects.new_reply(
+                self.message.thread, self.second_user, "reply")
+        after = self.get_modified()
+        for previous, current in zip(before, after):
+            self.assertGreater(current, previous)
+
+    def test_touch_inbox(self):
+        before = self.get_modified()
+        with self.captureOnCommitCallbacks(execute=True):
+            counters.touch_inbox([self.third_user.id])
+        after = self.get_modified()
+        self.assertEqual(after[:2], before[:2])
+        self.assertGreater(after[2], before[2])
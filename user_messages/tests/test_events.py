@@ -0,0 +1,197 @@
+"""Unit tests for user_messages.events and user_messages.asgi"""
+
+import json
+
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, override_settings
+import mock
+
+from user_messages import asgi
+from user_messages import events
+from user_messages import models
+
+
+class InProcessBrokerTestCase(SimpleTestCase):
+
+    async def test_publish(self):
+        broker = events.InProcessBroker()
+        subscription = broker.subscribe(["user:1", "group:1"])
+        other_subscription = broker.subscribe(["user:2"])
+        broker.publish(["user:1", "group:1"], {"type": "message"})
+        self.assertEqual(await subscription.get(), {"type": "message"})
+        self.assertTrue(subscription.queue.empty())
+        self.assertTrue(other_subscription.queue.empty())
+        subscription.close()
+        other_subscription.close()
+        self.assertEqual(dict(broker._subscriptions), {})
+
+    async def test_full_queue_drops_events(self):
+        broker = events.InProcessBroker(max_size=1)
+        subscription = broker.subscribe(["user:1"])
+        broker.publish(["user:1"], {"type": "message", "message": 1})
+        broker.publish(["user:1"], {"type": "message", "message": 2})
+        self.assertEqual(
+            await subscription.get(), {"type": "message", "message": 1})
+        self.assertTrue(subscription.queue.empty())
+        subscription.close()
+
+
+class PublishMessageTestCase(TestCase):
+
+    def setUp(self):
+        self.first_user = get_user_model().objects.create_user(
+            "first", "first@fakemail.com", "pass")
+        self.second_user = get_user_model().objects.create_user(
+            "second", "second@fakemail.com", "pass")
+
+    def new_message(self):
+        return models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="subject",
+            content="content",
+            to_users=[self.second_user],
+        )
+
+    def test_disabled(self):
+        with mock.patch.object(events, "get_broker") as get_broker:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.new_message()
+        self.assertFalse(get_broker.called)
+
+    @override_settings(USER_MESSAGES_EVENTS=True)
+    def test_new_message(self):
+        with mock.patch.object(events, "get_broker") as get_broker:
+            with self.captureOnCommitCallbacks(execute=True):
+                message = self.new_message()
+        channels, event = get_broker.return_value.publish.call_args[0]
+        self.assertEqual(
+            sorted(channels),
+            ["user:{}".format(self.first_user.pk),
+             "user:{}".format(self.second_user.pk)]
+        )
+        self.assertEqual(event, {
+            "type": "message",
+            "thread": message.thread.pk,
+            "subject": "subject",
+            "message": message.pk,
+            "sender": self.first_user.pk,
+            "reply": False,
+        })
+
+    @override_settings(USER_MESSAGES_EVENTS=True)
+    def test_new_reply_is_published_once_committed(self):
+        thread = self.new_message().thread
+        with mock.patch.object(events, "get_broker") as get_broker:
+            with self.captureOnCommitCallbacks() as callbacks:
+                models.Message.objects.new_reply(
+                    thread, self.second_user, "reply")
+            self.assertFalse(get_broker.called)
+            for callback in callbacks:
+                callback()
+        channels, event = get_broker.return_value.publish.call_args[0]
+        self.assertTrue(event["reply"])
+
+
+@override_settings(
+    USER_MESSAGES_EVENTS=True,
+    USER_MESSAGES_EVENTS_KEEPALIVE=0.1,
+    USER_MESSAGES_EVENTS_POLL_TIMEOUT=0.1
+)
+class EventStreamTestCase(TestCase):
+
+    def setUp(self):
+        self.first_user = get_user_model().objects.create_user(
+            "first", "first@fakemail.com", "pass")
+        self.second_user = get_user_model().objects.create_user(
+            "second", "second@fakemail.com", "pass")
+        self.group = Group.objects.create(name="events")
+        self.group.user_set.add(self.first_user, self.second_user)
+        self.client.force_login(self.second_user)
+        cache.clear()
+
+    def new_message(self, **kwargs):
+        with self.captureOnCommitCallbacks(execute=True):
+            return models.Message.objects.new_message(
+                from_user=self.first_user,
+                subject="subject",
+                content="content",
+                **kwargs
+            )
+
+    def get_communicator(self, query_string=b"", logged_in=True):
+        headers = []
+        if logged_in:
+            headers.append((b"cookie", "{}={}".format(
+                settings.SESSION_COOKIE_NAME,
+                self.client.cookies[settings.SESSION_COOKIE_NAME].value
+            ).encode("latin-1")))
+        return ApplicationCommunicator(asgi.event_stream, {
+            "type": "http",
+            "path": "/messages/events/",
+            "query_string": query_string,
+            "headers": headers,
+        })
+
+    async def receive_body(self, communicator):
+        return (await communicator.receive_output(1))["body"]
+
+    async def test_stream(self):
+        communicator = self.get_communicator()
+        await communicator.send_input({"type": "http.request"})
+        start = await communicator.receive_output(1)
+        self.assertEqual(start["status"], 200)
+        self.assertIn(
+            (b"content-type", b"text/event-stream"), start["headers"])
+        self.assertEqual(
+            await self.receive_body(communicator),
+            b'event: unread_count\ndata: {"unread_count": 0}\n\n'
+        )
+        message = await sync_to_async(self.new_message)(
+            to_users=[self.second_user])
+        body = await self.receive_body(communicator)
+        self.assertTrue(body.startswith(b"event: message\n"))
+        event = json.loads(body.decode("utf-8").split("data: ")[1])
+        self.assertEqual(event["message"], message.pk)
+        self.assertEqual(
+            await self.receive_body(communicator),
+            b'event: unread_count\ndata: {"unread_count": 1}\n\n'
+        )
+        self.assertEqual(
+            await self.receive_body(communicator), b": keepalive\n\n")
+        await communicator.send_input({"type": "http.disconnect"})
+        await communicator.wait(1)
+
+    async def test_group_subscription(self):
+        communicator = self.get_communicator()
+        await communicator.send_input({"type": "http.request"})
+        await communicator.receive_output(1)
+        await communicator.receive_output(1)
+        group_profile = mock.Mock(group_id=self.group.pk)
+        message = await sync_to_async(self.new_message)(
+            to_groups=[group_profile], subscribe_groups=True)
+        body = await self.receive_body(communicator)
+        event = json.loads(body.decode("utf-8").split("data: ")[1])
+        self.assertEqual(event["message"], message.pk)
+        await communicator.send_input({"type": "http.disconnect"})
+        await communicator.wait(1)
+
+    async def test_long_poll_timeout(self):
+        communicator = self.get_communicator(b"poll")
+        await communicator.send_input({"type": "http.request"})
+        start = await communicator.receive_output(1)
+        self.assertEqual(start["status"], 200)
+        self.assertEqual(
+            json.loads((await self.receive_body(communicator)).decode()),
+            {"events": [], "unread_count": 0}
+        )
+
+    async def test_anonymous(self):
+        communicator = self.get_communicator(logged_in=False)
+        await communicator.send_input({"type": "http.request"})
+        start = await communicator.receive_output(1)
+        self.assertEqual(start["status"], 403)
@@ -1,16 +1,19 @@
 """Unit tests for user_messages.forms"""
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import TestCase
 
 from geonode.groups.models import GroupProfile
 
 from user_messages import forms
+from user_messages import recipients
 
 
 class NewMessageFormTestCase(TestCase):
 
     def setUp(self):
+        cache.clear()
         self.user_password = "fakepass"
         self.first_user = get_user_model().objects.create_user(
             "first", "first@fakemail.com", self.user_password)
@@ -205,6 +208,57 @@ class NewMessageFormTestCase(TestCase):
         eligible_users = list(new_form.fields["to_users"].queryset)
         self.assertNotIn(self.inactive_user, eligible_users)
 
+    def test_new_message_form_renders_only_selected_users(self):
+        new_form = forms.NewMessageForm(
+            current_user=self.first_user,
+            initial={"to_users": [self.second_user.id]}
+        )
+        rendered = str(new_form["to_users"])
+        self.assertIn(
+            '<option value="{}" selected>second</option>'.format(
+                self.second_user.id),
+            rendered
+        )
+        self.assertNotIn("third", rendered)
+        self.assertIn('data-autocomplete-url="', rendered)
+        self.assertIn(
+            "user_messages/js/recipients.js", str(new_form.media))
+
+    def test_new_message_form_caches_messageable_groups(self):
+        new_form = forms.NewMessageForm(current_user=self.first_user)
+        self.assertEqual(
+            list(new_form.fields["to_groups"].queryset),
+            [self.first_group_profile, self.second_group_profile]
+        )
+        with self.assertNumQueries(1):
+            new_form = forms.NewMessageForm(current_user=self.first_user)
+            list(new_form.fields["to_groups"].queryset)
+
+    def test_messageable_groups_follow_membership(self):
+        self.assertNotIn(
+            self.third_group_profile.id,
+            recipients.messageable_group_ids(self.first_user)
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.third_group_profile.join(self.first_user)
+        self.assertIn(
+            self.third_group_profile.id,
+            recipients.messageable_group_ids(self.first_user)
+        )
+
+    def test_messageable_groups_follow_access(self):
+        self.assertNotIn(
+            self.fourth_group_profile.id,
+            recipients.messageable_group_ids(self.first_user)
+        )
+        self.fourth_group_profile.access = "public"
+        with self.captureOnCommitCallbacks(execute=True):
+            self.fourth_group_profile.save()
+        self.assertIn(
+            self.fourth_group_profile.id,
+            recipients.messageable_group_ids(self.first_user)
+        )
+
     def test_new_message_form_admin_can_message_all_groups(self):
         new_form = forms.NewMessageForm(
             {
@@ -0,0 +1,95 @@
+"""Unit tests for user_messages.instrumentation"""
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from user_messages import instrumentation
+from user_messages import models
+from user_messages.signals import operation_measured
+
+
+class InstrumentationTestCase(TestCase):
+
+    def setUp(self):
+        self.first_user = get_user_model().objects.create_user(
+            "first", "first@fakemail.com", "pass")
+        self.second_user = get_user_model().objects.create_user(
+            "second", "second@fakemail.com", "pass")
+        self.third_user = get_user_model().objects.create_user(
+            "third", "third@fakemail.com", "pass")
+        self.measurements = []
+        operation_measured.connect(self.receiver)
+        self.addCleanup(operation_measured.disconnect, self.receiver)
+
+    def receiver(self, sender, **kwargs):
+        self.measurements.append(kwargs)
+
+    def new_message(self):
+        return models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="subject",
+            content="content",
+            to_users=[self.second_user, self.third_user],
+        )
+
+    def test_disabled(self):
+        self.new_message()
+        self.assertEqual(self.measurements, [])
+
+    @override_settings(USER_MESSAGES_INSTRUMENTATION=True)
+    def test_new_message(self):
+        with self.assertNumQueries(8):
+            self.new_message()
+        measurement, = self.measurements
+        self.assertEqual(measurement["name"], "MessageManager.new_message")
+        self.assertEqual(measurement["queries"], 8)
+        self.assertEqual(measurement["fanout"], 2)
+        self.assertGreaterEqual(measurement["duration"], 0)
+        self.assertIsNone(measurement["exception"])
+
+    @override_settings(USER_MESSAGES_INSTRUMENTATION=True)
+    def test_new_reply(self):
+        thread = self.new_message().thread
+        thread.userthread_set.filter(user=self.third_user).update(deleted=True)
+        del self.measurements[:]
+        models.Message.objects.new_reply(thread, self.second_user, "reply")
+        measurement, = self.measurements
+        self.assertEqual(measurement["name"], "MessageManager.new_reply")
+        # the sender's record and the restored one of the third user
+        self.assertEqual(measurement["fanout"], 2)
+
+    @override_settings(USER_MESSAGES_INSTRUMENTATION=True)
+    def test_nested(self):
+        thread = self.new_message().thread
+        del self.measurements[:]
+        self.client.force_login(self.second_user)
+        self.client.post(
+            reverse("messages_thread_detail", args=(thread.pk,)),
+            {"content": "reply"}
+        )
+        reply, view = self.measurements
+        self.assertEqual(reply["name"], "MessageManager.new_reply")
+        self.assertEqual(view["name"], "views.thread_detail")
+        self.assertEqual(view["fanout"], reply["fanout"])
+        self.assertGreater(view["queries"], reply["queries"])
+        self.assertGreater(view["duration"], reply["duration"])
+
+    @override_settings(USER_MESSAGES_INSTRUMENTATION=True)
+    def test_exception(self):
+
+        @instrumentation.instrumented("failing")
+        def failing():
+            instrumentation.record_fanout(3)
+            raise ValueError("failing")
+
+        with self.assertRaises(ValueError):
+            failing()
+        measurement, = self.measurements
+        self.assertEqual(measurement["name"], "failing")
+        self.assertEqual(measurement["fanout"], 3)
+        self.assertIsInstance(measurement["exception"], ValueError)
+
+    def test_record_fanout_without_measurement(self):
+        instrumentation.record_fanout(3)
+        self.assertEqual(self.measurements, [])
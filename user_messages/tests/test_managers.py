@@ -1,13 +1,21 @@
 """Unit tests for user_messages.managers."""
 
+from io import StringIO
+
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 import mock
 
 from geonode.groups.models import GroupProfile
 
 from user_messages import models
+from user_messages import fanout
 from user_messages import managers
+from user_messages.pagination import InvalidCursor
+from user_messages.templatetags import user_messages_tags
 
 
 class Base(TestCase):
@@ -113,6 +121,62 @@ class ThreadManagerSingleUsersTestCase(Base):
         self.assertIn(self.second_thread, second)
         self.assertIn(self.second_thread, third)
 
+    def test_sorted_active_threads(self):
+        with self.assertNumQueries(1):
+            threads = list(
+                models.Thread.objects.sorted_active_threads(self.second_user))
+        self.assertEqual(threads, [self.first_thread, self.second_thread])
+
+    def test_sorted_unread_threads(self):
+        with self.assertNumQueries(1):
+            threads = list(
+                models.Thread.objects.sorted_unread_threads(self.third_user))
+        self.assertEqual(threads, [self.second_thread])
+
+    def test_with_latest_message(self):
+        with self.assertNumQueries(1):
+            latest = dict(
+                (thread, (thread.latest_message, thread.latest_message.sender))
+                for thread in models.Thread.objects.active_threads(
+                    self.second_user).with_latest_message()
+            )
+        self.assertEqual(
+            latest[self.first_thread], (self.first_reply, self.second_user))
+        self.assertEqual(
+            latest[self.second_thread],
+            (self.second_message, self.first_user)
+        )
+
+    def test_active_threads_page(self):
+        first_page = models.Thread.objects.active_threads_page(
+            self.second_user, page_size=1)
+        self.assertEqual(list(first_page), [self.first_thread])
+        self.assertFalse(first_page.has_previous)
+        self.assertTrue(first_page.has_next)
+        second_page = models.Thread.objects.active_threads_page(
+            self.second_user, cursor=first_page.next_cursor, page_size=1)
+        self.assertEqual(list(second_page), [self.second_thread])
+        self.assertTrue(second_page.has_previous)
+        self.assertFalse(second_page.has_next)
+        previous_page = models.Thread.objects.active_threads_page(
+            self.second_user, cursor=second_page.previous_cursor,
+            page_size=1
+        )
+        self.assertEqual(list(previous_page), [self.first_thread])
+        self.assertFalse(previous_page.has_previous)
+        self.assertTrue(previous_page.has_next)
+
+    def test_unread_threads_page(self):
+        page = models.Thread.objects.unread_threads_page(self.third_user)
+        self.assertEqual(list(page), [self.second_thread])
+        self.assertFalse(page.has_next)
+        self.assertFalse(page.has_previous)
+
+    def test_threads_page_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            models.Thread.objects.active_threads_page(
+                self.second_user, cursor="invalid")
+
 
 class ThreadManagerGroupsTestCase(Base):
 
@@ -174,6 +238,238 @@ class ThreadManagerGroupsTestCase(Base):
         self.assertIn(self.second_thread, third)
         self.assertIn(self.second_thread, fourth)
 
+    def test_with_user_state(self):
+        with self.assertNumQueries(1):
+            states = dict(
+                (thread, (thread.user_unread, thread.user_deleted))
+                for thread in models.Thread.objects.with_user_state(
+                    self.third_user)
+            )
+        self.assertEqual(states[self.first_thread], (False, True))
+        self.assertEqual(states[self.second_thread], (True, False))
+
+    def test_unread_filter_uses_group_state(self):
+        self.assertTrue(
+            user_messages_tags.unread(self.second_thread, self.fourth_user))
+        self.assertFalse(
+            user_messages_tags.unread(self.first_thread, self.fourth_user))
+
+    def test_unread_filter_uses_annotation(self):
+        thread = models.Thread.objects.with_user_state(
+            self.fourth_user).get(pk=self.second_thread.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(
+                user_messages_tags.unread(thread, self.fourth_user))
+
+
+class ThreadManagerGroupSubscriptionsTestCase(Base):
+
+    def setUp(self):
+        super(ThreadManagerGroupSubscriptionsTestCase, self).setUp()
+        self.message = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="first message of the subscribed thread",
+            content="test",
+            to_groups=[self.second_group_profile],
+            subscribe_groups=True
+        )
+        self.thread = self.message.thread
+
+    def test_new_message_does_not_create_member_records(self):
+        self.assertEqual(
+            list(self.thread.groupthread_set.values_list("group", flat=True)),
+            [self.second_group.id]
+        )
+        self.assertEqual(
+            list(self.thread.groupmemberthread_set.values_list(
+                "user", "read_sequence")),
+            [(self.first_user.id, 1)]
+        )
+
+    def test_active_threads(self):
+        for user in (self.first_user, self.third_user, self.fourth_user):
+            self.assertIn(
+                self.thread, models.Thread.objects.active_threads(user))
+        self.assertNotIn(
+            self.thread, models.Thread.objects.active_threads(self.fifth_user))
+
+    def test_unread_threads(self):
+        for user in (self.third_user, self.fourth_user):
+            self.assertIn(
+                self.thread, models.Thread.objects.unread_threads(user))
+        self.assertNotIn(
+            self.thread, models.Thread.objects.unread_threads(self.first_user))
+
+    def test_membership_is_resolved_through_current_groups(self):
+        self.second_group_profile.join(self.fifth_user)
+        self.assertIn(
+            self.thread,
+            models.Thread.objects.unread_threads(self.fifth_user)
+        )
+
+    def test_leaving_the_group_after_reading(self):
+        models.Thread.objects.mark_read(self.third_user, [self.thread.pk])
+        self.second_group.user_set.remove(self.third_user)
+        models.Message.objects.new_reply(
+            self.thread, self.first_user, "reply")
+        self.assertNotIn(
+            self.thread, models.Thread.objects.active_threads(self.third_user))
+        self.assertNotIn(
+            self.thread, models.Thread.objects.unread_threads(self.third_user))
+        self.assertNotIn(self.third_user, self.thread.registered_users)
+        self.assertIn(
+            self.thread,
+            models.Thread.objects.unread_threads(self.fourth_user)
+        )
+
+    def test_member_state_records(self):
+        fanout.add_member_states(
+            self.thread, self.third_user, read_sequence=self.thread.sequence)
+        fanout.add_member_states(self.thread, self.fourth_user, deleted=True)
+        self.assertNotIn(
+            self.thread, models.Thread.objects.unread_threads(self.third_user))
+        self.assertIn(
+            self.thread, models.Thread.objects.active_threads(self.third_user))
+        self.assertNotIn(
+            self.thread,
+            models.Thread.objects.active_threads(self.fourth_user)
+        )
+        models.Message.objects.new_reply(
+            self.thread, self.first_user, "reply")
+        for user in (self.third_user, self.fourth_user):
+            self.assertIn(
+                self.thread, models.Thread.objects.unread_threads(user))
+
+    def test_new_reply_marks_thread_as_read_for_sender(self):
+        models.Message.objects.new_reply(
+            self.thread, self.third_user, "reply")
+        self.assertNotIn(
+            self.thread, models.Thread.objects.unread_threads(self.third_user))
+        self.assertIn(
+            self.thread, models.Thread.objects.unread_threads(self.first_user))
+        self.assertEqual(self.thread.groupmemberthread_set.count(), 2)
+
+    def test_registered_users(self):
+        self.assertEqual(
+            set(self.thread.registered_users),
+            {self.first_user, self.third_user, self.fourth_user,
+             self.inactive_user}
+        )
+
+
+class ThreadManagerBulkStateTestCase(Base):
+
+    def setUp(self):
+        super(ThreadManagerBulkStateTestCase, self).setUp()
+        self.direct_thread = models.Message.objects.new_message(
+            from_user=self.second_user,
+            subject="direct thread",
+            content="test",
+            to_users=[self.first_user, self.third_user],
+        ).thread
+        self.group_thread = models.Message.objects.new_message(
+            from_user=self.second_user,
+            subject="group thread",
+            content="test",
+            to_groups=[self.first_group_profile],
+        ).thread
+        self.subscribed_thread = models.Message.objects.new_message(
+            from_user=self.fourth_user,
+            subject="subscribed thread",
+            content="test",
+            to_groups=[self.second_group_profile],
+            subscribe_groups=True
+        ).thread
+
+    def test_mark_read(self):
+        with self.assertNumQueries(4):
+            models.Thread.objects.mark_read(self.first_user)
+        self.assertEqual(
+            list(models.Thread.objects.unread_threads(self.first_user)), [])
+        self.assertEqual(
+            len(models.Thread.objects.active_threads(self.first_user)), 3)
+        self.assertIn(
+            self.direct_thread,
+            models.Thread.objects.unread_threads(self.third_user)
+        )
+
+    def test_unread_messages(self):
+        models.Message.objects.new_reply(
+            self.direct_thread, self.third_user, "reply")
+        models.Message.objects.new_reply(
+            self.subscribed_thread, self.fourth_user, "reply")
+
+        def unread_messages():
+            return dict(models.Thread.objects.active_threads(
+                self.first_user).with_user_state(self.first_user).values_list(
+                "subject", "user_unread_messages"))
+
+        self.assertEqual(unread_messages(), {
+            "direct thread": 2, "group thread": 1, "subscribed thread": 2})
+        models.Thread.objects.mark_read(self.first_user)
+        self.assertEqual(unread_messages(), {
+            "direct thread": 0, "group thread": 0, "subscribed thread": 0})
+        models.Thread.objects.mark_unread(self.first_user)
+        self.assertEqual(unread_messages(), {
+            "direct thread": 1, "group thread": 1, "subscribed thread": 1})
+
+    def test_mark_read_selected_threads(self):
+        changed = models.Thread.objects.mark_read(
+            self.third_user, [self.subscribed_thread.pk])
+        self.assertEqual(changed, 1)
+        self.assertEqual(
+            list(models.Thread.objects.unread_threads(self.third_user)),
+            [self.direct_thread]
+        )
+        self.assertIn(
+            self.subscribed_thread,
+            models.Thread.objects.unread_threads(self.first_user)
+        )
+
+    def test_mark_unread(self):
+        models.Thread.objects.mark_read(self.first_user)
+        with self.assertNumQueries(2):
+            models.Thread.objects.mark_unread(
+                self.first_user,
+                [self.direct_thread.pk, self.subscribed_thread.pk]
+            )
+        self.assertEqual(
+            sorted(models.Thread.objects.unread_threads(
+                self.first_user).values_list("pk", flat=True)),
+            [self.direct_thread.pk, self.subscribed_thread.pk]
+        )
+
+    def test_delete_threads(self):
+        models.Thread.objects.delete_threads(self.first_user)
+        self.assertEqual(
+            list(models.Thread.objects.active_threads(self.first_user)), [])
+        for user in (self.second_user, self.third_user):
+            self.assertIn(
+                self.direct_thread,
+                models.Thread.objects.active_threads(user)
+            )
+        self.assertIn(
+            self.subscribed_thread,
+            models.Thread.objects.active_threads(self.third_user)
+        )
+
+    def test_inaccessible_threads_are_left_alone(self):
+        thread_ids = [self.direct_thread.pk, self.group_thread.pk,
+                      self.subscribed_thread.pk]
+        self.assertEqual(
+            models.Thread.objects.delete_threads(self.fifth_user, thread_ids),
+            0
+        )
+        models.Thread.objects.delete_threads(
+            self.first_user, [self.direct_thread.pk])
+        self.assertEqual(
+            models.Thread.objects.mark_read(
+                self.first_user, [self.direct_thread.pk]),
+            0
+        )
+        self.assertTrue(self.direct_thread.userthread_set.get(
+            user=self.first_user).unread)
+
 
 class MessageManagerSingleUsersTestCase(Base):
 
@@ -206,6 +502,12 @@ class MessageManagerSingleUsersTestCase(Base):
     def test_new_message_has_content(self):
         self.assertEqual(self.message.content, self.test_content)
 
+    def test_new_message_updates_thread_last_message(self):
+        thread = models.Thread.objects.get(pk=self.message.thread.pk)
+        self.assertEqual(thread.last_message, self.message)
+        self.assertEqual(thread.last_message_at, self.message.sent_at)
+        self.assertEqual(thread.message_count, 1)
+
     def test_new_message_sender_visibility_is_read(self):
         user_thread = self.message.sender.userthread_set.get(
             thread=self.message.thread)
@@ -277,6 +579,99 @@ class MessageManagerSingleUsersReplyTestCase(Base):
         for user_thread in self.reply.thread.userthread_set.all():
             self.assertFalse(user_thread.deleted)
 
+    def test_new_reply_restores_deleted_thread(self):
+        thread = self.message.thread
+        thread.userthread_set.filter(user=self.second_user).update(
+            deleted=True, read_sequence=2)
+        models.Message.objects.new_reply(thread, self.sender, "again")
+        self.assertEqual(
+            sorted(thread.userthread_set.values_list(
+                "user", "read_sequence", "deleted")),
+            [(self.first_user.id, 3, False),
+             (self.second_user.id, 2, False),
+             (self.third_user.id, 2, False)]
+        )
+        self.assertIn(
+            thread, models.Thread.objects.unread_threads(self.second_user))
+
+    def test_new_reply_only_writes_changed_states(self):
+        thread = self.message.thread
+        # the sender's record is the only one to change
+        self.assertEqual(
+            managers._update_reply_states(
+                thread.userthread_set, self.reply_sender, 2),
+            0
+        )
+        thread.userthread_set.filter(user=self.third_user).update(
+            deleted=True)
+        self.assertEqual(
+            managers._update_reply_states(
+                thread.userthread_set, self.second_user, 2),
+            2
+        )
+
+    def test_new_reply_increments_thread_sequence(self):
+        thread = models.Thread.objects.get(pk=self.message.thread.pk)
+        self.assertEqual(thread.sequence, 2)
+        # only the sender's record has been written
+        self.assertEqual(
+            sorted(thread.userthread_set.values_list(
+                "user", "read_sequence")),
+            [(self.first_user.id, 1),
+             (self.second_user.id, 0),
+             (self.third_user.id, 2)]
+        )
+
+    def test_new_reply_with_stale_thread(self):
+        stale = models.Thread.objects.get(pk=self.message.thread.pk)
+        models.Message.objects.new_reply(
+            models.Thread.objects.get(pk=stale.pk), self.second_user, "one")
+        models.Message.objects.new_reply(stale, self.sender, "two")
+        self.assertEqual(stale.sequence, 4)
+        self.assertEqual(stale.message_count, 4)
+        self.assertEqual(
+            stale.userthread_set.get(user=self.sender).read_sequence, 4)
+        self.assertNotIn(
+            stale, models.Thread.objects.unread_threads(self.sender))
+
+    def test_new_reply_updates_thread_last_message(self):
+        thread = models.Thread.objects.get(pk=self.message.thread.pk)
+        self.assertEqual(thread.last_message, self.reply)
+        self.assertEqual(thread.last_message_at, self.reply.sent_at)
+        self.assertEqual(thread.message_count, 2)
+
+    def test_messages_page(self):
+        second_reply = models.Message.objects.new_reply(
+            thread=self.message.thread,
+            user=self.sender,
+            content="second reply"
+        )
+        with self.assertNumQueries(1):
+            latest_page = models.Message.objects.messages_page(
+                self.message.thread, page_size=2)
+            self.assertEqual(
+                [message.sender for message in latest_page],
+                [self.reply_sender, self.sender]
+            )
+        self.assertEqual(list(latest_page), [self.reply, second_reply])
+        self.assertTrue(latest_page.has_next)
+        self.assertFalse(latest_page.has_previous)
+        older_page = models.Message.objects.messages_page(
+            self.message.thread, cursor=latest_page.next_cursor, page_size=2)
+        self.assertEqual(list(older_page), [self.message])
+        self.assertFalse(older_page.has_next)
+        self.assertTrue(older_page.has_previous)
+        newer_page = models.Message.objects.messages_page(
+            self.message.thread, cursor=older_page.previous_cursor,
+            page_size=2
+        )
+        self.assertEqual(list(newer_page), [self.reply, second_reply])
+
+    def test_messages_page_size_setting(self):
+        with self.settings(USER_MESSAGES_THREAD_PAGE_SIZE=1):
+            page = models.Message.objects.messages_page(self.message.thread)
+        self.assertEqual(list(page), [self.reply])
+
 
 class MessageManagerGroupsTestCase(Base):
     """Tests for when messages are sent to groups"""
@@ -330,3 +725,117 @@ class MessageManagerGroupsTestCase(Base):
     def test_new_message_is_not_deleted_for_any_recipient(self):
         for member_thread in self.message.thread.groupmemberthread_set.all():
             self.assertFalse(member_thread.deleted)
+
+    def test_new_message_group_fan_out_query_count(self):
+        with CaptureQueriesContext(connection) as single_group:
+            models.Message.objects.new_message(
+                from_user=self.sender,
+                subject=self.test_subject,
+                content=self.test_content,
+                to_groups=[self.first_group_profile]
+            )
+        with CaptureQueriesContext(connection) as multiple_groups:
+            models.Message.objects.new_message(
+                from_user=self.sender,
+                subject=self.test_subject,
+                content=self.test_content,
+                to_groups=self.to_groups
+            )
+        self.assertEqual(
+            len(single_group.captured_queries),
+            len(multiple_groups.captured_queries)
+        )
+
+    def test_new_reply_does_not_read_group_members(self):
+        with CaptureQueriesContext(connection) as queries:
+            models.Message.objects.new_reply(
+                self.message.thread, self.second_user, "reply")
+        self.assertEqual([
+            query["sql"] for query in queries.captured_queries
+            if query["sql"].startswith("SELECT") and
+            "groupmemberthread" in query["sql"]
+        ], [])
+
+    def test_new_message_group_fan_out_in_batches(self):
+        with self.settings(USER_MESSAGES_FANOUT_BATCH_SIZE=1):
+            message = models.Message.objects.new_message(
+                from_user=self.sender,
+                subject=self.test_subject,
+                content=self.test_content,
+                to_groups=self.to_groups
+            )
+        self.assertEqual(
+            sorted(message.thread.groupmemberthread_set.values_list(
+                "group", "user", "read_sequence")),
+            sorted(self.message.thread.groupmemberthread_set.values_list(
+                "group", "user", "read_sequence"))
+        )
+
+    def test_new_message_deferred_fan_out(self):
+        with self.settings(USER_MESSAGES_DEFERRED_FANOUT_THRESHOLD=1):
+            with mock.patch.object(fanout, "_get_executor") as mock_executor:
+                with self.captureOnCommitCallbacks(execute=True):
+                    message = models.Message.objects.new_message(
+                        from_user=self.sender,
+                        subject=self.test_subject,
+                        content=self.test_content,
+                        to_groups=self.to_groups
+                    )
+        thread = message.thread
+        self.assertEqual(thread.fanout_status, models.Thread.FANOUT_PENDING)
+        self.assertEqual(thread.groupmemberthread_set.count(), 0)
+        self.assertEqual(
+            set(thread.fanoutgroup_set.values_list("group", flat=True)),
+            set(group_profile.group_id for group_profile in self.to_groups)
+        )
+        self.assertTrue(mock_executor.return_value.submit.called)
+        fanout.run_group_fanout(thread.pk, self.sender, self.to_groups)
+        thread.refresh_from_db()
+        self.assertEqual(thread.fanout_status, models.Thread.FANOUT_COMPLETE)
+        self.assertEqual(
+            sorted(thread.groupmemberthread_set.values_list(
+                "group", "user", "read_sequence")),
+            sorted(self.message.thread.groupmemberthread_set.values_list(
+                "group", "user", "read_sequence"))
+        )
+
+    def test_resume_group_fanouts(self):
+        with self.settings(USER_MESSAGES_DEFERRED_FANOUT_THRESHOLD=1):
+            with mock.patch.object(fanout, "_get_executor"):
+                with self.captureOnCommitCallbacks(execute=True):
+                    message = models.Message.objects.new_message(
+                        from_user=self.sender,
+                        subject=self.test_subject,
+                        content=self.test_content,
+                        to_groups=self.to_groups
+                    )
+        thread = message.thread
+        models.Thread.objects.filter(pk=thread.pk).update(
+            fanout_status=models.Thread.FANOUT_FAILED)
+        stdout = StringIO()
+        call_command("user_messages_resume_fanouts", stdout=stdout)
+        self.assertIn("Completed 1 fan-outs", stdout.getvalue())
+        thread.refresh_from_db()
+        self.assertEqual(thread.fanout_status, models.Thread.FANOUT_COMPLETE)
+        self.assertEqual(
+            sorted(thread.groupmemberthread_set.values_list(
+                "group", "user", "read_sequence")),
+            sorted(self.message.thread.groupmemberthread_set.values_list(
+                "group", "user", "read_sequence"))
+        )
+
+    def test_new_message_fan_out_failure(self):
+        message = models.Message.objects.new_message(
+            from_user=self.sender,
+            subject=self.test_subject,
+            content=self.test_content,
+            to_users=[self.second_user]
+        )
+        thread = message.thread
+        thread.fanout_status = models.Thread.FANOUT_PENDING
+        thread.save()
+        with mock.patch.object(fanout, "add_group_members",
+                               side_effect=RuntimeError):
+            fanout.run_group_fanout(thread.pk, self.sender, self.to_groups)
+        thread.refresh_from_db()
+        self.assertEqual(thread.fanout_status, models.Thread.FANOUT_FAILED)
@@ -1,6 +1,9 @@
 """Unit tests for user_messages.models."""
 
+from unittest import skipUnless
+
 from django.contrib.auth import get_user_model
+from django.db import connection
 from django.urls import reverse
 from django.test import TestCase
 
@@ -111,6 +114,23 @@ class ThreadSingleUserTestCase(ThreadBase):
     def test_num_users(self):
         self.assertEqual(self.first_thread.num_users, 2)
 
+    def test_with_unread(self):
+        with self.assertNumQueries(1):
+            states = list(models.UserThread.objects.filter(
+                thread=self.first_thread).with_unread().order_by("user"))
+            self.assertEqual(
+                [(state.user_id, state.unread) for state in states],
+                [(self.first_user.id, True), (self.second_user.id, False)]
+            )
+        self.assertEqual(
+            list(models.UserThread.objects.with_unread().filter(
+                unread=True).values_list("user", flat=True)),
+            [self.first_user.id]
+        )
+        state = models.UserThread.objects.get(
+            thread=self.first_thread, user=self.first_user)
+        self.assertTrue(state.unread)
+
 
 class ThreadMultiUserTestCase(ThreadBase):
 
@@ -227,3 +247,63 @@ class ThreadMixGroupAndSingleUserTestCase(ThreadBase):
 
     def test_num_users(self):
         self.assertEqual(self.first_thread.num_users, 2)
+
+
+@skipUnless(connection.vendor == "sqlite", "query plans are SQLite specific")
+class IndexesTestCase(ThreadBase):
+    """Check that the inbox queries are able to use the composite indexes"""
+
+    def setUp(self):
+        super(IndexesTestCase, self).setUp()
+        self.first_message = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="first message of the first thread",
+            content="test",
+            to_users=[self.second_user],
+            to_groups=[self.first_group_profile],
+        )
+        models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="first message of the second thread",
+            content="test",
+            to_groups=[self.second_group_profile],
+            subscribe_groups=True
+        )
+        self.first_thread = self.first_message.thread
+
+    def assertUsesIndex(self, queryset, index_name):
+        self.assertIn(index_name, queryset.explain())
+
+    def test_user_thread_state_index(self):
+        self.assertUsesIndex(
+            models.UserThread.objects.filter(
+                user=self.second_user, deleted=False, read_sequence__lt=1
+            ).values("thread"),
+            "um_userthread_user_"
+        )
+
+    def test_group_member_thread_state_index(self):
+        self.assertUsesIndex(
+            models.GroupMemberThread.objects.filter(
+                user=self.second_user, deleted=False, read_sequence__lt=1
+            ).values("thread"),
+            "um_gmthread_user_"
+        )
+
+    def test_latest_message_index(self):
+        self.assertUsesIndex(
+            self.first_thread.messages.order_by("-sent_at")[:1],
+            "um_message_thread_sent_idx"
+        )
+
+    def test_group_subscription_indexes(self):
+        queryset = models.Thread.objects.unread_threads(self.third_user)
+        self.assertUsesIndex(queryset, "um_groupthread_group_idx")
+        self.assertUsesIndex(queryset, "um_gmthread_thread_member_idx")
+
+    def test_thread_manager_queries_use_user_indexes(self):
+        for queryset in (
+                models.Thread.objects.active_threads(self.second_user),
+                models.Thread.objects.unread_threads(self.second_user)):
+            self.assertUsesIndex(queryset, "um_userthread_user_")
+            self.assertUsesIndex(queryset, "um_gmthread_user_")
@@ -0,0 +1,419 @@
+"""Query budgets of the views and manager methods of user_messages.
+
+Every entry point is measured against two datasets of different sizes. The
+number of queries must be the same for both of them, so that any query
+running once per thread, message or participant is caught, and must not
+exceed the budget of the entry point.
+
+"""
+
+from collections import namedtuple
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from geonode.groups.models import GroupProfile
+
+from user_messages import models
+from user_messages.context_processors import user_messages
+from user_messages.templatetags import user_messages_tags
+
+DATASET_SIZES = (3, 12)
+
+QUERY_BUDGETS = {
+    "inbox": 6,
+    "thread_detail_get": 10,
+    "thread_detail_get_read": 5,
+    "thread_messages": 6,
+    "thread_detail_post": 14,
+    "thread_delete": 8,
+    "message_create_get": 12,
+    "message_create_get_cached": 10,
+    "message_create_post": 17,
+    "api_inbox": 4,
+    "api_inbox_not_modified": 2,
+    "api_thread_messages": 5,
+    "api_unread_count": 4,
+    "api_recipients": 3,
+    "context_processor": 2,
+    "context_processor_cached": 0,
+    "active_threads": 1,
+    "unread_threads": 1,
+    "sorted_active_threads": 1,
+    "sorted_unread_threads": 1,
+    "active_threads_page": 1,
+    "unread_threads_page": 1,
+    "with_user_state": 1,
+    "with_latest_message": 1,
+    "messages_page": 1,
+    "new_message": 11,
+    "new_message_subscribed": 11,
+    "new_reply": 11,
+    "new_reply_subscribed": 13,
+}
+
+Dataset = namedtuple("Dataset", [
+    "users", "sender", "reader", "group_profile", "group_thread",
+    "subscribed_thread",
+])
+
+
+class QueryBudgetsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def create_dataset(self, size):
+        """Create ``size`` direct threads and two group threads.
+
+        The reader takes part in all of them and every group thread has
+        ``size + 2`` participants and ``size + 1`` messages.
+
+        """
+
+        users = [
+            get_user_model().objects.create_user(
+                "budget_{}_{}".format(size, index),
+                "budget_{}_{}@fakemail.com".format(size, index),
+                "pass"
+            ) for index in range(size + 2)
+        ]
+        group_profile = GroupProfile.objects.create(
+            title="budget {}".format(size),
+            slug="budget-{}".format(size),
+            description="budget",
+            access="public",
+        )
+        for user in users:
+            group_profile.join(user)
+        sender = users[0]
+        for index in range(size):
+            models.Message.objects.new_message(
+                sender, "direct {}".format(index), "test", to_users=users[1:])
+        group_thread = models.Message.objects.new_message(
+            sender, "group", "test", to_groups=[group_profile]).thread
+        subscribed_thread = models.Message.objects.new_message(
+            sender, "subscribed", "test", to_groups=[group_profile],
+            subscribe_groups=True
+        ).thread
+        for thread in (group_thread, subscribed_thread):
+            for user in users[2:]:
+                models.Message.objects.new_reply(thread, user, "reply")
+        return Dataset(
+            users=users,
+            sender=sender,
+            reader=users[1],
+            group_profile=group_profile,
+            group_thread=group_thread,
+            subscribed_thread=subscribed_thread,
+        )
+
+    def assertQueryBudget(self, name, func, prepare=None):
+        """Run ``func`` against both datasets and check its queries.
+
+        ``func`` and ``prepare`` receive the dataset as their only argument.
+        ``prepare`` runs before the queries are captured.
+
+        """
+
+        counts = []
+        for size in DATASET_SIZES:
+            data = self.create_dataset(size)
+            cache.clear()
+            if prepare is not None:
+                prepare(data)
+            with CaptureQueriesContext(connection) as queries:
+                func(data)
+            counts.append(len(queries))
+        self.assertEqual(
+            counts[0], counts[-1],
+            "{} runs {} queries with {} and {} with {}: {}".format(
+                name, counts[0], DATASET_SIZES[0], counts[-1],
+                DATASET_SIZES[-1],
+                "\n".join(query["sql"] for query in queries.captured_queries)
+            )
+        )
+        self.assertLessEqual(
+            counts[-1], QUERY_BUDGETS[name],
+            "{} runs {} queries, its budget is {}".format(
+                name, counts[-1], QUERY_BUDGETS[name])
+        )
+
+    def login(self, data):
+        self.client.force_login(data.reader)
+
+    # views
+
+    def test_inbox(self):
+        def func(data):
+            response = self.client.get(reverse("messages_inbox"))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget("inbox", func, prepare=self.login)
+
+    def test_thread_detail_get(self):
+        def func(data):
+            response = self.client.get(reverse(
+                "messages_thread_detail", args=(data.group_thread.pk,)))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget("thread_detail_get", func, prepare=self.login)
+
+    def test_thread_detail_get_subscribed(self):
+        def func(data):
+            response = self.client.get(reverse(
+                "messages_thread_detail", args=(data.subscribed_thread.pk,)))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget("thread_detail_get", func, prepare=self.login)
+
+    def assertReadThreadDetailBudget(self, get_thread):
+        """Check that showing a thread that is already read only reads."""
+        def prepare(data):
+            self.login(data)
+            self.client.get(reverse(
+                "messages_thread_detail", args=(get_thread(data).pk,)))
+
+        def func(data):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse(
+                    "messages_thread_detail", args=(get_thread(data).pk,)))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([
+                query["sql"] for query in queries.captured_queries
+                if not query["sql"].startswith("SELECT")
+            ], [])
+
+        self.assertQueryBudget("thread_detail_get_read", func, prepare)
+
+    def test_thread_detail_get_read(self):
+        self.assertReadThreadDetailBudget(lambda data: data.group_thread)
+
+    def test_thread_detail_get_read_subscribed(self):
+        self.assertReadThreadDetailBudget(lambda data: data.subscribed_thread)
+
+    def test_thread_messages(self):
+        cursors = {}
+
+        def prepare(data):
+            self.login(data)
+            page = models.Message.objects.messages_page(
+                data.group_thread, page_size=1)
+            cursors[data.group_thread.pk] = page.next_cursor
+
+        def func(data):
+            response = self.client.get(
+                reverse("messages_thread_messages",
+                        args=(data.group_thread.pk,)),
+                {"cursor": cursors[data.group_thread.pk]}
+            )
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget("thread_messages", func, prepare=prepare)
+
+    def test_thread_detail_post(self):
+        def func(data):
+            response = self.client.post(
+                reverse("messages_thread_detail",
+                        args=(data.group_thread.pk,)),
+                {"content": "budget"}
+            )
+            self.assertEqual(response.status_code, 302)
+        self.assertQueryBudget("thread_detail_post", func, prepare=self.login)
+
+    def test_thread_delete(self):
+        def func(data):
+            response = self.client.post(reverse(
+                "messages_thread_delete", args=(data.group_thread.pk,)))
+            self.assertEqual(response.status_code, 302)
+        self.assertQueryBudget("thread_delete", func, prepare=self.login)
+
+    def test_message_create_get(self):
+        def func(data):
+            response = self.client.get(reverse("message_create"))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget("message_create_get", func, prepare=self.login)
+
+    def test_message_create_get_cached(self):
+        def func(data):
+            response = self.client.get(reverse("message_create"))
+            self.assertEqual(response.status_code, 200)
+
+        def prepare(data):
+            self.login(data)
+            func(data)
+
+        self.assertQueryBudget(
+            "message_create_get_cached", func, prepare=prepare)
+
+    def test_message_create_post(self):
+        def func(data):
+            response = self.client.post(reverse("message_create"), {
+                "to_users": [user.pk for user in data.users[2:]],
+                "to_groups": [data.group_profile.pk],
+                "subject": "budget",
+                "content": "budget",
+            })
+            self.assertEqual(response.status_code, 302)
+        self.assertQueryBudget("message_create_post", func, prepare=self.login)
+
+    def test_api_inbox(self):
+        def func(data):
+            response = self.client.get(reverse("messages_api_inbox"))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget("api_inbox", func, prepare=self.login)
+
+    def test_api_inbox_not_modified(self):
+        etags = {}
+
+        def prepare(data):
+            self.login(data)
+            response = self.client.get(reverse("messages_api_inbox"))
+            etags[data.reader.pk] = response["ETag"]
+
+        def func(data):
+            response = self.client.get(
+                reverse("messages_api_inbox"),
+                HTTP_IF_NONE_MATCH=etags[data.reader.pk]
+            )
+            self.assertEqual(response.status_code, 304)
+        self.assertQueryBudget(
+            "api_inbox_not_modified", func, prepare=prepare)
+
+    def test_api_thread_messages(self):
+        def func(data):
+            response = self.client.get(reverse(
+                "messages_api_thread_messages",
+                args=(data.group_thread.pk,)
+            ))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget("api_thread_messages", func, prepare=self.login)
+
+    def test_api_unread_count(self):
+        def func(data):
+            response = self.client.get(reverse("messages_api_unread_count"))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget("api_unread_count", func, prepare=self.login)
+
+    def test_api_recipients(self):
+        def func(data):
+            response = self.client.get(reverse("messages_api_recipients"))
+            self.assertEqual(response.status_code, 200)
+        self.assertQueryBudget("api_recipients", func, prepare=self.login)
+
+    def test_context_processor(self):
+        def func(data):
+            request = RequestFactory().get("/")
+            request.user = data.reader
+            self.assertEqual(
+                user_messages(request)["inbox_count"], len(data.users))
+        self.assertQueryBudget("context_processor", func)
+
+    def test_context_processor_cached(self):
+        def func(data):
+            request = RequestFactory().get("/")
+            request.user = data.reader
+            self.assertEqual(
+                user_messages(request)["inbox_count"], len(data.users))
+        self.assertQueryBudget(
+            "context_processor_cached", func, prepare=func)
+
+    # ThreadManager
+
+    def test_active_threads(self):
+        self.assertQueryBudget(
+            "active_threads",
+            lambda data: list(
+                models.Thread.objects.active_threads(data.reader))
+        )
+
+    def test_unread_threads(self):
+        self.assertQueryBudget(
+            "unread_threads",
+            lambda data: list(
+                models.Thread.objects.unread_threads(data.reader))
+        )
+
+    def test_sorted_active_threads(self):
+        self.assertQueryBudget(
+            "sorted_active_threads",
+            lambda data: list(
+                models.Thread.objects.sorted_active_threads(data.reader))
+        )
+
+    def test_sorted_unread_threads(self):
+        self.assertQueryBudget(
+            "sorted_unread_threads",
+            lambda data: list(
+                models.Thread.objects.sorted_unread_threads(data.reader))
+        )
+
+    def test_active_threads_page(self):
+        def func(data):
+            for thread in models.Thread.objects.active_threads_page(
+                    data.reader):
+                user_messages_tags.unread(thread, data.reader)
+                thread.latest_message.sender.username
+        self.assertQueryBudget("active_threads_page", func)
+
+    def test_unread_threads_page(self):
+        def func(data):
+            for thread in models.Thread.objects.unread_threads_page(
+                    data.reader):
+                user_messages_tags.unread(thread, data.reader)
+                thread.latest_message.sender.username
+        self.assertQueryBudget("unread_threads_page", func)
+
+    def test_with_user_state(self):
+        def func(data):
+            for thread in models.Thread.objects.all().with_user_state(
+                    data.reader):
+                thread.user_unread
+                thread.user_deleted
+        self.assertQueryBudget("with_user_state", func)
+
+    def test_with_latest_message(self):
+        def func(data):
+            for thread in models.Thread.objects.all().with_latest_message():
+                if thread.latest_message is not None:
+                    thread.latest_message.sender.username
+        self.assertQueryBudget("with_latest_message", func)
+
+    # MessageManager
+
+    def test_messages_page(self):
+        def func(data):
+            for message in models.Message.objects.messages_page(
+                    data.group_thread):
+                message.sender.username
+        self.assertQueryBudget("messages_page", func)
+
+    def test_new_message(self):
+        self.assertQueryBudget(
+            "new_message",
+            lambda data: models.Message.objects.new_message(
+                data.sender, "budget", "budget",
+                to_users=data.users[1:], to_groups=[data.group_profile])
+        )
+
+    def test_new_message_subscribed(self):
+        self.assertQueryBudget(
+            "new_message_subscribed",
+            lambda data: models.Message.objects.new_message(
+                data.sender, "budget", "budget",
+                to_groups=[data.group_profile], subscribe_groups=True)
+        )
+
+    def test_new_reply(self):
+        self.assertQueryBudget(
+            "new_reply",
+            lambda data: models.Message.objects.new_reply(
+                data.group_thread, data.reader, "budget")
+        )
+
+    def test_new_reply_subscribed(self):
+        self.assertQueryBudget(
+            "new_reply_subscribed",
+            lambda data: models.Message.objects.new_reply(
+                data.subscribed_thread, data.reader, "budget")
+        )
@@ -0,0 +1,174 @@
+"""Unit tests for user_messages.retention"""
+
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+import mock
+
+from user_messages import counters
+from user_messages import models
+from user_messages import retention
+
+
+class RetentionTestCase(TestCase):
+
+    def setUp(self):
+        self.first_user = get_user_model().objects.create_user(
+            "first", "first@fakemail.com", "pass")
+        self.second_user = get_user_model().objects.create_user(
+            "second", "second@fakemail.com", "pass")
+        self.third_user = get_user_model().objects.create_user(
+            "third", "third@fakemail.com", "pass")
+        self.group = Group.objects.create(name="retention")
+        self.group.user_set.add(self.first_user, self.third_user)
+        self.direct_thread = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="direct",
+            content="direct message",
+            to_users=[self.second_user],
+        ).thread
+        models.Message.objects.new_reply(
+            self.direct_thread, self.second_user, "reply")
+        self.group_thread = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="group",
+            content="group message",
+            to_groups=[mock.Mock(group_id=self.group.pk)],
+            subscribe_groups=True,
+        ).thread
+
+    def delete_thread(self, thread, user):
+        thread.userthread_set.filter(user=user).update(deleted=True)
+        thread.groupmemberthread_set.filter(user=user).update(deleted=True)
+        models.GroupMemberThread.objects.bulk_create([
+            models.GroupMemberThread(
+                thread=thread, group_id=group_id, user=user, deleted=True)
+            for group_id in thread.groupthread_set.exclude(
+                group__in=thread.groupmemberthread_set.filter(
+                    user=user).values("group")
+            ).filter(group__user=user).values_list("group", flat=True)
+        ])
+
+    def age_thread(self, thread, days):
+        models.Thread.objects.filter(pk=thread.pk).update(
+            last_message_at=timezone.now() - timedelta(days=days))
+
+    def test_deleted_threads(self):
+        self.delete_thread(self.direct_thread, self.first_user)
+        self.assertEqual(list(retention.deleted_threads()), [])
+        self.delete_thread(self.direct_thread, self.second_user)
+        self.assertEqual(
+            list(retention.deleted_threads()), [self.direct_thread])
+
+    def test_deleted_subscribed_threads(self):
+        self.delete_thread(self.group_thread, self.first_user)
+        # the third user has no state record, but still sees the thread
+        self.assertEqual(list(retention.deleted_threads()), [])
+        self.delete_thread(self.group_thread, self.third_user)
+        self.assertEqual(
+            list(retention.deleted_threads()), [self.group_thread])
+
+    def test_pending_threads_are_not_deleted(self):
+        self.delete_thread(self.direct_thread, self.first_user)
+        self.delete_thread(self.direct_thread, self.second_user)
+        models.Thread.objects.filter(pk=self.direct_thread.pk).update(
+            fanout_status=models.Thread.FANOUT_PENDING)
+        self.assertEqual(list(retention.deleted_threads()), [])
+
+    def test_purgeable_threads(self):
+        self.delete_thread(self.direct_thread, self.first_user)
+        self.delete_thread(self.direct_thread, self.second_user)
+        self.assertEqual(
+            list(retention.purgeable_threads()), [self.direct_thread])
+        self.assertEqual(
+            list(retention.purgeable_threads(deleted_days=30)), [])
+        self.age_thread(self.direct_thread, 31)
+        self.assertEqual(
+            list(retention.purgeable_threads(deleted_days=30)),
+            [self.direct_thread]
+        )
+
+    def test_purgeable_expired_threads(self):
+        self.age_thread(self.group_thread, 100)
+        self.assertEqual(list(retention.purgeable_threads()), [])
+        self.assertEqual(
+            list(retention.purgeable_threads(expired_days=90)),
+            [self.group_thread]
+        )
+        with self.settings(USER_MESSAGES_RETENTION_DAYS=90):
+            self.assertEqual(
+                list(retention.purgeable_threads()), [self.group_thread])
+
+    def test_purge_threads(self):
+        self.delete_thread(self.direct_thread, self.first_user)
+        self.delete_thread(self.direct_thread, self.second_user)
+        purged = retention.purge_threads()
+        self.assertEqual(purged, 1)
+        self.assertEqual(
+            list(models.Thread.objects.all()), [self.group_thread])
+        self.assertFalse(models.Message.objects.filter(
+            thread=self.direct_thread.pk).exists())
+        self.assertFalse(models.UserThread.objects.filter(
+            thread=self.direct_thread.pk).exists())
+        self.assertEqual(
+            list(models.Message.objects.search(self.first_user, "direct")),
+            []
+        )
+
+    def test_purge_threads_in_chunks(self):
+        self.age_thread(self.direct_thread, 100)
+        self.age_thread(self.group_thread, 100)
+        progress = mock.Mock()
+        purged = retention.purge_threads(
+            retention.purgeable_threads(expired_days=90),
+            chunk_size=1,
+            progress=progress
+        )
+        self.assertEqual(purged, 2)
+        self.assertEqual(
+            progress.call_args_list, [mock.call(1), mock.call(2)])
+        self.assertFalse(models.Thread.objects.exists())
+        self.assertFalse(models.GroupThread.objects.exists())
+        self.assertFalse(models.GroupMemberThread.objects.exists())
+
+    def test_purge_threads_invalidates_counters(self):
+        cache.clear()
+        self.assertEqual(counters.get_unread_count(self.first_user), 1)
+        self.age_thread(self.direct_thread, 100)
+        with self.captureOnCommitCallbacks(execute=True):
+            retention.purge_threads(
+                retention.purgeable_threads(expired_days=90))
+        self.assertEqual(counters.get_unread_count(self.first_user), 0)
+
+    def test_purge_command(self):
+        self.delete_thread(self.direct_thread, self.first_user)
+        self.delete_thread(self.direct_thread, self.second_user)
+        stdout = StringIO()
+        call_command("user_messages_purge_threads", dry_run=True,
+                     stdout=stdout)
+        self.assertIn("1 threads would be purged", stdout.getvalue())
+        self.assertTrue(models.Thread.objects.filter(
+            pk=self.direct_thread.pk).exists())
+        stdout = StringIO()
+        call_command("user_messages_purge_threads", stdout=stdout)
+        self.assertIn("Purged 1/1 threads", stdout.getvalue())
+        self.assertFalse(models.Thread.objects.filter(
+            pk=self.direct_thread.pk).exists())
+
+    def test_purge_threads_query_count(self):
+        # one query per table, however many messages the thread has
+        for index in range(50):
+            models.Message.objects.new_reply(
+                self.direct_thread, self.second_user, "reply")
+        self.age_thread(self.direct_thread, 100)
+        with self.assertNumQueries(22):
+            retention.purge_threads(models.Thread.objects.filter(
+                pk=self.direct_thread.pk))
+        self.assertFalse(models.Message.objects.filter(
+            thread=self.direct_thread.pk).exists())
@@ -0,0 +1,161 @@
+"""Unit tests for user_messages.search"""
+
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+import mock
+
+from user_messages import models
+from user_messages import search
+
+
+class SearchTestCase(TestCase):
+
+    def setUp(self):
+        self.first_user = get_user_model().objects.create_user(
+            "first", "first@fakemail.com", "pass")
+        self.second_user = get_user_model().objects.create_user(
+            "second", "second@fakemail.com", "pass")
+        self.third_user = get_user_model().objects.create_user(
+            "third", "third@fakemail.com", "pass")
+        self.first_message = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="quarterly report",
+            content="the figures are attached",
+            to_users=[self.second_user],
+        )
+        self.first_thread = self.first_message.thread
+        self.first_reply = models.Message.objects.new_reply(
+            self.first_thread, self.second_user,
+            "thanks, I will read the report tonight"
+        )
+        self.other_message = models.Message.objects.new_message(
+            from_user=self.first_user,
+            subject="lunch",
+            content="the report can wait",
+            to_users=[self.third_user],
+        )
+
+    def test_search_ranks_messages(self):
+        page = models.Message.objects.search(self.first_user, "report")
+        # the subject weighs more than the content, shorter messages rank
+        # higher
+        self.assertEqual(
+            list(page),
+            [self.first_message, self.other_message, self.first_reply]
+        )
+        self.assertGreater(page[0].rank, page[1].rank)
+        self.assertFalse(page.has_next)
+
+    def test_search_matches_all_terms(self):
+        page = models.Message.objects.search(
+            self.first_user, "report tonight")
+        self.assertEqual(list(page), [self.first_reply])
+
+    def test_search_is_scoped_to_active_threads(self):
+        page = models.Message.objects.search(self.second_user, "report")
+        self.assertEqual(
+            list(page), [self.first_message, self.first_reply])
+        self.first_thread.userthread_set.filter(
+            user=self.second_user).update(deleted=True)
+        page = models.Message.objects.search(self.second_user, "report")
+        self.assertEqual(list(page), [])
+
+    def test_search_pagination(self):
+        first_page = models.Message.objects.search(
+            self.first_user, "report", page_size=2)
+        self.assertEqual(len(first_page), 2)
+        self.assertTrue(first_page.has_next)
+        self.assertEqual(first_page.next_page_number, 2)
+        second_page = models.Message.objects.search(
+            self.first_user, "report", page=2, page_size=2)
+        self.assertEqual(list(second_page), [self.first_reply])
+        self.assertFalse(second_page.has_next)
+        self.assertEqual(second_page.previous_page_number, 1)
+
+    def test_search_quotes_operators(self):
+        search_messages = models.Message.objects.search
+        self.assertEqual(
+            list(search_messages(self.first_user, "report OR lunch")), [])
+        self.assertEqual(list(search_messages(self.first_user, "NOT")), [])
+        self.assertEqual(
+            len(search_messages(self.first_user, "report*")), 3)
+        self.assertEqual(
+            len(search_messages(self.first_user, 'report"')), 3)
+        self.assertEqual(list(search_messages(self.first_user, "   ")), [])
+
+    def test_search_queries(self):
+        with self.assertNumQueries(2):
+            page = models.Message.objects.search(self.first_user, "report")
+            for message in page:
+                message.sender.username
+                message.thread.subject
+
+    def test_search_without_index(self):
+        with mock.patch.object(search, "get_backend", return_value=None):
+            page = models.Message.objects.search(self.first_user, "report")
+        self.assertEqual(
+            list(page),
+            [self.other_message, self.first_reply, self.first_message]
+        )
+        self.assertIsNone(page[0].rank)
+
+    def test_reindex_message(self):
+        self.first_message.content = "the figures are missing"
+        self.first_message.save()
+        search.reindex_message(self.first_message)
+        self.assertEqual(
+            list(models.Message.objects.search(self.first_user, "missing")),
+            [self.first_message]
+        )
+        self.assertEqual(
+            list(models.Message.objects.search(self.first_user, "attached")),
+            []
+        )
+        self.assertEqual(
+            list(models.Message.objects.search(self.first_user, "quarterly")),
+            [self.first_message]
+        )
+        search.reindex_message(self.first_reply)
+        self.assertEqual(
+            list(models.Message.objects.search(self.first_user, "quarterly")),
+            [self.first_message]
+        )
+
+    def test_rebuild_search_index(self):
+        search.get_backend().clear()
+        self.assertEqual(
+            list(models.Message.objects.search(self.first_user, "report")),
+            []
+        )
+        stdout = StringIO()
+        call_command(
+            "user_messages_rebuild_search_index", chunk_size=2, stdout=stdout)
+        self.assertIn("Indexed 2/3 messages", stdout.getvalue())
+        self.assertEqual(
+            list(models.Message.objects.search(self.first_user, "report")),
+            [self.first_message, self.other_message, self.first_reply]
+        )
+        # the subject is only indexed with the first message of a thread
+        self.assertEqual(
+            list(models.Message.objects.search(self.first_user, "quarterly")),
+            [self.first_message]
+        )
+
+    def test_prune_search_index(self):
+        # deletes the reply along with its sender
+        self.second_user.delete()
+        stdout = StringIO()
+        call_command(
+            "user_messages_rebuild_search_index", prune=True, stdout=stdout)
+        self.assertIn("Removed 1 entries", stdout.getvalue())
+        stdout = StringIO()
+        call_command(
+            "user_messages_rebuild_search_index", prune=True, stdout=stdout)
+        self.assertIn("Removed 0 entries", stdout.getvalue())
+        self.assertEqual(
+            list(models.Message.objects.search(self.first_user, "report")),
+            [self.first_message, self.other_message]
+        )
@@ -2,6 +2,7 @@
 
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
+from django.core.cache import cache
 from django.urls import reverse
 from django.http.request import QueryDict
 from django.test import TestCase
@@ -9,6 +10,7 @@ import mock
 
 from geonode.groups.models import GroupProfile
 
+from user_messages import counters
 from user_messages import models
 
 
@@ -83,12 +85,29 @@ class ViewsTestCase(Base):
             username=self.first_user.username, password=self.user_password)
         with mock.patch("user_messages.views.Thread",
                         autospec=True) as mock_thread:
-            mock_thread.objects.sorted_active_threads.return_value = []
-            mock_thread.objects.sorted_unread_threads.return_value = []
+            mock_thread.objects.active_threads_page.return_value = []
+            mock_thread.objects.unread_threads_page.return_value = []
             response = self.client.get(reverse("messages_inbox"))
             self.assertEqual(response.status_code, 200)
-            mock_thread.objects.sorted_active_threads.assert_called_with(
-                self.first_user)
+            mock_thread.objects.active_threads_page.assert_called_with(
+                self.first_user, cursor=None)
+
+    def test_inbox_paginates_threads(self):
+        with self.settings(USER_MESSAGES_INBOX_PAGE_SIZE=1):
+            response = self.client.get(reverse("messages_inbox"))
+            first_page = response.context["threads_all"]
+            self.assertEqual(list(first_page), [self.first_thread])
+            response = self.client.get(
+                reverse("messages_inbox"),
+                data={"cursor": first_page.next_cursor}
+            )
+            self.assertEqual(
+                list(response.context["threads_all"]), [self.second_thread])
+
+    def test_inbox_invalid_cursor(self):
+        response = self.client.get(
+            reverse("messages_inbox"), data={"cursor": "invalid"})
+        self.assertEqual(response.status_code, 404)
 
     def test_thread_detail_get_renders(self):
         with mock.patch("user_messages.views.MessageReplyForm",
@@ -105,6 +124,15 @@ class ViewsTestCase(Base):
         user_thread = self.thread.userthread_set.get(user=self.user)
         self.assertFalse(user_thread.unread)
 
+    def test_thread_detail_get_decrements_unread_count(self):
+        cache.clear()
+        self.assertEqual(counters.get_unread_count(self.user), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(
+                reverse("messages_thread_detail", args=(self.thread.id,)))
+        with self.assertNumQueries(0):
+            self.assertEqual(counters.get_unread_count(self.user), 0)
+
     def test_thread_detail_post(self):
         post_data = {"dummy_param": "dummy_value"}
         query_string = "&".join(
@@ -124,6 +152,50 @@ class ViewsTestCase(Base):
             self.assertTrue(MockForm.return_value.save.called)
             self.assertRedirects(response, reverse("messages_inbox"))
 
+    def test_thread_detail_shows_latest_messages(self):
+        with self.settings(USER_MESSAGES_THREAD_PAGE_SIZE=1):
+            response = self.client.get(
+                reverse("messages_thread_detail", args=(self.thread.id,)))
+        page = response.context["thread_messages"]
+        self.assertEqual(list(page), [self.first_reply])
+        self.assertTrue(page.has_next)
+
+    def test_thread_messages_loads_older_messages(self):
+        with self.settings(USER_MESSAGES_THREAD_PAGE_SIZE=1):
+            response = self.client.get(
+                reverse("messages_thread_detail", args=(self.thread.id,)))
+            cursor = response.context["thread_messages"].next_cursor
+            response = self.client.get(
+                reverse("messages_thread_messages", args=(self.thread.id,)),
+                data={"cursor": cursor}
+            )
+        self.assertEqual(response.status_code, 200)
+        page = response.context["thread_messages"]
+        self.assertEqual(list(page), [self.first_message])
+        self.assertFalse(page.has_next)
+
+    def test_thread_messages_invalid_cursor(self):
+        response = self.client.get(
+            reverse("messages_thread_messages", args=(self.thread.id,)),
+            data={"cursor": "invalid"}
+        )
+        self.assertEqual(response.status_code, 404)
+
+    def test_search(self):
+        response = self.client.get(
+            reverse("messages_search"), data={"q": "second"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["query"], "second")
+        self.assertEqual(
+            list(response.context["results"]),
+            [self.second_message, self.first_reply]
+        )
+
+    def test_search_invalid_page(self):
+        response = self.client.get(
+            reverse("messages_search"), data={"q": "test", "page": "x"})
+        self.assertEqual(response.status_code, 404)
+
     def test_message_create_no_args_get_renders(self):
         response = self.client.get(reverse("message_create_multiple"))
         self.assertEqual(response.status_code, 200)
@@ -175,3 +247,76 @@ class ViewsTestCase(Base):
         )
         self.assertEqual(groupmember_thread.deleted, True)
         self.assertRedirects(response, reverse("messages_inbox"))
+
+    def test_thread_delete_updates_unread_count(self):
+        cache.clear()
+        self.assertEqual(counters.get_unread_count(self.user), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                reverse(
+                    "messages_thread_delete",
+                    kwargs={"thread_id": self.thread.id}
+                )
+            )
+        self.assertEqual(counters.get_unread_count(self.user), 0)
+
+    def test_thread_bulk_update_mark_read(self):
+        response = self.client.post(
+            reverse("messages_thread_bulk_update"),
+            data={"action": "mark_read", "thread_ids": [self.thread.id]}
+        )
+        self.assertRedirects(response, reverse("messages_inbox"))
+        self.assertEqual(
+            list(models.Thread.objects.unread_threads(self.user)), [])
+
+    def test_thread_bulk_update_delete_all(self):
+        cache.clear()
+        self.assertEqual(counters.get_unread_count(self.user), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse("messages_thread_bulk_update"),
+                data={"action": "delete", "all": "1"}
+            )
+        self.assertRedirects(response, reverse("messages_inbox"))
+        self.assertEqual(
+            list(models.Thread.objects.active_threads(self.user)), [])
+        self.assertEqual(counters.get_unread_count(self.user), 0)
+
+    def test_thread_bulk_update_invalid_data(self):
+        for data in ({"action": "archive", "all": "1"},
+                     {"action": "delete", "thread_ids": ["x"]}):
+            response = self.client.post(
+                reverse("messages_thread_bulk_update"), data=data)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            len(models.Thread.objects.active_threads(self.user)), 2)
+
+    def test_thread_detail_get_subscribed_group_sets_unread_to_false(self):
+        message = models.Message.objects.new_message(
+            from_user=self.second_user,
+            subject="first message of the subscribed thread",
+            content="test",
+            to_groups=[self.first_group_profile],
+            subscribe_groups=True
+        )
+        self.client.get(
+            reverse("messages_thread_detail", args=(message.thread.id,)))
+        self.assertNotIn(
+            message.thread, models.Thread.objects.unread_threads(self.user))
+
+    def test_thread_delete_subscribed_group(self):
+        message = models.Message.objects.new_message(
+            from_user=self.second_user,
+            subject="first message of the subscribed thread",
+            content="test",
+            to_groups=[self.first_group_profile],
+            subscribe_groups=True
+        )
+        self.client.post(
+            reverse(
+                "messages_thread_delete",
+                kwargs={"thread_id": message.thread.id}
+            )
+        )
+        self.assertNotIn(
+            message.thread, models.Thread.objects.active_threads(self.user))
@@ -1,5 +1,6 @@
 from django.conf.urls import url
 
+from . import api
 from . import views
 
 urlpatterns = [  # "user_messages.views",
@@ -9,6 +10,18 @@ urlpatterns = [  # "user_messages.views",
     url(r"^create/_multiple/$", views.message_create, name="message_create_multiple"),
     url(r"^thread/(?P<thread_id>\d+)/$", views.thread_detail,
         name="messages_thread_detail"),
+    url(r"^thread/(?P<thread_id>\d+)/messages/$", views.thread_messages,
+        name="messages_thread_messages"),
     url(r"^thread/(?P<thread_id>\d+)/delete/$", views.thread_delete,
         name="messages_thread_delete"),
+    url(r"^threads/update/$", views.thread_bulk_update,
+        name="messages_thread_bulk_update"),
+    url(r"^search/$", views.search, name="messages_search"),
+    url(r"^api/inbox/$", api.inbox, name="messages_api_inbox"),
+    url(r"^api/thread/(?P<thread_id>\d+)/messages/$", api.thread_messages,
+        name="messages_api_thread_messages"),
+    url(r"^api/unread_count/$", api.unread_count,
+        name="messages_api_unread_count"),
+    url(r"^api/recipients/$", api.recipients_page,
+        name="messages_api_recipients"),
 ]
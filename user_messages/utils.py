@@ -14,3 +14,18 @@ def cached_attribute(func):
         setattr(self, cache_name, val)
         return val
     return inner
+
+
+def get_group_change_user_ids(instance, action, reverse, pk_set):
+    """Return the ids of the users whose groups are changed by an
+    ``m2m_changed`` signal of ``User.groups``, or ``None`` if they do not
+    change yet."""
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return None
+    if not reverse:
+        # ``instance`` is a user
+        return [instance.pk]
+    if action == "pre_clear":
+        # ``instance`` is a group, whose members are still there
+        return list(instance.user_set.values_list("pk", flat=True))
+    return pk_set
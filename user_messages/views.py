@@ -1,37 +1,64 @@
 from django.urls import reverse
+from django.http import Http404, HttpResponseBadRequest
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.views.decorators.http import require_POST
 
 from django.contrib.auth.decorators import login_required
 
+from user_messages import counters
+from user_messages import fanout
+from user_messages import instrumentation
 from user_messages.forms import MessageReplyForm, NewMessageForm
 from user_messages.models import Message
 from user_messages.models import Thread
-from user_messages.models import UserThread
-from user_messages.models import GroupMemberThread
+from user_messages.pagination import InvalidCursor
 
 
 @login_required
+@instrumentation.instrumented("views.inbox")
 def inbox(request, template_name="user_messages/inbox.html"):
+    try:
+        threads_all = Thread.objects.active_threads_page(
+            request.user, cursor=request.GET.get("cursor") or None)
+        threads_unread = Thread.objects.unread_threads_page(
+            request.user, cursor=request.GET.get("unread_cursor") or None)
+    except InvalidCursor:
+        raise Http404("Invalid cursor")
     return render(
         request,
         template_name,
         context={
-            "threads_all": Thread.objects.sorted_active_threads(request.user),
-            "threads_unread": Thread.objects.sorted_unread_threads(
-                request.user),
+            "threads_all": threads_all,
+            "threads_unread": threads_unread,
         }
     )
 
 
+def _mark_read(thread, user):
+    # deleted records are not taken into account when counting unread
+    # threads, so they can be left alone
+    marked_read = 0
+    for participants in (thread.userthread_set,
+                         thread.groupmemberthread_set):
+        marked_read += participants.filter(
+            user=user, deleted=False, read_sequence__lt=thread.sequence
+        ).update(read_sequence=thread.sequence)
+    marked_read += fanout.add_member_states(
+        thread, user, read_sequence=thread.sequence)
+    if marked_read:
+        counters.decrement_unread_count([user.id])
+
+
 @login_required
+@instrumentation.instrumented("views.thread_detail")
 def thread_detail(request, thread_id,
                   template_name="user_messages/thread_detail.html"):
-    thread = get_object_or_404(
-        Thread.objects.active_threads(request.user),
-        pk=thread_id
-    )
+    threads = Thread.objects.active_threads(request.user)
+    if request.method != "POST":
+        # tells whether the thread has to be marked as read
+        threads = threads.with_user_state(request.user)
+    thread = get_object_or_404(threads, pk=thread_id)
     if request.method == "POST":
         form = MessageReplyForm(request.POST, user=request.user, thread=thread)
         if form.is_valid():
@@ -39,15 +66,54 @@ def thread_detail(request, thread_id,
             return HttpResponseRedirect(reverse("messages_inbox"))
     else:
         form = MessageReplyForm(user=request.user, thread=thread)
-        thread.userthread_set.filter(user=request.user).update(unread=False)
-        thread.groupmemberthread_set.filter(user=request.user).update(unread=False)
+        # a thread that is already read is shown without any write, missing
+        # state records of subscribed groups make the thread unread
+        if thread.user_unread:
+            _mark_read(thread, request.user)
+            thread.user_unread = False
+            thread.user_unread_messages = 0
     return render(request, template_name, context={
         "thread": thread,
+        "thread_messages": Message.objects.messages_page(thread),
         "form": form
     })
 
 
 @login_required
+@instrumentation.instrumented("views.thread_messages")
+def thread_messages(request, thread_id,
+                    template_name="user_messages/thread_messages.html"):
+    thread = get_object_or_404(
+        Thread.objects.active_threads(request.user),
+        pk=thread_id
+    )
+    try:
+        messages = Message.objects.messages_page(
+            thread, cursor=request.GET.get("cursor") or None)
+    except InvalidCursor:
+        raise Http404("Invalid cursor")
+    return render(request, template_name, context={
+        "thread": thread,
+        "thread_messages": messages,
+    })
+
+
+@login_required
+@instrumentation.instrumented("views.search")
+def search(request, template_name="user_messages/search.html"):
+    query = request.GET.get("q", "")
+    try:
+        page = int(request.GET.get("page", 1))
+    except ValueError:
+        raise Http404("Invalid page")
+    return render(request, template_name, context={
+        "query": query,
+        "results": Message.objects.search(request.user, query, page),
+    })
+
+
+@login_required
+@instrumentation.instrumented("views.message_create")
 def message_create(request, user_id=None, group_id=None,
                    template_name="user_messages/message_create.html"):
     subject = request.GET['subject'] if 'subject' in request.GET else ''
@@ -81,23 +147,42 @@ def message_create(request, user_id=None, group_id=None,
 
 @login_required
 @require_POST
+@instrumentation.instrumented("views.thread_delete")
 def thread_delete(request, thread_id):
     thread = get_object_or_404(
         Thread.objects.active_threads(request.user),
         pk=thread_id
     )
-    try:
-        user_thread = thread.userthread_set.get(user=request.user)
-        user_thread.deleted = True
-        user_thread.save()
-    except UserThread.DoesNotExist:
-        # user is not participating in the discussion as standalone
-        # might part of one of the thread's groups though
-        pass
-    try:
-        member_threads = thread.groupmemberthread_set.filter(user=request.user)
-        member_threads.update(deleted=True)
-    except GroupMemberThread.DoesNotExist:
-        # user is not part of any groups that are in the discussion
-        pass
+    Thread.objects.delete_threads(request.user, [thread.pk])
+    return HttpResponseRedirect(reverse("messages_inbox"))
+
+
+_BULK_ACTIONS = {
+    "mark_read": "mark_read",
+    "mark_unread": "mark_unread",
+    "delete": "delete_threads",
+}
+
+
+@login_required
+@require_POST
+@instrumentation.instrumented("views.thread_bulk_update")
+def thread_bulk_update(request):
+    """Apply the ``action`` to the ``thread_ids`` threads, or to all the
+    user's threads if ``all`` is set."""
+    method = _BULK_ACTIONS.get(request.POST.get("action"))
+    if method is None:
+        return HttpResponseBadRequest("Invalid action")
+    if request.POST.get("all"):
+        thread_ids = None
+    else:
+        try:
+            thread_ids = set(
+                int(thread_id)
+                for thread_id in request.POST.getlist("thread_ids")
+            )
+        except ValueError:
+            return HttpResponseBadRequest("Invalid thread id")
+    if thread_ids != set():
+        getattr(Thread.objects, method)(request.user, thread_ids)
     return HttpResponseRedirect(reverse("messages_inbox"))
@@ -0,0 +1,36 @@
+from django import forms
+from django.urls import reverse
+
+
+class RecipientSelectMultiple(forms.SelectMultiple):
+    """A multiple select that only renders the selected users.
+
+    Rendering every possible recipient does not scale with the number of
+    users. The other users are looked up through the endpoint whose URL is
+    set in the ``data-autocomplete-url`` attribute, see
+    ``api.recipients_page``, by the widget's script. Templates include it
+    with ``{{ form.media }}``.
+
+    """
+
+    class Media:
+        js = ("user_messages/js/recipients.js",)
+
+    def get_context(self, name, value, attrs):
+        context = super(RecipientSelectMultiple, self).get_context(
+            name, value, attrs)
+        context["widget"]["attrs"].setdefault(
+            "data-autocomplete-url", reverse("messages_api_recipients"))
+        return context
+
+    def optgroups(self, name, value, attrs=None):
+        pks = [pk for pk in value if str(pk).isdigit()]
+        if not pks:
+            return []
+        groups = []
+        for index, user in enumerate(
+                self.choices.queryset.filter(pk__in=pks).order_by("pk")):
+            option_value, label = self.choices.choice(user)
+            groups.append((None, [self.create_option(
+                name, option_value, label, True, index, attrs=attrs)], index))
+        return groups